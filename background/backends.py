@@ -0,0 +1,112 @@
+## Picks the services we talk to: the real ones, or local stand-ins for running without them
+# Strategy:
+# - Each service (embedding model, elastic search, OCR, mongo) has a setting naming which one
+#   to use, OFFLINE=1 switches them all to their stand-in at once
+# - The stand-ins are deterministic and run in memory, taking about as long as the real
+#   service would (each delay can be set to 0), so the update loop can be run and timed on a
+#   laptop or in CI without any keys
+#   - embeddings: made up vectors from a hash of the text (see fake_embeddings.py)
+#   - elastic search: documents kept in memory, with kNN search (see memory_elasticsearch.py)
+#   - OCR: made up text for each page (see fake_ocr.py)
+#   - mongo: mongomock, nothing is kept once the process ends
+# - Only the stand-ins that are used are imported, so they aren't needed in production. The
+#   real client packages still are offline, the rest of the code uses their helpers and error
+#   types (elastic's bulk helpers, openai's rate limit errors, Document Intelligence's request
+#   model), only their connections aren't made
+# - Crawling and downloading still go over the network, the KB source is read from a file
+
+import os
+
+from dotenv import load_dotenv
+
+from logger import setup_logger
+
+load_dotenv()
+
+logger = setup_logger()
+
+# use the local stand-in for every service below unless it's set otherwise
+OFFLINE = os.getenv("OFFLINE", "") == "1"
+# "openai" or "fake"
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "fake" if OFFLINE else "openai")
+# "elasticsearch" or "memory"
+ELASTIC_BACKEND = os.getenv("ELASTIC_BACKEND", "memory" if OFFLINE else "elasticsearch")
+# "azure" or "fake"
+OCR_BACKEND = os.getenv("OCR_BACKEND", "fake" if OFFLINE else "azure")
+# "mongo" or "mongomock" (needs the mongomock package)
+DATABASE_BACKEND = os.getenv("DATABASE_BACKEND", "mongomock" if OFFLINE else "mongo")
+
+# how long the stand-ins take, roughly what the real services take
+FAKE_EMBEDDING_LATENCY_SECONDS = float(
+    os.getenv("FAKE_EMBEDDING_LATENCY_SECONDS", "0.5")
+)
+MEMORY_ELASTIC_LATENCY_SECONDS = float(
+    os.getenv("MEMORY_ELASTIC_LATENCY_SECONDS", "0.05")
+)
+FAKE_OCR_SECONDS_PER_PAGE = float(os.getenv("FAKE_OCR_SECONDS_PER_PAGE", "1"))
+
+
+def create_embeddings(model: str, dimensions: int | None = None, **kwargs):
+    """The embedding model, kwargs go to OpenAIEmbeddings"""
+    if EMBEDDING_BACKEND == "fake":
+        from fake_embeddings import FakeEmbeddings
+
+        logger.info(f"Using fake embeddings in place of {model}")
+        # its own model name, so its vectors are never cached as the real model's
+        return FakeEmbeddings(
+            dimensions=dimensions or 1536,
+            latency=FAKE_EMBEDDING_LATENCY_SECONDS,
+            model=f"fake-{model}",
+        )
+
+    from langchain_openai import OpenAIEmbeddings
+
+    return OpenAIEmbeddings(model=model, dimensions=dimensions, **kwargs)
+
+
+def create_elasticsearch(**kwargs):
+    """The elastic search client, kwargs go to Elasticsearch"""
+    if ELASTIC_BACKEND == "memory":
+        from memory_elasticsearch import MemoryElasticsearch
+
+        logger.info("Using in-memory elastic search")
+        return MemoryElasticsearch(latency=MEMORY_ELASTIC_LATENCY_SECONDS)
+
+    from elasticsearch import Elasticsearch
+
+    return Elasticsearch(**kwargs)
+
+
+def create_ocr_client():
+    """The OCR client, anything with DocumentIntelligenceClient's begin_analyze_document"""
+    if OCR_BACKEND == "fake":
+        from fake_ocr import FakeDocumentIntelligenceClient
+
+        logger.info("Using fake OCR")
+        return FakeDocumentIntelligenceClient(
+            seconds_per_page=FAKE_OCR_SECONDS_PER_PAGE
+        )
+
+    from azure.ai.documentintelligence import DocumentIntelligenceClient
+    from azure.core.credentials import AzureKeyCredential
+
+    endpoint = os.getenv("AZURE_DOCUMENT_INTELLIGENCE_ENDPOINT")
+    credential = AzureKeyCredential(os.getenv("AZURE_DOCUMENT_INTELLIGENCE_KEY"))
+    return DocumentIntelligenceClient(endpoint, credential)
+
+
+def connect_database(db: str, host: str):
+    """Connect mongoengine to the database"""
+    from mongoengine import connect
+
+    if DATABASE_BACKEND == "mongomock":
+        import mongomock
+
+        logger.info("Using in-memory mongo, nothing is kept once the process ends")
+        return connect(
+            db=db or "policy",
+            host="mongodb://localhost",
+            mongo_client_class=mongomock.MongoClient,
+        )
+
+    return connect(db=db, host=host)
@@ -0,0 +1,276 @@
+## Compares kNN recall of the compact vector index (fewer dimensions, int8_hnsw) against the
+## full size float vectors ElasticsearchStore maps by default, on a local corpus
+# Strategy:
+# - The corpus is the extraction cache (or any folder of .json page lists and .txt files),
+#   split into chunks the same way ingest splits documents
+# - Every chunk is embedded once at the model's full size. The compact vectors are those cut
+#   down to the configured size and normalized again, which is what the API returns for
+#   text-embedding-3 models when asked for fewer dimensions
+# - Both go into a throwaway index each, mapped the old way and the new way, merged down to
+#   one segment so they're compared fairly
+# - Queries are the start of randomly picked chunks. The right answer for each is an exact
+#   (brute force) search over the full size vectors, and recall is how much of it each index's
+#   approximate kNN search finds
+# - Also reports search latency, disk size and the memory elastic wants for the vectors
+#
+# Run with: python background/benchmark_vectors.py
+# Set EMBEDDING_BACKEND=fake to try it out without spending embedding quota (see backends.py).
+# It also runs against the in-memory elastic search, but its kNN is exact and nothing is
+# quantized there, so recall, latency and size only mean something against a real cluster
+
+import json
+import math
+import os
+import random
+from typing import List
+
+from dotenv import load_dotenv
+from elasticsearch import helpers
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+from langchain_elasticsearch import ApproxRetrievalStrategy
+from langchain_elasticsearch._utilities import DistanceStrategy
+
+from backends import create_embeddings
+from embedding_cache import CachedEmbeddings
+from embedding_budget import BudgetedEmbeddings
+from extraction_cache import EXTRACTION_CACHE_DIR
+from logger import setup_logger
+from store import (
+    ELASTIC_INDEX,
+    ELASTIC_VECTOR_M,
+    EMBEDDING_DIMENSIONS,
+    EMBEDDING_MODEL,
+    embedding_budget,
+    embedding_cache,
+    es_client,
+    vector_index_mapping,
+)
+
+load_dotenv()
+
+logger = setup_logger()
+
+# folder of documents to benchmark on
+BENCHMARK_CORPUS_DIR = os.getenv("BENCHMARK_CORPUS_DIR", EXTRACTION_CACHE_DIR)
+# chunks indexed, and how many of them are used as queries
+BENCHMARK_MAX_CHUNKS = int(os.getenv("BENCHMARK_MAX_CHUNKS", "5000"))
+BENCHMARK_QUERIES = int(os.getenv("BENCHMARK_QUERIES", "100"))
+# results per query, and candidates elastic looks at to find them
+BENCHMARK_K = int(os.getenv("BENCHMARK_K", "10"))
+BENCHMARK_NUM_CANDIDATES = int(os.getenv("BENCHMARK_NUM_CANDIDATES", "100"))
+# vector size to compare against the full one, the configured size if there is one
+BENCHMARK_DIMENSIONS = int(
+    os.getenv("BENCHMARK_DIMENSIONS", str(EMBEDDING_DIMENSIONS or 512))
+)
+# characters of a chunk used as a query
+QUERY_LENGTH = 200
+
+BASELINE_INDEX = f"{ELASTIC_INDEX}_benchmark_baseline"
+COMPACT_INDEX = f"{ELASTIC_INDEX}_benchmark_compact"
+
+
+def load_corpus(directory: str) -> List[str]:
+    """The text of each document in the folder"""
+    texts = []
+    for root, _, files in os.walk(directory):
+        for name in sorted(files):
+            path = os.path.join(root, name)
+            try:
+                with open(path, "r", encoding="utf-8") as file:
+                    if name.endswith(".json"):
+                        # an extraction cache entry, a list of (page number, text)
+                        texts.append("\n".join(text for _, text in json.load(file)))
+                    elif name.endswith(".txt"):
+                        texts.append(file.read())
+            except (OSError, ValueError) as e:
+                logger.warning(f"Skipping {path}: {e}")
+
+    return [text for text in texts if text.strip()]
+
+
+def split_corpus(texts: List[str], max_chunks: int) -> List[str]:
+    text_splitter = RecursiveCharacterTextSplitter()
+    chunks = []
+    for text in texts:
+        chunks += text_splitter.split_text(text)
+        if len(chunks) >= max_chunks:
+            break
+    return chunks[:max_chunks]
+
+
+def full_size_embeddings():
+    # same budget and cache as ingest, but always the model's full size
+    return CachedEmbeddings(
+        BudgetedEmbeddings(
+            create_embeddings(EMBEDDING_MODEL, max_retries=0), embedding_budget
+        ),
+        embedding_cache,
+    )
+
+
+def shorten(vector: List[float], dims: int) -> List[float]:
+    """The first dims values, normalized to length 1 again"""
+    values = vector[:dims]
+    length = math.sqrt(sum(value * value for value in values)) or 1
+    return [value / length for value in values]
+
+
+def baseline_mapping(dims: int) -> dict:
+    """The mapping ElasticsearchStore gives a new index"""
+    return ApproxRetrievalStrategy().index(
+        dims_length=dims,
+        vector_query_field="vector",
+        text_field="text",
+        similarity=DistanceStrategy.COSINE,
+    )["mappings"]
+
+
+def fill_index(
+    index: str, mapping: dict, chunks: List[str], vectors: List[List[float]]
+):
+    es_client.indices.delete(index=index, ignore_unavailable=True)
+    es_client.indices.create(
+        index=index, mappings=mapping, settings={"number_of_replicas": 0}
+    )
+
+    helpers.bulk(
+        es_client,
+        (
+            {"_index": index, "_id": str(i), "text": text, "vector": vector}
+            for i, (text, vector) in enumerate(zip(chunks, vectors))
+        ),
+        chunk_size=200,
+    )
+
+    # one segment each, so neither is helped or hurt by how its writes happened to merge
+    client = es_client.options(request_timeout=3600)
+    client.indices.forcemerge(index=index, max_num_segments=1)
+    client.indices.refresh(index=index)
+
+
+def exact_search(index: str, vector: List[float], k: int) -> List[str]:
+    response = es_client.search(
+        index=index,
+        size=k,
+        query={
+            "script_score": {
+                "query": {"match_all": {}},
+                "script": {
+                    "source": "cosineSimilarity(params.vector, 'vector') + 1.0",
+                    "params": {"vector": vector},
+                },
+            }
+        },
+        source=False,
+    )
+    return [hit["_id"] for hit in response["hits"]["hits"]]
+
+
+def knn_search(index: str, vector: List[float], k: int, num_candidates: int):
+    """Ids found and seconds elastic took"""
+    response = es_client.search(
+        index=index,
+        knn={
+            "field": "vector",
+            "query_vector": vector,
+            "k": k,
+            "num_candidates": num_candidates,
+        },
+        size=k,
+        source=False,
+    )
+    return [hit["_id"] for hit in response["hits"]["hits"]], response["took"] / 1000
+
+
+def store_size_mb(index: str) -> float:
+    stats = es_client.indices.stats(index=index, metric="store")
+    size = stats["indices"][index]["primaries"]["store"]["size_in_bytes"]
+    return round(size / (1024 * 1024), 1)
+
+
+def vector_memory_mb(num_vectors: int, dims: int, quantized: bool) -> float:
+    """Off heap memory elastic wants to search the vectors quickly, from its tuning guide"""
+    graph = num_vectors * 4 * ELASTIC_VECTOR_M
+    if quantized:
+        size = num_vectors * (dims + 4)
+    else:
+        size = num_vectors * 4 * dims
+    return round((size + graph) / (1024 * 1024), 1)
+
+
+def run_benchmark() -> dict:
+    texts = load_corpus(BENCHMARK_CORPUS_DIR)
+    chunks = split_corpus(texts, BENCHMARK_MAX_CHUNKS)
+    if not chunks:
+        raise ValueError(f"No documents found in {BENCHMARK_CORPUS_DIR}")
+
+    queries = [
+        chunk[:QUERY_LENGTH]
+        for chunk in random.Random(0).sample(
+            chunks, min(BENCHMARK_QUERIES, len(chunks))
+        )
+    ]
+
+    logger.info(
+        f"Benchmarking {len(chunks)} chunks from {len(texts)} documents, {len(queries)} queries"
+    )
+
+    embeddings = full_size_embeddings()
+    vectors = embeddings.embed_documents(chunks)
+    query_vectors = embeddings.embed_documents(queries)
+
+    full_dims = len(vectors[0])
+    dims = min(BENCHMARK_DIMENSIONS, full_dims)
+
+    fill_index(BASELINE_INDEX, baseline_mapping(full_dims), chunks, vectors)
+    fill_index(
+        COMPACT_INDEX,
+        vector_index_mapping(dims),
+        chunks,
+        [shorten(vector, dims) for vector in vectors],
+    )
+
+    results = {
+        "baseline": {"recall": [], "seconds": []},
+        "compact": {"recall": [], "seconds": []},
+    }
+    for query_vector in query_vectors:
+        expected = set(exact_search(BASELINE_INDEX, query_vector, BENCHMARK_K))
+
+        for name, index, vector in (
+            ("baseline", BASELINE_INDEX, query_vector),
+            ("compact", COMPACT_INDEX, shorten(query_vector, dims)),
+        ):
+            found, seconds = knn_search(
+                index, vector, BENCHMARK_K, BENCHMARK_NUM_CANDIDATES
+            )
+            results[name]["recall"].append(
+                len(expected & set(found)) / max(len(expected), 1)
+            )
+            results[name]["seconds"].append(seconds)
+
+    report = {}
+    for name, index, index_dims, quantized in (
+        ("baseline", BASELINE_INDEX, full_dims, False),
+        ("compact", COMPACT_INDEX, dims, True),
+    ):
+        recall = results[name]["recall"]
+        seconds = results[name]["seconds"]
+        report[name] = {
+            "dimensions": index_dims,
+            f"recall_at_{BENCHMARK_K}": round(sum(recall) / len(recall), 3),
+            "average_ms": round(sum(seconds) / len(seconds) * 1000, 1),
+            "disk_mb": store_size_mb(index),
+            "vector_memory_mb": vector_memory_mb(len(chunks), index_dims, quantized),
+        }
+        logger.info(f"Benchmark {name} ({index}): {report[name]}")
+
+    return report
+
+
+if __name__ == "__main__":
+    try:
+        run_benchmark()
+    finally:
+        for index in (BASELINE_INDEX, COMPACT_INDEX):
+            es_client.indices.delete(index=index, ignore_unavailable=True)
@@ -0,0 +1,342 @@
+## Writes chunks to elastic search in bulk requests shared across documents
+# Strategy:
+# - Documents hand over their bulk actions (index, update, delete) and get a Future back,
+#   instead of each document making its own bulk request (and refresh)
+# - One thread collects actions and sends them as one bulk request once there are enough of
+#   them (by count or size), once the oldest have waited long enough, or when the run ends.
+#   A document's actions always go in the same request
+# - Up to N bulk requests are sent at once, each through the streaming bulk helper. Items
+#   elastic pushes back on (429) are sent again after a backoff
+# - Each document's future resolves to the errors for its own actions, an empty list if
+#   everything was written. Deleting something that's already gone isn't an error
+#   - Results are matched to actions by their position in the request, the same _id can be in
+#     one request more than once. We retry ourselves because the helper's own retries would
+#     give results out of order
+# - Every request's latency is logged, along with the items that failed
+# - For big runs refresh can be switched off on the index while we write, and put back after
+
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+import json
+import os
+import threading
+import time
+from typing import List
+
+from elasticsearch import ApiError, Elasticsearch, helpers
+
+from logger import setup_logger
+
+logger = setup_logger()
+
+# send once this many actions are waiting
+BULK_MAX_ACTIONS = int(os.getenv("BULK_MAX_ACTIONS", "500"))
+# send once the waiting actions are about this big (chunks with vectors are ~30KB each)
+BULK_MAX_MB = float(os.getenv("BULK_MAX_MB", "10"))
+# send whatever is waiting once the oldest action has waited this long
+BULK_MAX_WAIT_SECONDS = float(os.getenv("BULK_MAX_WAIT_SECONDS", "1"))
+# bulk requests sent at once
+BULK_MAX_IN_FLIGHT = int(os.getenv("BULK_MAX_IN_FLIGHT", "2"))
+# times items elastic rejects with 429 are tried again
+BULK_MAX_RETRIES = int(os.getenv("BULK_MAX_RETRIES", "3"))
+# how many failed items to log for each request, the rest are only counted
+BULK_MAX_LOGGED_ERRORS = 5
+
+
+def action_size(action: dict) -> int:
+    """Roughly how many bytes the action adds to a bulk request"""
+    return len(json.dumps(action, default=str))
+
+
+class _Request:
+    def __init__(self, actions: List[dict], future: Future):
+        self.actions = actions
+        self.future = future
+        self.size = sum(action_size(action) for action in actions)
+        self.submitted_at = time.monotonic()
+
+
+class BulkIndexer:
+    """
+    Collects bulk actions across documents and sends them in shared bulk requests.
+    Use as a context manager so whatever is left is sent when the run ends.
+    """
+
+    def __init__(
+        self,
+        client: Elasticsearch,
+        max_actions: int = BULK_MAX_ACTIONS,
+        max_bytes: int = int(BULK_MAX_MB * 1024 * 1024),
+        max_wait_seconds: float = BULK_MAX_WAIT_SECONDS,
+        max_in_flight: int = BULK_MAX_IN_FLIGHT,
+        max_retries: int = BULK_MAX_RETRIES,
+    ):
+        self.client = client
+        self.max_actions = max(1, max_actions)
+        self.max_bytes = max(1, max_bytes)
+        self.max_wait_seconds = max_wait_seconds
+        self.max_in_flight = max(1, max_in_flight)
+        self.max_retries = max_retries
+
+        self._condition = threading.Condition()
+        self._pending: List[_Request] = []
+        self._pending_actions = 0
+        self._pending_bytes = 0
+        self._closed = False
+        self._slots = threading.BoundedSemaphore(self.max_in_flight)
+        self._executor = ThreadPoolExecutor(
+            self.max_in_flight, thread_name_prefix="bulk-request"
+        )
+
+        self.num_batches = 0
+        self.num_actions = 0
+        self.num_errors = 0
+        self.num_bytes = 0
+        self.latencies: List[float] = []
+
+        self._thread = threading.Thread(
+            target=self._run, name="bulk-indexer", daemon=True
+        )
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+        return False
+
+    def submit(self, actions: List[dict]) -> Future:
+        """
+        Queue a document's actions, the future resolves to the errors for them.
+        Every action needs an _id so its errors can be matched back to it.
+        """
+        future = Future()
+
+        if not actions:
+            future.set_result([])
+            return future
+
+        request = _Request(list(actions), future)
+
+        with self._condition:
+            if self._closed:
+                raise RuntimeError("Bulk indexer is closed")
+
+            self._pending.append(request)
+            self._pending_actions += len(request.actions)
+            self._pending_bytes += request.size
+            self._condition.notify()
+
+        return future
+
+    def close(self):
+        """Send whatever is still waiting and stop"""
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+
+        self._thread.join()
+        self._executor.shutdown(wait=True)
+
+    def stats(self) -> dict:
+        with self._condition:
+            latencies = sorted(self.latencies)
+            return {
+                "batches": self.num_batches,
+                "actions": self.num_actions,
+                "errors": self.num_errors,
+                "size_mb": round(self.num_bytes / (1024 * 1024), 2),
+                "average_seconds": (
+                    round(sum(latencies) / len(latencies), 3) if latencies else 0
+                ),
+                "p95_seconds": (
+                    round(latencies[int(len(latencies) * 0.95)], 3) if latencies else 0
+                ),
+                "max_seconds": round(latencies[-1], 3) if latencies else 0,
+            }
+
+    def log_stats(self):
+        stats = self.stats()
+        logger.info(
+            f"Bulk indexing: {stats['batches']} requests, {stats['actions']} actions ({stats['size_mb']} MB), "
+            f"{stats['errors']} failed, {stats['average_seconds']}s average, "
+            f"{stats['p95_seconds']}s p95, {stats['max_seconds']}s max"
+        )
+
+    def _run(self):
+        while True:
+            # wait for a free request first, so the batch keeps filling while they're all busy
+            self._slots.acquire()
+
+            with self._condition:
+                while not self._ready():
+                    if self._closed and not self._pending:
+                        self._slots.release()
+                        return
+                    self._condition.wait(self._wait_seconds())
+
+                batch = self._take_batch()
+
+            self._executor.submit(self._send, batch)
+
+    def _ready(self) -> bool:
+        if not self._pending:
+            return False
+
+        return (
+            self._closed
+            or self._pending_actions >= self.max_actions
+            or self._pending_bytes >= self.max_bytes
+            or time.monotonic() - self._pending[0].submitted_at >= self.max_wait_seconds
+        )
+
+    def _wait_seconds(self) -> float | None:
+        if not self._pending:
+            return None
+        waited = time.monotonic() - self._pending[0].submitted_at
+        return max(self.max_wait_seconds - waited, 0)
+
+    def _take_batch(self) -> List[_Request]:
+        """Take requests off the front until the batch is full, always at least one"""
+        batch = []
+        actions = 0
+        size = 0
+        while self._pending:
+            request = self._pending[0]
+            if batch and (
+                actions + len(request.actions) > self.max_actions
+                or size + request.size > self.max_bytes
+            ):
+                break
+            batch.append(self._pending.pop(0))
+            actions += len(request.actions)
+            size += request.size
+
+        self._pending_actions -= actions
+        self._pending_bytes -= size
+        return batch
+
+    def _send(self, batch: List[_Request]):
+        try:
+            self._send_batch(batch)
+        finally:
+            self._slots.release()
+
+    def _send_batch(self, batch: List[_Request]):
+        actions = [action for request in batch for action in request.actions]
+        size = sum(request.size for request in batch)
+        # the request each action came from, by position
+        owners = [request for request in batch for _ in request.actions]
+        errors_by_request = {id(request): [] for request in batch}
+
+        started = time.monotonic()
+        try:
+            for request, (ok, item) in zip(owners, self._bulk(actions, size)):
+                if ok:
+                    continue
+                op_type, result = next(iter(item.items()))
+                if op_type == "delete" and result.get("status") == 404:
+                    continue
+                errors_by_request[id(request)].append(item)
+        except Exception as e:
+            logger.error(f"Bulk request of {len(actions)} actions failed: {e}")
+            for request in batch:
+                request.future.set_exception(e)
+            return
+
+        seconds = time.monotonic() - started
+        errors = [error for errors in errors_by_request.values() for error in errors]
+
+        with self._condition:
+            self.num_batches += 1
+            self.num_actions += len(actions)
+            self.num_errors += len(errors)
+            self.num_bytes += size
+            self.latencies.append(seconds)
+
+        logger.info(
+            f"Bulk request of {len(actions)} actions ({size / (1024 * 1024):.2f} MB) from {len(batch)} "
+            f"documents took {seconds:.2f}s, {len(errors)} failed"
+        )
+        for error in errors[:BULK_MAX_LOGGED_ERRORS]:
+            op_type, result = next(iter(error.items()))
+            logger.error(
+                f"Bulk {op_type} of {result.get('_id')} failed with status {result.get('status')}: "
+                f"{result.get('error')}"
+            )
+
+        for request in batch:
+            request.future.set_result(errors_by_request[id(request)])
+
+    def _bulk(self, actions: List[dict], size: int) -> list:
+        """(ok, item) for each action in the same order, retrying 429s with a backoff"""
+        results = [None] * len(actions)
+        pending = list(range(len(actions)))
+
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                time.sleep(min(30, 2 ** (attempt - 1)))
+
+            try:
+                for position, (ok, item) in zip(
+                    pending,
+                    helpers.streaming_bulk(
+                        self.client,
+                        [actions[position] for position in pending],
+                        # we've already sized the batch, send it as one request
+                        chunk_size=len(pending),
+                        max_chunk_bytes=max(self.max_bytes, size) * 2,
+                        raise_on_error=False,
+                        max_retries=0,
+                    ),
+                ):
+                    _, result = next(iter(item.items()))
+                    if ok or result.get("status") != 429 or attempt == self.max_retries:
+                        results[position] = (ok, item)
+            except ApiError as e:
+                # the whole request was pushed back, send what's left again
+                if e.status_code != 429 or attempt == self.max_retries:
+                    raise
+
+            pending = [position for position in pending if results[position] is None]
+            if not pending:
+                break
+
+        return results
+
+
+@contextmanager
+def refresh_paused(client: Elasticsearch, index: str, pause: bool = True):
+    """
+    Switch refresh off on the index while writing lots of documents, then put back what it was
+    and refresh once. Searches won't see new chunks until then.
+    """
+    if not pause or not client.indices.exists(index=index):
+        yield
+        return
+
+    settings = client.indices.get_settings(index=index, name="index.refresh_interval")
+    original = (
+        next(iter(settings.body.values()), {})
+        .get("settings", {})
+        .get("index", {})
+        .get("refresh_interval")
+    )
+    # a run that died while paused left it off, put it back to the default then
+    if original == "-1":
+        original = None
+
+    logger.info(f"Pausing refresh on {index}")
+    client.indices.put_settings(
+        index=index, settings={"index": {"refresh_interval": "-1"}}
+    )
+
+    try:
+        yield
+    finally:
+        client.indices.put_settings(
+            index=index, settings={"index": {"refresh_interval": original}}
+        )
+        client.indices.refresh(index=index)
+        logger.info(f"Refresh on {index} restored to {original or 'the default'}")
@@ -0,0 +1,89 @@
+## Checkpoints ingest progress on the IndexAttempt so a restarted worker can resume it
+# Strategy:
+# - After crawling, save the list of policies on the attempt so a resume doesn't crawl again
+# - As documents finish, remember their urls and save them on the attempt whenever the
+#   document writes are flushed. Indexed (or reused) documents are marked by the write buffer
+#   once their record is saved, unchanged ones by ingest. Documents that failed anywhere
+#   aren't remembered, a resume tries them again
+# - On startup, an attempt that is still in progress for the source is picked up again and
+#   every url already on it is skipped
+
+from datetime import datetime, timedelta, timezone
+import threading
+from typing import List
+
+from db import IndexAttempt, IndexStatus, Source
+from logger import setup_logger
+from models.policy_details import PolicyDetails
+
+logger = setup_logger()
+
+
+class IngestCheckpoint:
+    def __init__(self, attempt: IndexAttempt):
+        self.attempt = attempt
+        self.completed_urls = set(attempt.completed_urls or [])
+        self._pending_urls: List[str] = []
+        self._lock = threading.Lock()
+
+    @classmethod
+    def find_resumable(cls, source: Source):
+        """
+        Find the attempt for this source that was still in progress when the worker stopped.
+        Anything older than a day is left for cleanup_old_attempts to fail.
+        """
+        one_day_ago = datetime.now(timezone.utc) - timedelta(days=1)
+        attempt = (
+            IndexAttempt.objects(
+                source_id=source._id,
+                status=IndexStatus.INPROGRESS,
+                start_time__gte=one_day_ago,
+            )
+            .order_by("-start_time")
+            .first()
+        )
+
+        return cls(attempt) if attempt else None
+
+    @property
+    def has_policies(self) -> bool:
+        return bool(self.attempt.policies)
+
+    def get_policies(self) -> List[PolicyDetails]:
+        return [PolicyDetails.from_dict(policy) for policy in self.attempt.policies]
+
+    def save_policies(self, policies: List[PolicyDetails]):
+        self.attempt.policies = [policy.to_dict() for policy in policies if policy]
+        self.attempt.save()
+
+    def is_done(self, url: str) -> bool:
+        return url in self.completed_urls
+
+    def mark_done(self, url: str):
+        """Safe to call from any pipeline stage, saved on the next save()"""
+        with self._lock:
+            if url not in self.completed_urls:
+                self.completed_urls.add(url)
+                self._pending_urls.append(url)
+
+    def save(self, num_docs_indexed: int = 0, num_new_docs: int = 0):
+        """
+        Save the urls finished since the last save, along with how many more documents
+        were indexed. Call after the documents themselves are saved.
+        """
+        with self._lock:
+            urls = self._pending_urls
+            self._pending_urls = []
+
+        if not urls and not num_docs_indexed and not num_new_docs:
+            return
+
+        IndexAttempt.objects(pk=self.attempt.pk).update_one(
+            add_to_set__completed_urls=urls,
+            inc__num_docs_indexed=num_docs_indexed,
+            inc__num_new_docs=num_new_docs,
+        )
+
+        logger.info(
+            f"Checkpoint: {len(self.completed_urls)} documents done for attempt {self.attempt.pk}"
+        )
@@ -10,15 +10,18 @@ from mongoengine import (
     DictField,
     IntField,
     EnumField,
-    connect,
+    ListField,
 )
 
+from backends import connect_database
+
 load_dotenv()
 
 MONGO_CONNECTION = os.getenv("MONGO_CONNECTION")
 MONGO_DB = os.getenv("MONGO_DB")
 
-connect(db=MONGO_DB, host=MONGO_CONNECTION)
+# mongo, or an in-memory stand-in (see backends.py)
+connect_database(MONGO_DB, MONGO_CONNECTION)
 
 
 class RefreshFrequency(Enum):
@@ -61,7 +64,8 @@ class IndexedDocument(Document):
     metadata = DictField(required=True)
     _id = ObjectIdField(default=ObjectId, primary_key=True)
 
-    meta = {"collection": "documents"}
+    # hash lets us find documents with the same content at a different url
+    meta = {"collection": "documents", "indexes": ["metadata.hash"]}
 
 
 class IndexStatus(Enum):
@@ -80,6 +84,9 @@ class IndexAttempt(Document):
     end_time = DateTimeField(required=False)
     duration = IntField(required=True)
     error_details = StringField(default="")
+    # checkpoint so a restarted worker can pick up where this attempt left off
+    policies = ListField(DictField(), default=list)  # crawled PolicyDetails
+    completed_urls = ListField(StringField(), default=list)
     _id = ObjectIdField(default=ObjectId, primary_key=True)
 
     meta = {"collection": "index_attempts"}
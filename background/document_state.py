@@ -0,0 +1,149 @@
+## In-memory view of what we already have indexed for a source
+# Strategy:
+# - Before ingesting a source, load the url, hash, validators and last_updated of every
+#   document in that source with one projected query
+# - Answer "has this document changed?" from memory instead of one Mongo round trip per document
+# - Keep the view up to date as ingest writes documents
+# - Find documents by content hash, so the same file at a new url can reuse what's already indexed
+#   - Only documents already written count, two urls with the same new file in one run are
+#     both extracted and embedded, the next run finds them as duplicates of each other
+
+from datetime import datetime
+import threading
+from typing import Dict
+
+from db import IndexedDocument, Source
+from download import Validators
+from logger import setup_logger
+
+logger = setup_logger()
+
+# the only fields we need to decide if a document has changed
+STATE_FIELDS = [
+    "url",
+    "last_updated",
+    "metadata.hash",
+    "metadata.etag",
+    "metadata.last_modified",
+]
+
+
+class DocumentState:
+    def __init__(
+        self,
+        url: str,
+        hash: str = "",
+        etag: str = "",
+        last_modified: str = "",
+        last_updated: datetime | None = None,
+    ):
+        self.url = url
+        self.hash = hash
+        self.etag = etag
+        self.last_modified = last_modified
+        self.last_updated = last_updated
+
+    @property
+    def validators(self) -> Validators:
+        return Validators(etag=self.etag, last_modified=self.last_modified)
+
+    @classmethod
+    def from_dict(cls, data: dict):
+        metadata = data.get("metadata") or {}
+        return cls(
+            url=data["url"],
+            hash=metadata.get("hash", ""),
+            etag=metadata.get("etag", ""),
+            last_modified=metadata.get("last_modified", ""),
+            last_updated=data.get("last_updated"),
+        )
+
+
+class DocumentStateIndex:
+    """
+    url -> DocumentState for every document we have indexed for a source.
+    Safe to read from the download threads while ingest records new writes.
+    """
+
+    def __init__(self, states: Dict[str, DocumentState] | None = None):
+        self._states = states or {}
+        self._urls_by_hash = {
+            state.hash: state.url for state in self._states.values() if state.hash
+        }
+        self._lock = threading.Lock()
+
+    @classmethod
+    def load_for_source(cls, source: Source):
+        documents = (
+            IndexedDocument.objects(source_id=source._id)
+            .only(*STATE_FIELDS)
+            .as_pymongo()
+        )
+        states = {}
+        for data in documents:
+            state = DocumentState.from_dict(data)
+            states[state.url] = state
+
+        logger.info(f"Loaded {len(states)} known documents for source {source.name}")
+
+        return cls(states)
+
+    def get(self, url: str) -> DocumentState | None:
+        with self._lock:
+            return self._states.get(url)
+
+    def get_hash(self, url: str) -> str:
+        state = self.get(url)
+        return state.hash if state else ""
+
+    def get_validators(self, url: str) -> Validators:
+        state = self.get(url)
+        return state.validators if state else Validators()
+
+    def find_url_by_hash(self, hash: str, exclude_url: str = "") -> str | None:
+        """
+        Find an indexed document with the given content hash at a url other than exclude_url.
+        Checks this source first, then every other source.
+        """
+        if not hash:
+            return None
+
+        with self._lock:
+            url = self._urls_by_hash.get(hash)
+        if url and url != exclude_url:
+            return url
+
+        document = (
+            IndexedDocument.objects(metadata__hash=hash, url__ne=exclude_url)
+            .only("url")
+            .first()
+        )
+        return document.url if document else None
+
+    def record(self, state: DocumentState):
+        """Call when a document is written so later lookups see the new state"""
+        with self._lock:
+            previous = self._states.get(state.url)
+            self._states[state.url] = state
+
+            # the url no longer has its old content, don't send duplicates of that to it
+            if (
+                previous
+                and previous.hash != state.hash
+                and self._urls_by_hash.get(previous.hash) == state.url
+            ):
+                del self._urls_by_hash[previous.hash]
+
+            if state.hash:
+                self._urls_by_hash[state.hash] = state.url
+
+    def record_validators(self, url: str, validators: Validators):
+        with self._lock:
+            state = self._states.get(url)
+            if state:
+                state.etag = validators.etag
+                state.last_modified = validators.last_modified
+
+    def __len__(self):
+        with self._lock:
+            return len(self._states)
@@ -0,0 +1,172 @@
+## Buffers IndexedDocument writes during ingest and saves them in bulk
+# Strategy:
+# - Collect new and changed documents instead of saving each one as we go
+# - Every N documents or T seconds, send everything collected as one unordered bulk write,
+#   upserting on url so new and existing documents are handled the same way
+# - Always flush what's left when ingest finishes, including when it fails part way
+# - After each flush, mark the documents that were saved done on the attempt's checkpoint and
+#   save it (see checkpoint.py), a document that failed to save is left to be tried again
+
+from datetime import datetime, timezone
+import os
+import threading
+import time
+from typing import Dict
+
+from bson import ObjectId
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+from checkpoint import IngestCheckpoint
+from db import IndexedDocument, Source
+from document_state import DocumentState, DocumentStateIndex
+from logger import setup_logger
+from models.policy_details import PolicyDetails, VectorDocument
+
+logger = setup_logger()
+
+# flush after this many documents are waiting
+MONGO_WRITE_BATCH_SIZE = int(os.getenv("MONGO_WRITE_BATCH_SIZE", "100"))
+# flush after documents have been waiting this long
+MONGO_WRITE_FLUSH_SECONDS = float(os.getenv("MONGO_WRITE_FLUSH_SECONDS", "30"))
+
+
+class DocumentWriteBuffer:
+    """
+    Collects IndexedDocument upserts and writes them in batches.
+    Use as a context manager so anything left is written even if ingest raises.
+    Safe to share between pipeline stages.
+    """
+
+    def __init__(
+        self,
+        source: Source,
+        known_documents: DocumentStateIndex | None = None,
+        batch_size: int = MONGO_WRITE_BATCH_SIZE,
+        flush_seconds: float = MONGO_WRITE_FLUSH_SECONDS,
+        checkpoint: IngestCheckpoint | None = None,
+    ):
+        self.source = source
+        self.known_documents = known_documents
+        self.checkpoint = checkpoint
+        self.batch_size = max(1, batch_size)
+        self.flush_seconds = flush_seconds
+
+        # keyed on url so a document added twice before a flush is only written once
+        self._pending: Dict[str, dict] = {}
+        self._last_flush_at = time.monotonic()
+        self._lock = threading.RLock()
+
+        self.num_inserted = 0
+        self.num_updated = 0
+        self.num_failed = 0
+        self.num_flushes = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        try:
+            self.flush()
+        except Exception as e:
+            # don't hide the original error if we're already failing
+            if exc_type is None:
+                raise
+            logger.error(f"Failed to flush document writes while handling error: {e}")
+
+        return False
+
+    def add(self, policy: PolicyDetails, vectorized_document: VectorDocument):
+        record = {
+            "url": policy.url,
+            "metadata": vectorized_document.metadata.to_dict(),
+            "title": policy.title,
+            "filename": policy.filename,
+            "last_updated": datetime.now(timezone.utc),
+        }
+
+        with self._lock:
+            self._pending[policy.url] = record
+
+            # later lookups during this run should see the new state right away
+            if self.known_documents is not None:
+                self.known_documents.record(DocumentState.from_dict(record))
+
+            if len(self._pending) >= self.batch_size:
+                self.flush()
+            else:
+                self.flush_if_due()
+
+    def flush_if_due(self):
+        with self._lock:
+            if time.monotonic() - self._last_flush_at >= self.flush_seconds:
+                self.flush()
+
+    def flush(self):
+        with self._lock:
+            self._last_flush_at = time.monotonic()
+
+            inserted, matched, saved_urls = self._write_pending()
+
+            # only the documents that were saved, so a resume never skips an unsaved document
+            if self.checkpoint:
+                for url in saved_urls:
+                    self.checkpoint.mark_done(url)
+                self.checkpoint.save(
+                    num_docs_indexed=inserted + matched, num_new_docs=inserted
+                )
+
+    def _write_pending(self):
+        if not self._pending:
+            return 0, 0, []
+
+        records = list(self._pending.values())
+        self._pending = {}
+
+        operations = [
+            UpdateOne(
+                {"url": record["url"]},
+                {
+                    "$set": record,
+                    # existing documents keep the source they were first indexed from
+                    "$setOnInsert": {"_id": ObjectId(), "source_id": self.source._id},
+                },
+                upsert=True,
+            )
+            for record in records
+        ]
+
+        self.num_flushes += 1
+
+        try:
+            result = IndexedDocument._get_collection().bulk_write(
+                operations, ordered=False
+            )
+            inserted = result.upserted_count
+            matched = result.matched_count
+            failed_urls = []
+        except BulkWriteError as e:
+            # unordered, so everything else in the batch was still written
+            details = e.details
+            inserted = details.get("nUpserted", 0)
+            matched = details.get("nMatched", 0)
+            failed_urls = []
+            for error in details.get("writeErrors", []):
+                url = records[error["index"]]["url"]
+                failed_urls.append(url)
+                logger.error(f"Failed to save document {url}: {error.get('errmsg')}")
+
+        failed = len(failed_urls)
+        saved_urls = [
+            record["url"] for record in records if record["url"] not in failed_urls
+        ]
+
+        self.num_inserted += inserted
+        self.num_updated += matched
+        self.num_failed += failed
+
+        logger.info(
+            f"Saved {len(records)} documents: {inserted} new, {matched} updated, {failed} failed"
+        )
+
+        return inserted, matched, saved_urls
@@ -0,0 +1,474 @@
+## Downloads documents from their sources so they can be ingested
+# Strategy:
+# - A fixed pool of worker threads pulls policies off a shared list
+# - Each host has a cap on how many downloads can be in flight at once, so UCOP, ellucid
+#   and ucnet can be fetched in parallel while each host still gets polite, bounded traffic
+# - If we have the ETag / Last-Modified from the last download, ask the host to only send
+#   the document if it changed (or check with HEAD for hosts we've seen ignore that this run)
+# - Documents are streamed to disk in chunks and hashed as the bytes arrive, small documents
+#   are kept in memory instead, and anything over the max size is abandoned
+# - Requests to each host are paced by an adaptive rate limiter that speeds up while the host
+#   is healthy and backs off when it pushes back (see rate_limit.py)
+# - Downloaded files are handed back as they finish; workers stop getting ahead once
+#   too many downloaded files are waiting to be processed
+
+from collections import Counter, deque
+import hashlib
+import os
+import queue
+import threading
+import time
+from typing import Callable, Iterator, List, Tuple
+from urllib.parse import urlparse
+import uuid
+
+import requests
+import http_client
+from logger import setup_logger
+from rate_limit import THROTTLE_STATUSES, get_rate_limiter
+from models.policy_details import PolicyDetails
+
+logger = setup_logger()
+
+user_agent = "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36"
+
+# total number of downloads in flight across all hosts
+DOWNLOAD_MAX_WORKERS = int(os.getenv("DOWNLOAD_MAX_WORKERS", "8"))
+# number of downloads in flight for any single host
+DOWNLOAD_MAX_PER_HOST = int(os.getenv("DOWNLOAD_MAX_PER_HOST", "2"))
+# size of each chunk we read from the network
+DOWNLOAD_CHUNK_SIZE = int(os.getenv("DOWNLOAD_CHUNK_SIZE", str(64 * 1024)))
+# give up on any document larger than this
+DOWNLOAD_MAX_BYTES = int(os.getenv("DOWNLOAD_MAX_BYTES", str(200 * 1024 * 1024)))
+# documents up to this size are kept in memory instead of written to disk, 0 to always use disk
+DOWNLOAD_IN_MEMORY_MAX_BYTES = int(
+    os.getenv("DOWNLOAD_IN_MEMORY_MAX_BYTES", str(1024 * 1024))
+)
+
+
+def request_with_retry(
+    url, retries=5, backoff_factor=1, method="GET", ok_statuses=(200,), **kwargs
+):
+    """
+    Sends a request to the specified URL with retry mechanism, paced by the host's rate limiter.
+
+    Args:
+        url (str): The URL to send the request to.
+        retries (int, optional): The number of retries to attempt. Defaults to 5.
+        backoff_factor (int, optional): The backoff factor for exponential backoff. Defaults to 1.
+        method (str, optional): The HTTP method to use. Defaults to "GET".
+        ok_statuses (tuple, optional): Status codes that count as success. Defaults to (200,).
+        **kwargs: Additional keyword arguments to pass to the http_client.request() function.
+
+    Returns:
+        requests.Response or None: The response object if the request is successful, None otherwise.
+    """
+    rate_limiter = get_rate_limiter(get_host(url))
+
+    for attempt in range(retries):
+        rate_limiter.acquire()
+
+        try:
+            response = http_client.request(method, url, **kwargs)
+            retry_after = response.headers.get("Retry-After")
+            rate_limiter.record(
+                response.status_code, response.elapsed.total_seconds(), retry_after
+            )
+            if response.status_code in ok_statuses:
+                return response
+            else:
+                response.close()
+                logger.warning(
+                    f"Request to {url} returned status code {response.status_code} on attempt {attempt + 1}"
+                )
+
+                # the rate limiter will hold the next attempt as long as the host asked
+                if response.status_code in THROTTLE_STATUSES and retry_after:
+                    continue
+        except requests.exceptions.RequestException as e:
+            rate_limiter.record(None, 0)
+            logger.warning(
+                f"Request to {url} failed on attempt {attempt + 1} with exception: {e}"
+            )
+
+        # If we are here, that means the request failed. We wait before retrying.
+        wait_time = backoff_factor * (2**attempt)
+        logger.info(f"Retrying request to {url} in {wait_time} seconds...")
+        time.sleep(wait_time)
+
+    # If we exit the loop without returning, it means we've exhausted all attempts
+    logger.error(f"Failed to fetch {url} after {retries} attempts")
+    return None
+
+
+class Validators:
+    """
+    The ETag and Last-Modified headers a host gave us for a document, used to ask the host
+    if the document has changed since we last downloaded it
+    """
+
+    def __init__(self, etag="", last_modified=""):
+        self.etag = etag or ""
+        self.last_modified = last_modified or ""
+
+    @classmethod
+    def from_response(cls, response: requests.Response):
+        return cls(
+            etag=response.headers.get("ETag", ""),
+            last_modified=response.headers.get("Last-Modified", ""),
+        )
+
+    @classmethod
+    def from_metadata(cls, metadata: dict | None):
+        if not metadata:
+            return cls()
+        return cls(
+            etag=metadata.get("etag", ""),
+            last_modified=metadata.get("last_modified", ""),
+        )
+
+    def to_request_headers(self) -> dict:
+        headers = {}
+        if self.etag:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified:
+            headers["If-Modified-Since"] = self.last_modified
+        return headers
+
+    def matches(self, other: "Validators") -> bool:
+        """
+        True if both sets of validators point to the same version of the document.
+        Prefer the ETag since it's the stronger check, and fall back to Last-Modified.
+        """
+        if self.etag and other.etag:
+            return self.etag == other.etag
+        if self.last_modified and other.last_modified:
+            return self.last_modified == other.last_modified
+        return False
+
+    def __bool__(self):
+        return bool(self.etag or self.last_modified)
+
+    def __eq__(self, other):
+        return (
+            isinstance(other, Validators)
+            and self.etag == other.etag
+            and self.last_modified == other.last_modified
+        )
+
+
+class DownloadResult:
+    def __init__(
+        self,
+        path: str | None = None,
+        content: bytes | None = None,
+        hash: str = "",
+        size: int = 0,
+        validators: Validators | None = None,
+        not_modified: bool = False,
+    ):
+        # small documents are kept in content, larger ones are written to path
+        self.path = path
+        self.content = content
+        self.hash = hash
+        self.size = size
+        self.validators = validators or Validators()
+        # True if the host told us the document hasn't changed, in which case there is no file
+        self.not_modified = not_modified
+
+    @property
+    def pdf(self) -> str | bytes | None:
+        """The downloaded document, either as a path to the file or as bytes"""
+        return self.content if self.content is not None else self.path
+
+
+class DocumentTooLargeError(Exception):
+    pass
+
+
+class ConditionalRequestHosts:
+    """
+    Hosts we've seen send the full document back even though it hasn't changed, for these
+    hosts we check with a HEAD request before downloading. Only kept for one run (one
+    DownloadPool), so a host that starts honoring conditional requests again gets the chance
+    """
+
+    def __init__(self):
+        self._ignoring = set()
+        self._lock = threading.Lock()
+
+    def ignores(self, host: str) -> bool:
+        with self._lock:
+            return host in self._ignoring
+
+    def mark_ignoring(self, host: str):
+        with self._lock:
+            if host not in self._ignoring:
+                logger.info(
+                    f"Host {host} ignores conditional requests, will check with HEAD first"
+                )
+                self._ignoring.add(host)
+
+
+def is_unchanged_by_head(url: str, known: Validators) -> bool:
+    """
+    Ask for just the headers of the document and compare them to what we have stored.
+    Any failure means we can't tell, so we say it has changed and download it.
+    """
+    headers = {"User-Agent": user_agent}
+    response = request_with_retry(
+        url, retries=2, method="HEAD", headers=headers, allow_redirects=True
+    )
+
+    if not response:
+        return False
+
+    return known.matches(Validators.from_response(response))
+
+
+# download the document and return the downloaded file along with its validators
+# if we know the validators from a previous download, only download if it has changed
+def download_pdf(
+    url: str,
+    dir: str,
+    known: Validators | None = None,
+    hosts: ConditionalRequestHosts | None = None,
+) -> DownloadResult | None:
+    headers = {"User-Agent": user_agent}
+    known = known or Validators()
+    hosts = hosts or ConditionalRequestHosts()
+    host = get_host(url)
+
+    if known and hosts.ignores(host):
+        if is_unchanged_by_head(url, known):
+            return DownloadResult(validators=known, not_modified=True)
+    else:
+        headers.update(known.to_request_headers())
+
+    response = request_with_retry(
+        url,
+        headers=headers,
+        allow_redirects=True,
+        ok_statuses=(200, 304),
+        stream=True,
+    )
+
+    if not response:
+        logger.error(f"Failed to download {url}")
+        return None
+
+    with response:
+        if response.status_code == 304:
+            return DownloadResult(validators=known, not_modified=True)
+
+        response.raise_for_status()
+
+        validators = Validators.from_response(response)
+
+        # we asked for the document only if it changed, got it anyway, and it hasn't changed
+        # we only have the headers so far, so closing the response skips the download
+        if known and known.matches(validators):
+            hosts.mark_ignoring(host)
+            return DownloadResult(validators=validators, not_modified=True)
+
+        try:
+            result = stream_to_result(response, dir)
+        except DocumentTooLargeError as e:
+            logger.error(f"Skipping {url}: {e}")
+            return None
+
+        result.validators = validators
+        return result
+
+
+def stream_to_result(
+    response: requests.Response,
+    dir: str,
+    max_bytes: int = DOWNLOAD_MAX_BYTES,
+    in_memory_max_bytes: int = DOWNLOAD_IN_MEMORY_MAX_BYTES,
+) -> DownloadResult:
+    """
+    Read the response body in chunks, hashing as we go. The body stays in memory until it
+    grows past in_memory_max_bytes, then it's moved to a file and the rest is streamed there.
+    """
+    content_length = int(response.headers.get("Content-Length") or 0)
+    if content_length > max_bytes:
+        raise DocumentTooLargeError(
+            f"document is {content_length} bytes, max is {max_bytes}"
+        )
+
+    hasher = hashlib.sha256()
+    buffer = bytearray()
+    size = 0
+    file = None
+    pdf_path = None
+
+    try:
+        for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+            size += len(chunk)
+            if size > max_bytes:
+                raise DocumentTooLargeError(
+                    f"document is larger than the max of {max_bytes} bytes"
+                )
+
+            hasher.update(chunk)
+
+            if file:
+                file.write(chunk)
+                continue
+
+            buffer += chunk
+
+            # too big to keep in memory, move what we have so far to disk
+            if len(buffer) > in_memory_max_bytes:
+                pdf_path = os.path.join(dir, f"{uuid.uuid4()}.pdf")
+                file = open(pdf_path, "wb")
+                file.write(buffer)
+                buffer = bytearray()
+    except Exception:
+        if file:
+            file.close()
+            os.remove(pdf_path)
+        raise
+
+    if file:
+        file.close()
+        return DownloadResult(path=pdf_path, hash=hasher.hexdigest(), size=size)
+
+    return DownloadResult(content=bytes(buffer), hash=hasher.hexdigest(), size=size)
+
+
+def get_host(url: str) -> str:
+    return urlparse(url).netloc.lower()
+
+
+class DownloadPool:
+    """
+    Downloads policies using a pool of worker threads, limiting both the total number of
+    downloads in flight and the number in flight for any one host.
+    """
+
+    def __init__(
+        self,
+        dir: str,
+        max_workers: int = DOWNLOAD_MAX_WORKERS,
+        max_per_host: int = DOWNLOAD_MAX_PER_HOST,
+        max_ready: int | None = None,
+    ):
+        self.dir = dir
+        self.max_workers = max(1, max_workers)
+        self.max_per_host = max(1, max_per_host)
+        # how many downloaded files can be waiting on the consumer before workers pause
+        self.max_ready = max_ready or self.max_workers * 2
+
+        self._condition = threading.Condition()
+        self._pending: deque = deque()
+        self._active_hosts: Counter = Counter()
+        self._ready_slots = threading.Semaphore(self.max_ready)
+        self._results: queue.Queue = queue.Queue()
+        self._stopped = False
+        # what we learn about hosts this run
+        self._conditional_request_hosts = ConditionalRequestHosts()
+
+    def download(
+        self,
+        policies: List[PolicyDetails],
+        get_validators: Callable[[str], Validators] | None = None,
+    ) -> Iterator[Tuple[PolicyDetails, DownloadResult | None]]:
+        """
+        Download every policy, yielding (policy, result) as each download finishes.
+        The result is None if the download failed.
+
+        get_validators should return the validators we have stored for a url, if any,
+        so unchanged documents can be skipped without downloading them.
+        """
+        self._get_validators = get_validators or (lambda url: Validators())
+
+        for policy in policies:
+            if not policy:
+                logger.warning(f"Policy is None, skipping")
+                continue
+            self._pending.append(policy)
+
+        num_downloads = len(self._pending)
+        num_workers = min(self.max_workers, num_downloads)
+
+        logger.info(
+            f"Downloading {num_downloads} documents with {num_workers} workers, at most {self.max_per_host} per host"
+        )
+
+        workers = [
+            threading.Thread(target=self._worker, daemon=True)
+            for _ in range(num_workers)
+        ]
+        for worker in workers:
+            worker.start()
+
+        try:
+            for _ in range(num_downloads):
+                yield self._results.get()
+                # the consumer is done with the previous file, let another download start
+                self._ready_slots.release()
+        finally:
+            self._stop()
+            for worker in workers:
+                worker.join()
+
+    def _worker(self):
+        while True:
+            # don't get too far ahead of the consumer
+            self._ready_slots.acquire()
+
+            task = self._next_task()
+            if task is None:
+                self._ready_slots.release()
+                return
+
+            policy, host = task
+
+            try:
+                known = self._get_validators(policy.url)
+                result = download_pdf(
+                    policy.url, self.dir, known, self._conditional_request_hosts
+                )
+            except Exception as e:
+                logger.error(f"Error downloading {policy.url}: {e}")
+                result = None
+            finally:
+                self._release_host(host)
+
+            self._results.put((policy, result))
+
+    def _next_task(self) -> Tuple[PolicyDetails, str] | None:
+        """
+        Take the next pending policy whose host has a free slot, waiting if every
+        remaining policy is for a host that is already busy.
+        """
+        with self._condition:
+            while not self._stopped and self._pending:
+                for i, policy in enumerate(self._pending):
+                    host = get_host(policy.url)
+                    if self._active_hosts[host] < self.max_per_host:
+                        del self._pending[i]
+                        self._active_hosts[host] += 1
+                        return policy, host
+
+                self._condition.wait()
+
+            return None
+
+    def _release_host(self, host: str):
+        with self._condition:
+            self._active_hosts[host] -= 1
+            self._condition.notify_all()
+
+    def _stop(self):
+        # called when the consumer is done, possibly early because of an error
+        with self._condition:
+            self._stopped = True
+            self._pending.clear()
+            self._condition.notify_all()
+
+        # wake up any workers waiting on the consumer
+        for _ in range(self.max_workers):
+            self._ready_slots.release()
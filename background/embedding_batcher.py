@@ -0,0 +1,227 @@
+## Batches chunks from many documents into each embedding request
+# Strategy:
+# - Documents hand over their chunks and get a Future back for the vectors, instead of
+#   sending a request each (short KB articles would otherwise be one or two chunks a request)
+# - One thread collects chunks and sends them as one request once there are enough of them
+#   (by count or estimated tokens), once the oldest have waited long enough, or when the run ends
+# - A document's chunks always go in the same request, and the vectors are split back out
+#   to each document's future in order
+# - If a request fails, every document in it fails with the same error
+# - Up to N requests are sent at once (each still waits on the API budget, see embedding_budget.py),
+#   chunks keep collecting into the next batch while they're all busy
+
+from concurrent.futures import Future, ThreadPoolExecutor
+import os
+import threading
+import time
+from typing import List
+
+from langchain_core.embeddings import Embeddings
+
+from logger import setup_logger
+
+logger = setup_logger()
+
+# send once this many chunks are waiting
+EMBED_BATCH_MAX_ITEMS = int(os.getenv("EMBED_BATCH_MAX_ITEMS", "512"))
+# send once this many (estimated) tokens are waiting
+EMBED_BATCH_MAX_TOKENS = int(os.getenv("EMBED_BATCH_MAX_TOKENS", "100000"))
+# send whatever is waiting once the oldest chunk has waited this long
+EMBED_BATCH_MAX_WAIT_SECONDS = float(os.getenv("EMBED_BATCH_MAX_WAIT_SECONDS", "2"))
+# embedding requests sent at once
+EMBED_MAX_IN_FLIGHT = int(os.getenv("EMBED_MAX_IN_FLIGHT", "4"))
+
+
+def estimate_tokens(text: str) -> int:
+    """Roughly 4 characters per token for english text, close enough for batching"""
+    return len(text) // 4 + 1
+
+
+class _Request:
+    def __init__(self, texts: List[str], future: Future):
+        self.texts = texts
+        self.future = future
+        self.tokens = sum(estimate_tokens(text) for text in texts)
+        self.submitted_at = time.monotonic()
+
+
+class EmbeddingBatcher:
+    """
+    Collects texts to embed across documents and sends them in batches.
+    Use as a context manager so whatever is left is sent when the run ends.
+    """
+
+    def __init__(
+        self,
+        embeddings: Embeddings,
+        max_items: int = EMBED_BATCH_MAX_ITEMS,
+        max_tokens: int = EMBED_BATCH_MAX_TOKENS,
+        max_wait_seconds: float = EMBED_BATCH_MAX_WAIT_SECONDS,
+        max_in_flight: int = EMBED_MAX_IN_FLIGHT,
+    ):
+        self.embeddings = embeddings
+        self.max_items = max(1, max_items)
+        self.max_tokens = max(1, max_tokens)
+        self.max_wait_seconds = max_wait_seconds
+        self.max_in_flight = max(1, max_in_flight)
+
+        self._condition = threading.Condition()
+        self._pending: List[_Request] = []
+        self._pending_items = 0
+        self._pending_tokens = 0
+        self._closed = False
+        self._slots = threading.BoundedSemaphore(self.max_in_flight)
+        self._executor = ThreadPoolExecutor(
+            self.max_in_flight, thread_name_prefix="embedding-request"
+        )
+
+        self.num_batches = 0
+        self.num_items = 0
+        self.num_tokens = 0
+        self.num_requests = 0
+
+        self._thread = threading.Thread(
+            target=self._run, name="embedding-batcher", daemon=True
+        )
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+        return False
+
+    def submit(self, texts: List[str]) -> Future:
+        """Queue the texts to embed, the future resolves to their vectors in the same order"""
+        future = Future()
+
+        if not texts:
+            future.set_result([])
+            return future
+
+        with self._condition:
+            if self._closed:
+                raise RuntimeError("Embedding batcher is closed")
+
+            self._pending.append(_Request(list(texts), future))
+            self._pending_items += len(texts)
+            self._pending_tokens += self._pending[-1].tokens
+            self._condition.notify()
+
+        return future
+
+    def close(self):
+        """Send whatever is still waiting and stop"""
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+
+        self._thread.join()
+        self._executor.shutdown(wait=True)
+
+    def stats(self) -> dict:
+        with self._condition:
+            return {
+                "batches": self.num_batches,
+                "documents": self.num_requests,
+                "items": self.num_items,
+                "tokens": self.num_tokens,
+                "average_items": (
+                    round(self.num_items / self.num_batches, 1)
+                    if self.num_batches
+                    else 0
+                ),
+            }
+
+    def log_stats(self):
+        stats = self.stats()
+        logger.info(
+            f"Embedding batches: {stats['batches']} requests for {stats['items']} chunks from "
+            f"{stats['documents']} documents, {stats['average_items']} chunks per request, "
+            f"~{stats['tokens']} tokens"
+        )
+
+    def _run(self):
+        while True:
+            # wait for a free request first, so the batch keeps filling while they're all busy
+            self._slots.acquire()
+
+            with self._condition:
+                while not self._ready():
+                    if self._closed and not self._pending:
+                        self._slots.release()
+                        return
+                    self._condition.wait(self._wait_seconds())
+
+                batch = self._take_batch()
+
+            self._executor.submit(self._send, batch)
+
+    def _ready(self) -> bool:
+        if not self._pending:
+            return False
+
+        return (
+            self._closed
+            or self._pending_items >= self.max_items
+            or self._pending_tokens >= self.max_tokens
+            or time.monotonic() - self._pending[0].submitted_at >= self.max_wait_seconds
+        )
+
+    def _wait_seconds(self) -> float | None:
+        if not self._pending:
+            return None
+        waited = time.monotonic() - self._pending[0].submitted_at
+        return max(self.max_wait_seconds - waited, 0)
+
+    def _take_batch(self) -> List[_Request]:
+        """Take requests off the front until the batch is full, always at least one"""
+        batch = []
+        items = 0
+        tokens = 0
+        while self._pending:
+            request = self._pending[0]
+            if batch and (
+                items + len(request.texts) > self.max_items
+                or tokens + request.tokens > self.max_tokens
+            ):
+                break
+            batch.append(self._pending.pop(0))
+            items += len(request.texts)
+            tokens += request.tokens
+
+        self._pending_items -= items
+        self._pending_tokens -= tokens
+        return batch
+
+    def _send(self, batch: List[_Request]):
+        try:
+            self._send_batch(batch)
+        finally:
+            self._slots.release()
+
+    def _send_batch(self, batch: List[_Request]):
+        texts = [text for request in batch for text in request.texts]
+
+        logger.info(f"Embedding {len(texts)} chunks from {len(batch)} documents")
+
+        try:
+            vectors = self.embeddings.embed_documents(texts)
+        except Exception as e:
+            logger.error(f"Failed to embed {len(texts)} chunks: {e}")
+            for request in batch:
+                request.future.set_exception(e)
+            return
+
+        with self._condition:
+            self.num_batches += 1
+            self.num_requests += len(batch)
+            self.num_items += len(texts)
+            self.num_tokens += sum(request.tokens for request in batch)
+
+        start = 0
+        for request in batch:
+            end = start + len(request.texts)
+            request.future.set_result(vectors[start:end])
+            start = end
@@ -0,0 +1,236 @@
+## Keeps embedding requests inside the API's tokens per minute and requests per minute budget
+# Strategy:
+# - Two token buckets for the embedding model, one counting (estimated) tokens and one counting
+#   requests, each refilled continuously at its per minute budget
+# - Every request waits until both buckets have room, so several requests can be in flight at
+#   once (see embedding_batcher.py) and together they use the budget without going over it
+# - The openai client's own retries are turned off so rate limit errors reach us: nothing is
+#   sent until Retry-After (or a backoff) has passed, then the request is tried again
+# - Connection errors, timeouts and server errors are retried after a backoff too
+# - Counts what was sent so we can see how much of the budget a run actually used
+
+import math
+import os
+import threading
+import time
+from typing import Callable, List
+
+import openai
+from langchain_core.embeddings import Embeddings
+
+from embedding_batcher import estimate_tokens
+from logger import setup_logger
+from rate_limit import parse_retry_after
+
+logger = setup_logger()
+
+# the budget for the embedding model, see the rate limits page of the OpenAI account
+EMBEDDING_TOKENS_PER_MINUTE = int(os.getenv("EMBEDDING_TOKENS_PER_MINUTE", "1000000"))
+EMBEDDING_REQUESTS_PER_MINUTE = int(os.getenv("EMBEDDING_REQUESTS_PER_MINUTE", "3000"))
+# how many seconds of budget can be spent at once after sitting idle
+EMBEDDING_BUDGET_BURST_SECONDS = float(
+    os.getenv("EMBEDDING_BUDGET_BURST_SECONDS", "10")
+)
+# times a request is tried again after a rate limit or server error
+EMBEDDING_MAX_RETRIES = int(os.getenv("EMBEDDING_MAX_RETRIES", "6"))
+# first backoff when there's no Retry-After, doubled each attempt up to the max
+EMBEDDING_RETRY_SECONDS = float(os.getenv("EMBEDDING_RETRY_SECONDS", "1"))
+EMBEDDING_RETRY_MAX_SECONDS = float(os.getenv("EMBEDDING_RETRY_MAX_SECONDS", "60"))
+
+# errors worth trying again, anything else (bad input, auth) fails right away
+RETRYABLE_ERRORS = (
+    openai.RateLimitError,
+    openai.APITimeoutError,
+    openai.APIConnectionError,
+    openai.InternalServerError,
+)
+
+
+class EmbeddingBudget:
+    """Token buckets for one embedding model's per minute limits. Safe to share between threads."""
+
+    def __init__(
+        self,
+        model: str,
+        tokens_per_minute: int = EMBEDDING_TOKENS_PER_MINUTE,
+        requests_per_minute: int = EMBEDDING_REQUESTS_PER_MINUTE,
+        burst_seconds: float = EMBEDDING_BUDGET_BURST_SECONDS,
+    ):
+        self.model = model
+        self.tokens_per_second = max(1, tokens_per_minute) / 60
+        self.requests_per_second = max(1, requests_per_minute) / 60
+        self.max_tokens = self.tokens_per_second * burst_seconds
+        self.max_requests = max(1.0, self.requests_per_second * burst_seconds)
+
+        self._lock = threading.Lock()
+        self._tokens = self.max_tokens
+        self._requests = self.max_requests
+        self._last_refill = time.monotonic()
+        # monotonic time before which nothing should be sent, after a rate limit error
+        self._blocked_until = 0.0
+
+        self.reset_stats()
+
+    def acquire(self, tokens: int, requests: int = 1):
+        """Wait until there's budget for the request, then take it"""
+        started = time.monotonic()
+
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+
+                wait = self._blocked_until - now
+                if wait <= 0:
+                    # a request bigger than the bucket goes once the bucket is full, leaving it
+                    # in debt so the requests after it wait for the difference
+                    needed_tokens = min(tokens, self.max_tokens)
+                    needed_requests = min(requests, self.max_requests)
+                    if (
+                        self._tokens >= needed_tokens
+                        and self._requests >= needed_requests
+                    ):
+                        self._tokens -= tokens
+                        self._requests -= requests
+                        self.waited_seconds += now - started
+                        return
+
+                    wait = max(
+                        (needed_tokens - self._tokens) / self.tokens_per_second,
+                        (needed_requests - self._requests) / self.requests_per_second,
+                    )
+
+            time.sleep(wait)
+
+    def record(self, tokens: int, requests: int = 1):
+        """A request that was sent and answered"""
+        with self._lock:
+            self.num_requests += requests
+            self.num_tokens += tokens
+
+    def throttle(self, seconds: float):
+        """The API told us to slow down, send nothing for a while"""
+        with self._lock:
+            self.num_throttled += 1
+            self._blocked_until = max(self._blocked_until, time.monotonic() + seconds)
+            # start from empty buckets once we're allowed to send again
+            self._tokens = min(self._tokens, 0)
+            self._requests = min(self._requests, 0)
+
+        logger.warning(
+            f"Embedding rate limit hit for {self.model}, waiting {seconds:.1f}s"
+        )
+
+    def reset_stats(self):
+        with self._lock:
+            self.num_requests = 0
+            self.num_tokens = 0
+            self.num_throttled = 0
+            self.waited_seconds = 0.0
+            # rates are over the whole run, a few requests close together say nothing about
+            # how much of the budget it used
+            self._stats_started = time.monotonic()
+
+    def stats(self) -> dict:
+        with self._lock:
+            elapsed = time.monotonic() - self._stats_started
+            return {
+                "model": self.model,
+                "requests": self.num_requests,
+                "tokens": self.num_tokens,
+                "throttled": self.num_throttled,
+                "waited_seconds": round(self.waited_seconds, 1),
+                "tokens_per_second": (
+                    round(self.num_tokens / elapsed, 1) if elapsed > 0 else 0
+                ),
+                "budget_tokens_per_second": round(self.tokens_per_second, 1),
+            }
+
+    def log_stats(self):
+        stats = self.stats()
+        logger.info(
+            f"Embedding budget {stats['model']}: {stats['requests']} requests, ~{stats['tokens']} tokens at "
+            f"{stats['tokens_per_second']} tokens/s (budget {stats['budget_tokens_per_second']}), "
+            f"{stats['throttled']} rate limited, {stats['waited_seconds']}s waiting on the budget"
+        )
+
+    def _refill(self, now: float):
+        elapsed = now - self._last_refill
+        self._tokens = min(
+            self.max_tokens, self._tokens + elapsed * self.tokens_per_second
+        )
+        self._requests = min(
+            self.max_requests, self._requests + elapsed * self.requests_per_second
+        )
+        self._last_refill = now
+
+
+def retry_after_seconds(error: Exception, attempt: int) -> float:
+    """How long to wait before trying again, from Retry-After if the API sent one"""
+    response = getattr(error, "response", None)
+    if response is not None:
+        seconds = parse_retry_after(response.headers.get("retry-after"))
+        if seconds:
+            return seconds
+
+    return min(EMBEDDING_RETRY_SECONDS * 2**attempt, EMBEDDING_RETRY_MAX_SECONDS)
+
+
+class BudgetedEmbeddings(Embeddings):
+    """Embeddings that only sends requests when the budget allows, retrying rate limit errors"""
+
+    def __init__(
+        self,
+        embeddings: Embeddings,
+        budget: EmbeddingBudget,
+        max_retries: int = EMBEDDING_MAX_RETRIES,
+    ):
+        self.embeddings = embeddings
+        self.budget = budget
+        self.max_retries = max_retries
+        # the cache keys vectors on these, so they have to be the real model's
+        self.model = getattr(embeddings, "model", type(embeddings).__name__)
+        self.dimensions = getattr(embeddings, "dimensions", None)
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        if not texts:
+            return []
+
+        tokens = sum(estimate_tokens(text) for text in texts)
+        # the client splits big lists into several requests
+        chunk_size = getattr(self.embeddings, "chunk_size", None) or len(texts)
+        requests = math.ceil(len(texts) / chunk_size)
+
+        return self._call(
+            lambda: self.embeddings.embed_documents(texts), tokens, requests
+        )
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._call(
+            lambda: self.embeddings.embed_query(text), estimate_tokens(text), 1
+        )
+
+    def _call(self, send: Callable, tokens: int, requests: int):
+        attempt = 0
+        while True:
+            self.budget.acquire(tokens, requests)
+
+            try:
+                result = send()
+            except RETRYABLE_ERRORS as e:
+                if attempt >= self.max_retries:
+                    raise
+
+                seconds = retry_after_seconds(e, attempt)
+                if isinstance(e, openai.RateLimitError):
+                    self.budget.throttle(seconds)
+                else:
+                    logger.warning(
+                        f"Embedding request failed, trying again in {seconds:.1f}s: {e}"
+                    )
+                    time.sleep(seconds)
+                attempt += 1
+                continue
+
+            self.budget.record(tokens, requests)
+            return result
@@ -0,0 +1,230 @@
+## Caches embeddings on disk so the same text is never embedded twice
+# Strategy:
+# - Wrap the embedding model, anything it's asked to embed is looked up first and only
+#   the misses are sent on to the real model
+# - Vectors are keyed on the model, its dimensions and a hash of the chunk text with its
+#   whitespace normalized, so boilerplate, duplicate documents and re-runs after wiping
+#   elastic are all hits
+# - Stored in a local sqlite database, capped in size, least recently used vectors are
+#   removed when it's over
+# - Queries aren't cached, they're one-off
+
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from array import array
+from typing import Dict, List
+
+from langchain_core.embeddings import Embeddings
+
+from logger import setup_logger
+
+logger = setup_logger()
+
+# sqlite database for cached vectors, empty to disable the cache
+EMBEDDING_CACHE_PATH = os.getenv("EMBEDDING_CACHE_PATH", "./cache/embeddings.sqlite3")
+# max total size of the cached vectors
+EMBEDDING_CACHE_MAX_MB = int(os.getenv("EMBEDDING_CACHE_MAX_MB", "2048"))
+
+
+def normalize_text(text: str) -> str:
+    """Text that only differs in unicode form or whitespace embeds the same"""
+    return re.sub(r"\s+", " ", unicodedata.normalize("NFC", text)).strip()
+
+
+def text_hash(text: str) -> str:
+    return hashlib.sha256(normalize_text(text).encode()).hexdigest()
+
+
+class EmbeddingCache:
+    """A size bounded LRU store of vectors in sqlite. Safe to share between threads."""
+
+    def __init__(
+        self,
+        path: str = EMBEDDING_CACHE_PATH,
+        max_bytes: int = EMBEDDING_CACHE_MAX_MB * 1024 * 1024,
+    ):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._connection = None
+        self._size = 0
+
+        self.num_hits = 0
+        self.num_misses = 0
+        self.num_evictions = 0
+
+        if self.enabled:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._connection = sqlite3.connect(self.path, check_same_thread=False)
+            self._connection.executescript("""
+                CREATE TABLE IF NOT EXISTS embeddings (
+                    model TEXT NOT NULL,
+                    dimensions INTEGER NOT NULL,
+                    hash TEXT NOT NULL,
+                    vector BLOB NOT NULL,
+                    last_used REAL NOT NULL,
+                    PRIMARY KEY (model, dimensions, hash)
+                );
+                CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used);
+                """)
+            self._size = self._connection.execute(
+                "SELECT COALESCE(SUM(LENGTH(vector)), 0) FROM embeddings"
+            ).fetchone()[0]
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.path) and self.max_bytes > 0
+
+    def get_many(
+        self, model: str, dimensions: int, hashes: List[str]
+    ) -> Dict[str, List[float]]:
+        """Cached vectors for whichever of the hashes we have"""
+        if not self.enabled or not hashes:
+            return {}
+
+        unique = list(set(hashes))
+        found = {}
+
+        with self._lock:
+            # stay well under sqlite's limit on query parameters
+            for start in range(0, len(unique), 500):
+                batch = unique[start : start + 500]
+                rows = self._connection.execute(
+                    f"SELECT hash, vector FROM embeddings WHERE model = ? AND dimensions = ? "
+                    f"AND hash IN ({','.join('?' * len(batch))})",
+                    [model, dimensions, *batch],
+                ).fetchall()
+                for hash, vector in rows:
+                    found[hash] = array("f", vector).tolist()
+
+            if found:
+                self._connection.executemany(
+                    "UPDATE embeddings SET last_used = ? WHERE model = ? AND dimensions = ? AND hash = ?",
+                    [(time.time(), model, dimensions, hash) for hash in found],
+                )
+                self._connection.commit()
+
+            hits = sum(1 for hash in hashes if hash in found)
+            self.num_hits += hits
+            self.num_misses += len(hashes) - hits
+
+        return found
+
+    def put_many(self, model: str, dimensions: int, vectors: Dict[str, List[float]]):
+        if not self.enabled or not vectors:
+            return
+
+        now = time.time()
+        rows = [
+            # stored as 4 byte floats
+            (model, dimensions, hash, array("f", vector).tobytes(), now)
+            for hash, vector in vectors.items()
+        ]
+
+        with self._lock:
+            for _, _, hash, _, _ in rows:
+                previous = self._connection.execute(
+                    "SELECT LENGTH(vector) FROM embeddings WHERE model = ? AND dimensions = ? AND hash = ?",
+                    (model, dimensions, hash),
+                ).fetchone()
+                if previous:
+                    self._size -= previous[0]
+
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO embeddings (model, dimensions, hash, vector, last_used) "
+                "VALUES (?, ?, ?, ?, ?)",
+                rows,
+            )
+            self._size += sum(len(row[3]) for row in rows)
+            self._evict()
+            self._connection.commit()
+
+    def reset_stats(self):
+        with self._lock:
+            self.num_hits = 0
+            self.num_misses = 0
+            self.num_evictions = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.num_hits + self.num_misses
+            return {
+                "size_mb": round(self._size / (1024 * 1024), 2),
+                "hits": self.num_hits,
+                "misses": self.num_misses,
+                "evictions": self.num_evictions,
+                "hit_rate": round(self.num_hits / lookups, 2) if lookups else 0,
+            }
+
+    def log_stats(self):
+        if not self.enabled:
+            return
+
+        stats = self.stats()
+        logger.info(
+            f"Embedding cache: {stats['hits']} hits, {stats['misses']} misses ({stats['hit_rate']} hit rate), "
+            f"{stats['evictions']} evicted, using {stats['size_mb']} MB"
+        )
+
+    def _evict(self):
+        # called with the lock held
+        while self._size > self.max_bytes:
+            rows = self._connection.execute(
+                "SELECT rowid, LENGTH(vector) FROM embeddings ORDER BY last_used LIMIT 1000"
+            ).fetchall()
+            if not rows:
+                self._size = 0
+                return
+
+            evict = []
+            for rowid, size in rows:
+                if self._size <= self.max_bytes:
+                    break
+                evict.append((rowid,))
+                self._size -= size
+
+            self._connection.executemany(
+                "DELETE FROM embeddings WHERE rowid = ?", evict
+            )
+            self.num_evictions += len(evict)
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    Embeddings that checks the cache before asking the model, and saves what the model returns
+    """
+
+    def __init__(self, embeddings: Embeddings, cache: EmbeddingCache):
+        self.embeddings = embeddings
+        self.cache = cache
+        self.model = getattr(embeddings, "model", type(embeddings).__name__)
+        # 0 means the model's default
+        self.dimensions = getattr(embeddings, "dimensions", None) or 0
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        hashes = [text_hash(text) for text in texts]
+        vectors = self.cache.get_many(self.model, self.dimensions, hashes)
+
+        # embed each missing text once, even if it's in the list more than once
+        missing = {}
+        for text, hash in zip(texts, hashes):
+            if hash not in vectors and hash not in missing:
+                missing[hash] = text
+
+        if missing:
+            embedded = self.embeddings.embed_documents(list(missing.values()))
+            new_vectors = dict(zip(missing.keys(), embedded))
+            self.cache.put_many(self.model, self.dimensions, new_vectors)
+            vectors.update(new_vectors)
+
+        return [vectors[hash] for hash in hashes]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embeddings.embed_query(text)
@@ -1,69 +1,88 @@
-import os
-from azure.core.credentials import AzureKeyCredential
-from azure.ai.documentintelligence import DocumentIntelligenceClient
-from azure.ai.documentintelligence.models import AnalyzeResult, AnalyzeDocumentRequest
+from typing import List, Tuple
 from dotenv import load_dotenv
-from pypdf import PdfReader
+import pypdf
 
+from background.backends import create_ocr_client
+from background.extract_pool import ExtractionPool, iter_pdf_pages, select_pdf_pages
 from background.logger import setup_logger
+from background.ocr_queue import OcrQueue
 
 load_dotenv()
 
 logger = setup_logger()
 
-endpoint = os.getenv("AZURE_DOCUMENT_INTELLIGENCE_ENDPOINT")
-credential = AzureKeyCredential(os.getenv("AZURE_DOCUMENT_INTELLIGENCE_KEY"))
-document_intelligence_client = DocumentIntelligenceClient(endpoint, credential)
+# Azure Document Intelligence, or a stand-in that makes up text (see backends.py)
+document_intelligence_client = create_ocr_client()
 
+# OCR model used for scanned documents
+OCR_MODEL = "prebuilt-read"
 
-def extract_text_from_unreadable_doc(doc_url: str) -> str | None:
-    """
-    Extract text from a document that is not readable by the
-    pypdf library. This could be due to the document being
-    a scanned PDF or an image file.
+# bump when extraction changes in a way that changes its output, so cached text is thrown away
+EXTRACTOR_VERSION = f"pypdf-{pypdf.__version__}/{OCR_MODEL}/2"
 
-    Uses Azure's Document Intelligence service to extract text.
-    """
-    try:
-        logger.info(f"Analyzing document {doc_url} for OCR text extraction")
 
-        poller = document_intelligence_client.begin_analyze_document(
-            "prebuilt-read", AnalyzeDocumentRequest(url_source=doc_url)
-        )
-        result: AnalyzeResult = poller.result()
+def create_ocr_queue() -> OcrQueue:
+    """OCR jobs for scanned pages run through this so ingest doesn't wait on them (see ocr_queue.py)"""
+    return OcrQueue(document_intelligence_client, OCR_MODEL)
+
 
-        text = ""
+def read_pdf_bytes(pdf: str | bytes | memoryview) -> bytes:
+    if isinstance(pdf, (bytes, bytearray, memoryview)):
+        return bytes(pdf)
+    with open(pdf, "rb") as file:
+        return file.read()
 
-        for page in result.pages:
-            for line in page.lines:
-                text += line.content + "\n"
 
-        return text
-    except Exception as e:
-        logger.error(f"Error analyzing document {doc_url}: {e}")
-        return None
+def read_pdf_pages(
+    pdf: str | bytes | memoryview,
+    original_doc_url: str,
+    pool: ExtractionPool | None = None,
+) -> List[Tuple[int, str]]:
+    """
+    (page number, text) for every page pypdf can read, including pages without text.
+    If a pool is given, pypdf runs in one of its worker processes (see extract_pool.py).
+    """
+    logger.info(f"Extracting text from {original_doc_url}")
+
+    return list(pool.iter_pages(pdf) if pool else iter_pdf_pages(pdf))
 
 
-def extract_text_from_pdf(input_path: str, original_doc_url: str) -> str:
+def find_scanned_pages(pages: List[Tuple[int, str]]) -> List[int]:
+    """Pages without text are probably scanned, those need OCR"""
+    return [page_number for page_number, text in pages if not text.strip()]
+
+
+def scanned_pages_document(
+    pdf: str | bytes | memoryview,
+    page_numbers: List[int],
+    num_pages: int,
+    pool: ExtractionPool | None = None,
+) -> bytes:
     """
-    Extract text from a PDF file. If the text is empty, then
-    we might have a scanned PDF -- try to extract text using OCR.
+    The document to send to OCR for the given pages.
+    Only those pages are uploaded, cut out into a PDF of their own.
     """
-    try:
-        logger.info(f"Extracting text from {original_doc_url}")
-        with open(input_path, "rb") as file:
-            pdf = PdfReader(file)
-            text = ""
-            for page in pdf.pages:
-                text += (
-                    page.extract_text() or ""
-                )  # Adding a fallback of empty string if None is returned
-
-            # if text is empty, then we might have a scanned pdf -- try to extract text using OCR
-            if not text:
-                logger.info(f"Extracting text using OCR from {original_doc_url}")
-                text = extract_text_from_unreadable_doc(original_doc_url)
-
-            return text
-    except Exception as e:
-        logger.error(f"Error extracting text from {original_doc_url}: {e}")
+    if len(page_numbers) == num_pages:
+        # every page is scanned, send the file as it is
+        return read_pdf_bytes(pdf)
+    if pool:
+        return pool.select_pages(pdf, page_numbers)
+    return select_pdf_pages(pdf, page_numbers)
+
+
+def merge_ocr_pages(
+    pages: List[Tuple[int, str]],
+    page_numbers: List[int],
+    ocr_pages: List[Tuple[int, str]],
+) -> List[Tuple[int, str]]:
+    """Put the OCR text for the scanned pages back in page order"""
+    # the OCR result numbers pages within the document we sent
+    ocr_text = {
+        page_numbers[ocr_page_number - 1]: text
+        for ocr_page_number, text in ocr_pages
+        if ocr_page_number <= len(page_numbers)
+    }
+
+    return [
+        (page_number, ocr_text.get(page_number, text)) for page_number, text in pages
+    ]
@@ -0,0 +1,336 @@
+## Runs pypdf text extraction in a pool of worker processes
+# Strategy:
+# - pypdf is CPU bound and holds the GIL, so run it in separate processes instead of the ingest threads
+# - Each worker is a small python process running this file, we send it a PDF (path or bytes)
+#   and it sends back the text of each page as soon as it's read
+# - Workers can also cut the scanned pages out of a PDF so only those are sent to OCR
+# - Each worker caps its own memory, so one pathological PDF can't balloon the whole worker loop
+# - If a worker doesn't answer within the timeout it's killed and replaced, and that document fails
+# - If a worker crashes only that document fails
+# - Workers are replaced after N documents so memory leaked by pypdf doesn't pile up
+#
+# OCR of the scanned pages runs in the background through the OCR queue (see ocr_queue.py)
+
+import io
+import os
+import pickle
+import queue
+import select
+import struct
+import subprocess
+import sys
+import threading
+import time
+import types
+from typing import Iterator, List, Tuple
+
+# number of worker processes
+EXTRACT_WORKERS = int(os.getenv("EXTRACT_WORKERS", "2"))
+# seconds a worker gets to extract one document before it's killed
+EXTRACT_TIMEOUT_SECONDS = float(os.getenv("EXTRACT_TIMEOUT_SECONDS", "120"))
+# max memory for each worker process, 0 for no limit
+EXTRACT_MAX_MEMORY_MB = int(os.getenv("EXTRACT_MAX_MEMORY_MB", "1024"))
+# replace each worker after it has extracted this many documents
+EXTRACT_MAX_DOCS_PER_WORKER = int(os.getenv("EXTRACT_MAX_DOCS_PER_WORKER", "50"))
+
+
+def open_pdf(pdf: str | bytes | memoryview):
+    """
+    Open a PDF given either a path to the file or its contents in memory
+    """
+    if isinstance(pdf, (bytes, bytearray, memoryview)):
+        return io.BytesIO(pdf)
+    return open(pdf, "rb")
+
+
+def iter_pdf_pages(pdf: str | bytes | memoryview) -> Iterator[Tuple[int, str]]:
+    """
+    Read the text of each page with pypdf, yielding (page number, text) starting at page 1.
+    Pages without any text come back as empty strings, usually that means a scanned page.
+    """
+    from pypdf import PdfReader
+
+    with open_pdf(pdf) as file:
+        reader = PdfReader(file)
+        for page_number, page in enumerate(reader.pages, start=1):
+            # Adding a fallback of empty string if None is returned
+            yield page_number, page.extract_text() or ""
+
+
+def select_pdf_pages(pdf: str | bytes | memoryview, page_numbers: List[int]) -> bytes:
+    """A new PDF with just the given pages (numbered from 1), in that order"""
+    from pypdf import PdfReader, PdfWriter
+
+    with open_pdf(pdf) as file:
+        reader = PdfReader(file)
+        writer = PdfWriter()
+        for page_number in page_numbers:
+            writer.add_page(reader.pages[page_number - 1])
+
+        output = io.BytesIO()
+        writer.write(output)
+        return output.getvalue()
+
+
+# what a worker can be asked to do, generators send back each item as it's ready
+_TASKS = {
+    "pages": iter_pdf_pages,
+    "select_pages": select_pdf_pages,
+}
+
+
+class ExtractionError(Exception):
+    pass
+
+
+class ExtractionTimeout(ExtractionError):
+    pass
+
+
+# every message from a worker is a pickle prefixed with its length, so we can read exactly
+# one message at a time straight from the pipe and never wait on data that's already buffered
+_HEADER = struct.Struct(">I")
+
+
+def _send_message(file, message):
+    data = pickle.dumps(message)
+    file.write(_HEADER.pack(len(data)) + data)
+    file.flush()
+
+
+class _Worker:
+    def __init__(self, max_memory_mb: int):
+        self.process = subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), str(max_memory_mb)],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+        )
+        self.num_docs = 0
+
+    def run(self, task: str, args: tuple, timeout: float):
+        """
+        Run one of _TASKS in the worker, yielding each item it sends back as it arrives.
+        The task's result is the return value of this generator.
+        """
+        try:
+            pickle.dump((task, args), self.process.stdin)
+            self.process.stdin.flush()
+        except (BrokenPipeError, OSError) as e:
+            raise ExtractionError(f"worker process died: {e}")
+
+        # the timeout is for the whole task, not each item
+        deadline = time.monotonic() + timeout
+
+        while True:
+            (size,) = _HEADER.unpack(self._read(_HEADER.size, deadline, timeout))
+            status, value = pickle.loads(self._read(size, deadline, timeout))
+
+            if status == "item":
+                yield value
+            elif status == "done":
+                self.num_docs += 1
+                return value
+            else:
+                self.num_docs += 1
+                raise ExtractionError(value)
+
+    def _read(self, size: int, deadline: float, timeout: float) -> bytes:
+        fd = self.process.stdout.fileno()
+        data = bytearray()
+        while len(data) < size:
+            ready, _, _ = select.select(
+                [fd], [], [], max(deadline - time.monotonic(), 0)
+            )
+            if not ready:
+                raise ExtractionTimeout(f"timed out after {timeout}s")
+
+            chunk = os.read(fd, size - len(data))
+            if not chunk:
+                raise ExtractionError(
+                    f"worker process crashed (exit code {self.process.wait()})"
+                )
+            data += chunk
+        return bytes(data)
+
+    def stop(self):
+        try:
+            self.process.stdin.close()
+            self.process.wait(timeout=5)
+        except Exception:
+            self.kill()
+
+    def kill(self):
+        self.process.kill()
+        self.process.wait()
+
+
+class ExtractionPool:
+    """
+    A pool of pypdf worker processes. Can be used from many threads at once,
+    each call waits for a free worker and holds it until it's done.
+    """
+
+    def __init__(
+        self,
+        workers: int = EXTRACT_WORKERS,
+        timeout: float = EXTRACT_TIMEOUT_SECONDS,
+        max_memory_mb: int = EXTRACT_MAX_MEMORY_MB,
+        max_docs_per_worker: int = EXTRACT_MAX_DOCS_PER_WORKER,
+    ):
+        self.workers = max(1, workers)
+        self.timeout = timeout
+        self.max_memory_mb = max_memory_mb
+        self.max_docs_per_worker = max(1, max_docs_per_worker)
+
+        # workers are started the first time they're needed
+        self._idle: queue.Queue = queue.Queue()
+        for _ in range(self.workers):
+            self._idle.put(None)
+
+        self._lock = threading.Lock()
+        self._all: set = set()
+
+        self.num_timeouts = 0
+        self.num_failures = 0
+        self.num_recycled = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+        return False
+
+    def iter_pages(self, pdf: str | bytes | memoryview) -> Iterator[Tuple[int, str]]:
+        """
+        Extract the text of the PDF in a worker process, yielding (page number, text)
+        as each page is read. Raises ExtractionError if the worker fails, crashes or times out.
+        """
+        return self._run("pages", pdf)
+
+    def select_pages(
+        self, pdf: str | bytes | memoryview, page_numbers: List[int]
+    ) -> bytes:
+        """
+        A new PDF with just the given pages, made in a worker process.
+        Raises ExtractionError if the worker fails, crashes or times out.
+        """
+        run = self._run("select_pages", pdf, page_numbers)
+        while True:
+            try:
+                next(run)
+            except StopIteration as done:
+                return done.value
+
+    def _run(self, task: str, pdf: str | bytes | memoryview, *args):
+        if isinstance(pdf, memoryview):
+            pdf = pdf.tobytes()
+
+        worker = self._idle.get()
+        finished = False
+        try:
+            if worker is None:
+                worker = self._start_worker()
+
+            try:
+                result = yield from worker.run(task, (pdf, *args), self.timeout)
+                finished = True
+            except ExtractionError as e:
+                with self._lock:
+                    if isinstance(e, ExtractionTimeout):
+                        self.num_timeouts += 1
+                    else:
+                        self.num_failures += 1
+
+                # the worker may be stuck or in a bad state, don't use it again
+                self._discard(worker, kill=True)
+                worker = None
+                raise
+
+            if worker.num_docs >= self.max_docs_per_worker:
+                with self._lock:
+                    self.num_recycled += 1
+                self._discard(worker)
+                worker = None
+
+            return result
+        finally:
+            # stopped reading part way, the worker still has items for us so start fresh
+            if worker is not None and not finished:
+                self._discard(worker, kill=True)
+                worker = None
+            self._idle.put(worker)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "workers": self.workers,
+                "timeouts": self.num_timeouts,
+                "failures": self.num_failures,
+                "recycled": self.num_recycled,
+            }
+
+    def close(self):
+        with self._lock:
+            workers = list(self._all)
+            self._all.clear()
+
+        for worker in workers:
+            worker.stop()
+
+    def _start_worker(self) -> _Worker:
+        worker = _Worker(self.max_memory_mb)
+        with self._lock:
+            self._all.add(worker)
+        return worker
+
+    def _discard(self, worker: _Worker, kill: bool = False):
+        with self._lock:
+            self._all.discard(worker)
+
+        if kill:
+            worker.kill()
+        else:
+            worker.stop()
+
+
+def _worker_main(max_memory_mb: int):
+    """
+    Runs in the worker process: read (task, args) from stdin, write ("item", value) to stdout
+    for each item a generator task yields, then ("done", result) or ("error", message)
+    """
+    if max_memory_mb:
+        import resource
+
+        limit = max_memory_mb * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+    stdin = sys.stdin.buffer
+    stdout = sys.stdout.buffer
+
+    # anything pypdf prints should not end up in our results
+    sys.stdout = sys.stderr
+
+    while True:
+        try:
+            task, args = pickle.load(stdin)
+        except EOFError:
+            return
+
+        try:
+            value = _TASKS[task](*args)
+            if isinstance(value, types.GeneratorType):
+                for item in value:
+                    _send_message(stdout, ("item", item))
+                value = None
+            result = ("done", value)
+        except MemoryError:
+            result = ("error", f"ran out of memory (limit {max_memory_mb} MB)")
+        except Exception as e:
+            result = ("error", f"{type(e).__name__}: {e}")
+
+        _send_message(stdout, result)
+
+
+if __name__ == "__main__":
+    _worker_main(int(sys.argv[1]) if len(sys.argv) > 1 else 0)
@@ -0,0 +1,192 @@
+## On-disk cache of extracted text, keyed by the file's hash
+# Strategy:
+# - We already hash every download, so the same file always maps to the same cache entry,
+#   whatever url it came from
+# - The key also includes the extractor version, so changing how we extract text
+#   (pypdf upgrade, OCR model) means old entries are simply never read again
+# - Each entry is one file holding the document's pages, written atomically so a crash
+#   never leaves half an entry
+# - The cache is capped in size, when it's over the least recently used entries are removed
+#   (reading an entry bumps its modified time, which is what we sort on)
+# - Failed extractions are never cached, documents with no text are, so a scanned
+#   document that OCR couldn't read isn't sent to OCR again
+
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+from typing import Dict, List, Tuple
+
+from logger import setup_logger
+
+logger = setup_logger()
+
+# where cache entries are kept, empty to disable the cache
+EXTRACTION_CACHE_DIR = os.getenv("EXTRACTION_CACHE_DIR", "./cache/extraction")
+# max total size of the cache
+EXTRACTION_CACHE_MAX_MB = int(os.getenv("EXTRACTION_CACHE_MAX_MB", "1024"))
+
+_SUFFIX = ".json"
+
+
+class ExtractionCache:
+    """
+    A size bounded LRU cache of (page number, text) lists on disk. Safe to share between threads.
+    """
+
+    def __init__(
+        self,
+        version: str,
+        directory: str = EXTRACTION_CACHE_DIR,
+        max_bytes: int = EXTRACTION_CACHE_MAX_MB * 1024 * 1024,
+    ):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.version = hashlib.sha256(version.encode()).hexdigest()[:12]
+
+        self._lock = threading.Lock()
+        # file name -> (size, last used), for every entry on disk
+        self._entries: Dict[str, Tuple[int, float]] = {}
+        self._size = 0
+
+        self.num_hits = 0
+        self.num_misses = 0
+        self.num_evictions = 0
+
+        if self.enabled:
+            os.makedirs(self.directory, exist_ok=True)
+            self._load()
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.directory) and self.max_bytes > 0
+
+    def get(self, hash: str) -> List[Tuple[int, str]] | None:
+        """The cached pages for the file with this hash, or None if we don't have them"""
+        if not self.enabled or not hash:
+            return None
+
+        name = self._name(hash)
+        path = os.path.join(self.directory, name)
+
+        try:
+            with open(path, "r", encoding="utf-8") as file:
+                pages = [(page_number, text) for page_number, text in json.load(file)]
+            # mark it as recently used
+            os.utime(path)
+        except FileNotFoundError:
+            with self._lock:
+                self.num_misses += 1
+            return None
+        except (OSError, ValueError) as e:
+            logger.warning(f"Removing unreadable extraction cache entry {name}: {e}")
+            self._remove(name)
+            with self._lock:
+                previous = self._entries.pop(name, None)
+                if previous:
+                    self._size -= previous[0]
+                self.num_misses += 1
+            return None
+
+        with self._lock:
+            self.num_hits += 1
+            if name in self._entries:
+                self._entries[name] = (self._entries[name][0], time.time())
+
+        return pages
+
+    def put(self, hash: str, pages: List[Tuple[int, str]]):
+        if not self.enabled or not hash or pages is None:
+            return
+
+        name = self._name(hash)
+        data = json.dumps(pages).encode("utf-8")
+
+        # bigger than the whole cache, not worth keeping
+        if len(data) > self.max_bytes:
+            return
+
+        path = os.path.join(self.directory, name)
+
+        try:
+            fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+            with os.fdopen(fd, "wb") as file:
+                file.write(data)
+            os.replace(temp_path, path)
+            last_used = os.path.getmtime(path)
+        except OSError as e:
+            logger.warning(f"Failed to write extraction cache entry {name}: {e}")
+            return
+
+        with self._lock:
+            previous = self._entries.get(name)
+            if previous:
+                self._size -= previous[0]
+            self._entries[name] = (len(data), last_used)
+            self._size += len(data)
+
+        self._evict()
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.num_hits + self.num_misses
+            return {
+                "entries": len(self._entries),
+                "size_mb": round(self._size / (1024 * 1024), 2),
+                "hits": self.num_hits,
+                "misses": self.num_misses,
+                "evictions": self.num_evictions,
+                "hit_rate": round(self.num_hits / lookups, 2) if lookups else 0,
+            }
+
+    def log_stats(self):
+        if not self.enabled:
+            return
+
+        stats = self.stats()
+        logger.info(
+            f"Extraction cache: {stats['hits']} hits, {stats['misses']} misses ({stats['hit_rate']} hit rate), "
+            f"{stats['evictions']} evicted, {stats['entries']} entries using {stats['size_mb']} MB"
+        )
+
+    def _name(self, hash: str) -> str:
+        return f"{hash}-{self.version}{_SUFFIX}"
+
+    def _load(self):
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".tmp"):
+                # left over from a write that never finished
+                self._remove(entry.name)
+            elif entry.name.endswith(_SUFFIX):
+                stat = entry.stat()
+                self._entries[entry.name] = (stat.st_size, stat.st_mtime)
+                self._size += stat.st_size
+
+        self._evict()
+
+    def _evict(self):
+        with self._lock:
+            if self._size <= self.max_bytes:
+                return
+
+            # oldest first
+            oldest = sorted(self._entries.items(), key=lambda entry: entry[1][1])
+            evict = []
+            for name, (size, _) in oldest:
+                if self._size <= self.max_bytes:
+                    break
+                del self._entries[name]
+                self._size -= size
+                self.num_evictions += 1
+                evict.append(name)
+
+        for name in evict:
+            self._remove(name)
+
+    def _remove(self, name: str):
+        try:
+            os.remove(os.path.join(self.directory, name))
+        except OSError:
+            pass
@@ -0,0 +1,91 @@
+## A stand-in for the OpenAI embedding API, for trying out embedding changes without spending quota
+# Strategy:
+# - Vectors are made up from a hash of the text, so the same text always gets the same vector
+# - Optionally enforces its own tokens and requests per minute over a sliding minute, failing
+#   with the same RateLimitError (and Retry-After) the real client raises when over
+# - Optionally takes a while to answer, like a real request would
+
+from collections import deque
+import hashlib
+import random
+import threading
+import time
+from typing import List
+
+import httpx
+import openai
+from langchain_core.embeddings import Embeddings
+
+from embedding_batcher import estimate_tokens
+
+
+class FakeEmbeddings(Embeddings):
+    def __init__(
+        self,
+        dimensions: int = 1536,
+        tokens_per_minute: int | None = None,
+        requests_per_minute: int | None = None,
+        latency: float = 0,
+        model: str = "fake-embedding",
+    ):
+        self.model = model
+        self.dimensions = dimensions
+        self.tokens_per_minute = tokens_per_minute
+        self.requests_per_minute = requests_per_minute
+        self.latency = latency
+
+        self._lock = threading.Lock()
+        # (time, tokens) of each request answered in the last minute
+        self._window = deque()
+
+        self.num_requests = 0
+        self.num_rate_limited = 0
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        self._check_rate_limit(sum(estimate_tokens(text) for text in texts))
+        if self.latency:
+            time.sleep(self.latency)
+        return [self._vector(text) for text in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_documents([text])[0]
+
+    def _vector(self, text: str) -> List[float]:
+        seed = int.from_bytes(hashlib.sha256(text.encode()).digest()[:8], "big")
+        values = random.Random(seed).choices(range(-1000, 1001), k=self.dimensions)
+        length = sum(value * value for value in values) ** 0.5 or 1
+        return [value / length for value in values]
+
+    def _check_rate_limit(self, tokens: int):
+        with self._lock:
+            now = time.monotonic()
+            while self._window and self._window[0][0] <= now - 60:
+                self._window.popleft()
+
+            used_tokens = sum(used for _, used in self._window)
+            over = (
+                self.requests_per_minute is not None
+                and len(self._window) + 1 > self.requests_per_minute
+            ) or (
+                self.tokens_per_minute is not None
+                and used_tokens + tokens > self.tokens_per_minute
+                # a single request over the limit only goes through an empty window
+                and self._window
+            )
+
+            if not over:
+                self._window.append((now, tokens))
+                self.num_requests += 1
+                return
+
+            self.num_rate_limited += 1
+            retry_after = max(1, round(self._window[0][0] + 60 - now))
+
+        response = httpx.Response(
+            429,
+            headers={"retry-after": str(retry_after)},
+            request=httpx.Request("POST", "https://fake.invalid/v1/embeddings"),
+        )
+        raise openai.RateLimitError(
+            f"Rate limit reached for {self.model}", response=response, body=None
+        )
@@ -0,0 +1,93 @@
+## A stand-in for the Document Intelligence client, for running OCR offline
+# Strategy:
+# - Speaks the same protocol OcrQueue uses (see ocr_queue.py): begin_analyze_document(model,
+#   request) returns a poller with done() and result(), the result has pages with lines
+# - Each page of the document gets made up text, seeded from the document's bytes and the
+#   page number, so the same document always reads the same
+# - A job isn't done until a few seconds per page have passed, like the real service
+
+import base64
+import hashlib
+import io
+import random
+import threading
+import time
+from types import SimpleNamespace
+
+import pypdf
+
+# words the made up text is drawn from
+WORDS = (
+    "policy university campus employee student department office responsible "
+    "procedure requirement review approval records compliance safety health "
+    "leave salary appointment faculty staff academic personnel research funds "
+    "contract service access information security report annual committee "
+    "chancellor president regents effective date section exception training"
+).split()
+# made up text per page
+LINES_PER_PAGE = 30
+WORDS_PER_LINE = 12
+
+
+def request_bytes(request) -> bytes:
+    """The document an AnalyzeDocumentRequest (or a plain dict of one) carries"""
+    if isinstance(request, (bytes, bytearray, memoryview)):
+        return bytes(request)
+    return base64.b64decode(request["base64Source"])
+
+
+def page_lines(document_hash: str, page_number: int):
+    rng = random.Random(f"{document_hash}/{page_number}")
+    return [
+        f"Page {page_number}. "
+        + " ".join(rng.choice(WORDS) for _ in range(WORDS_PER_LINE))
+        for _ in range(LINES_PER_PAGE)
+    ]
+
+
+class FakePoller:
+    def __init__(self, result, ready_at: float):
+        self._result = result
+        self._ready_at = ready_at
+
+    def done(self) -> bool:
+        return time.monotonic() >= self._ready_at
+
+    def result(self):
+        wait = self._ready_at - time.monotonic()
+        if wait > 0:
+            time.sleep(wait)
+        return self._result
+
+
+class FakeDocumentIntelligenceClient:
+    def __init__(self, seconds_per_page: float = 1):
+        self.seconds_per_page = seconds_per_page
+        self._lock = threading.Lock()
+        self.num_requests = 0
+        self.num_pages = 0
+
+    def begin_analyze_document(self, model: str, request, **kwargs) -> FakePoller:
+        document = request_bytes(request)
+        num_pages = len(pypdf.PdfReader(io.BytesIO(document)).pages)
+        document_hash = hashlib.sha256(document).hexdigest()
+
+        pages = [
+            SimpleNamespace(
+                page_number=page_number,
+                lines=[
+                    SimpleNamespace(content=line)
+                    for line in page_lines(document_hash, page_number)
+                ],
+            )
+            for page_number in range(1, num_pages + 1)
+        ]
+
+        with self._lock:
+            self.num_requests += 1
+            self.num_pages += num_pages
+
+        return FakePoller(
+            SimpleNamespace(pages=pages),
+            time.monotonic() + self.seconds_per_page * num_pages,
+        )
@@ -0,0 +1,149 @@
+## Shared HTTP client used for every fetch during ingest
+# Strategy:
+# - One requests Session shared across all download threads, so connections to the same few
+#   hosts are kept alive and reused instead of paying for a new TCP+TLS handshake each time
+# - Each host gets its own connection pool, sized so every download worker for that host
+#   can hold a connection
+# - Count requests and new connections per host so we can see how often connections are reused
+
+from collections import Counter
+import os
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+from logger import setup_logger
+
+logger = setup_logger()
+
+# number of hosts to keep connection pools for
+HTTP_POOL_CONNECTIONS = int(os.getenv("HTTP_POOL_CONNECTIONS", "10"))
+# number of connections to keep alive for each host
+HTTP_POOL_MAXSIZE = int(os.getenv("HTTP_POOL_MAXSIZE", "4"))
+# seconds to wait when connecting and when waiting for data, used if a request doesn't set its own
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "10"))
+HTTP_READ_TIMEOUT = float(os.getenv("HTTP_READ_TIMEOUT", "60"))
+
+
+class ConnectionStats:
+    """
+    Counts requests and newly opened connections per host.
+    Any request that didn't need a new connection reused one from the pool.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = Counter()
+        self.new_connections = Counter()
+
+    def record_request(self, host: str):
+        with self._lock:
+            self.requests[host] += 1
+
+    def record_new_connection(self, host: str):
+        with self._lock:
+            self.new_connections[host] += 1
+
+    def reset(self):
+        with self._lock:
+            self.requests.clear()
+            self.new_connections.clear()
+
+    def summary(self) -> dict:
+        with self._lock:
+            hosts = set(self.requests) | set(self.new_connections)
+            return {
+                host: {
+                    "requests": self.requests[host],
+                    "new_connections": self.new_connections[host],
+                    "reused": max(0, self.requests[host] - self.new_connections[host]),
+                }
+                for host in sorted(hosts)
+            }
+
+
+connection_stats = ConnectionStats()
+
+
+class _CountingHTTPConnectionPool(HTTPConnectionPool):
+    def _new_conn(self):
+        connection_stats.record_new_connection(self.host)
+        return super()._new_conn()
+
+
+class _CountingHTTPSConnectionPool(HTTPSConnectionPool):
+    def _new_conn(self):
+        connection_stats.record_new_connection(self.host)
+        return super()._new_conn()
+
+
+class PooledHTTPAdapter(HTTPAdapter):
+    """HTTPAdapter whose connection pools report every new connection they open"""
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": _CountingHTTPConnectionPool,
+            "https": _CountingHTTPSConnectionPool,
+        }
+
+
+def _record_response(response: requests.Response, *args, **kwargs):
+    connection_stats.record_request(requests.utils.urlparse(response.url).hostname)
+
+
+def create_session(
+    pool_connections: int = HTTP_POOL_CONNECTIONS,
+    pool_maxsize: int = HTTP_POOL_MAXSIZE,
+) -> requests.Session:
+    session = requests.Session()
+
+    # retries are handled by the caller, see download.request_with_retry
+    adapter = PooledHTTPAdapter(
+        pool_connections=pool_connections,
+        pool_maxsize=pool_maxsize,
+        max_retries=0,
+        pool_block=False,
+    )
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    session.hooks["response"].append(_record_response)
+
+    return session
+
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_session() -> requests.Session:
+    """Get the shared session, creating it the first time"""
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = create_session()
+        return _session
+
+
+def request(method: str, url: str, **kwargs) -> requests.Response:
+    """Send a request through the shared session, using the default timeouts if none are given"""
+    kwargs.setdefault("timeout", (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT))
+    return get_session().request(method, url, **kwargs)
+
+
+def log_connection_stats():
+    summary = connection_stats.summary()
+
+    for host, stats in summary.items():
+        logger.info(
+            f"HTTP {host}: {stats['requests']} requests, {stats['new_connections']} new connections, {stats['reused']} reused"
+        )
+
+    total_requests = sum(s["requests"] for s in summary.values())
+    total_reused = sum(s["reused"] for s in summary.values())
+    if total_requests:
+        logger.info(
+            f"HTTP connection reuse: {total_reused} of {total_requests} requests ({total_reused / total_requests:.0%})"
+        )
@@ -1,33 +1,91 @@
 ## This will ingest documents from the provided source from downloading to vectorizing and saving to elastic
 # Strategy:
-# - One at a time, download the document from the source
-# - Calculate the file hash and check if it already exists in the database
-# - If it exists and hasn't been changed, quit
-# - If it exists and has been changed, or doesn't exist, continue to next step
-# - Extract the text from the document
-# - Vectorize the text
-# - Save the document to elastic search
+# - Download documents from the source in parallel, a few at a time per host (see download.py)
+# - As they finish downloading, send them through a pipeline of stages (see pipeline.py),
+#   each with its own workers, so we're extracting and embedding while still downloading:
+# - check:
+#   - Skip documents the host says haven't changed since our last download (ETag / Last-Modified)
+#   - Calculate the file hash and check if it already exists in the database
+#     (everything we know about the source is loaded up front in one query, see document_state.py)
+#   - If it exists and hasn't been changed, quit
+#   - If it exists and has been changed, or doesn't exist, continue to next step
+#   - If the same file is already indexed at another url, copy what's indexed and go straight to record
+# - extract: Extract the text of each page of the document, in a pool of worker processes (see extract_pool.py)
+#   unless we've extracted the same file before (see extraction_cache.py)
+#   - Pages without text are sent to OCR in the background (see ocr_queue.py)
+# - ocr: Wait for OCR on any scanned pages and put their text back in page order
+# - chunk: Split the text into chunks, a page at a time, and compare them to the chunks
+#   already indexed for the document
+# - embed: Vectorize the chunks that are new, unchanged chunks keep the vectors they have.
+#   Chunks from many documents are sent together (see embedding_batcher.py)
+# - index: Save the new chunks to elastic search and delete the ones that are gone, in bulk
+#   requests shared with other documents (see bulk_indexer.py). Big runs switch refresh off
+#   on the index until they're done. The document's whole text goes to the full text index
+#   (ELASTIC_INDEX_FULLTEXT) the same way, one record per url
+# - record: Once its chunks are written, save the document to the database, in batches
+#   (see document_writer.py)
 # - Update the source's last_updated field or create it if it doesn't exist
+# - Progress is checkpointed on the index attempt so a restarted worker skips finished documents
 
+from concurrent.futures import Future
 from datetime import datetime, timezone
 import hashlib
 import os
-import random
 import tempfile
-import time
+import threading
 from typing import List, Tuple
-import uuid
 
-import requests
-from background.extract import extract_text_from_pdf
+from background.extract import (
+    EXTRACTOR_VERSION,
+    create_ocr_queue,
+    find_scanned_pages,
+    merge_ocr_pages,
+    read_pdf_pages,
+    scanned_pages_document,
+)
+from background.extract_pool import ExtractionPool
+from background.ocr_queue import OcrQueue
+from bulk_indexer import BulkIndexer, refresh_paused
+from checkpoint import IngestCheckpoint
 from db import IndexedDocument, Source
+from document_state import DocumentStateIndex
+from document_writer import DocumentWriteBuffer
+from embedding_batcher import EmbeddingBatcher
+from download import DownloadPool, DownloadResult, Validators
+from extraction_cache import ExtractionCache
+from http_client import connection_stats, log_connection_stats
 from logger import log_memory_usage, setup_logger
-from store import vectorize_text
+from pipeline import Pipeline, Stage
+from rate_limit import log_rate_limiter_state
+from store import (
+    ELASTIC_INDEX,
+    ELASTIC_INDEX_FULLTEXT,
+    copy_document_text,
+    copy_document_vectors,
+    diff_chunks,
+    embed_chunks,
+    embedding,
+    embedding_budget,
+    embedding_cache,
+    es_client,
+    has_ignored_classification,
+    index_chunk_changes,
+    index_document_text,
+    split_document,
+)
 from models.policy_details import PolicyDetails, VectorDocument
 
 logger = setup_logger()
 
-user_agent = "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36"
+# workers for each of the slower ingest stages (extract gets one per EXTRACT_WORKERS process)
+INGEST_INDEX_WORKERS = int(os.getenv("INGEST_INDEX_WORKERS", "2"))
+# documents that can be waiting on their vectors at once, more gives the embedding batcher
+# more documents to fill each request from
+INGEST_EMBED_PENDING_DOCS = int(os.getenv("INGEST_EMBED_PENDING_DOCS", "16"))
+# documents that can be waiting on their chunks to be written at once, for the same reason
+INGEST_INDEX_PENDING_DOCS = int(os.getenv("INGEST_INDEX_PENDING_DOCS", "32"))
+# switch refresh off on the index while writing when a run has at least this many documents
+INGEST_PAUSE_REFRESH_MIN_DOCS = int(os.getenv("INGEST_PAUSE_REFRESH_MIN_DOCS", "200"))
 
 
 class IngestResult:
@@ -48,147 +106,534 @@ class IngestResult:
         self.duration = duration
 
 
-def request_with_retry(url, retries=5, backoff_factor=1, **kwargs):
+class IngestItem:
+    """
+    A document as it moves through the ingest stages, each stage fills in more of it
     """
-    Sends a GET request to the specified URL with retry mechanism.
-
-    Args:
-        url (str): The URL to send the request to.
-        retries (int, optional): The number of retries to attempt. Defaults to 5.
-        backoff_factor (int, optional): The backoff factor for exponential backoff. Defaults to 1.
-        **kwargs: Additional keyword arguments to pass to the requests.get() function.
 
-    Returns:
-        requests.Response or None: The response object if the request is successful, None otherwise.
+    def __init__(
+        self,
+        policy: PolicyDetails,
+        download_result: DownloadResult | None = None,
+        text: str | None = None,
+    ):
+        self.policy = policy
+        self.download_result = download_result
+        self.text = text
+        self.hash = ""
+        self.validators = Validators()
+        self.vectorized_document: VectorDocument | None = None
+        # the document's chunks compared to what's already indexed
+        self.chunk_changes = None
+        self.vectors = None
+        # future for the chunks being written by the bulk indexer, resolves to any errors
+        self.indexing = None
+        # same for the document's record in the full text index
+        self.fulltext_indexing = None
+        self.result = None
+        # True if it hasn't changed, so there's nothing to save for it (the write buffer
+        # marks documents it saves done itself)
+        self.unchanged = False
+        # (page number, text) while extracting, before the document is made
+        self.pages = None
+        # True if the pages came from the extraction cache
+        self.cached_pages = False
+        # scanned page numbers and the OCR job for them, if any
+        self.scanned_pages = []
+        self.ocr_job = None
+        # True if we copied what was already indexed for the same content at another url
+        self.reused = False
+
+
+class DocumentIngester:
+    """
+    The ingest stages for one source. Each stage takes an IngestItem and returns it to pass
+    it on, or None to stop there.
     """
-    for attempt in range(retries):
+
+    def __init__(
+        self,
+        source: Source,
+        known_documents: DocumentStateIndex,
+        write_buffer: DocumentWriteBuffer,
+        checkpoint: IngestCheckpoint | None = None,
+        extraction_pool: ExtractionPool | None = None,
+        extraction_cache: ExtractionCache | None = None,
+        ocr_queue: OcrQueue | None = None,
+        embedding_batcher: EmbeddingBatcher | None = None,
+        bulk_indexer: BulkIndexer | None = None,
+        index_name: str = ELASTIC_INDEX,
+    ):
+        self.source = source
+        self.known_documents = known_documents
+        self.write_buffer = write_buffer
+        self.checkpoint = checkpoint
+        self.extraction_pool = extraction_pool
+        self.extraction_cache = extraction_cache
+        self.ocr_queue = ocr_queue
+        self.embedding_batcher = embedding_batcher
+        self.bulk_indexer = bulk_indexer
+        # the vector index chunks are written to, a new one while rebuilding (see rebuild.py)
+        self.index_name = index_name
+        self.num_docs_indexed = 0
+        self._lock = threading.Lock()
+
+    def pipeline(self, check, extract: bool = True) -> Pipeline:
+        stages = [Stage("check", check)]
+        if extract:
+            # one thread per worker process, each waits while its process does the work
+            workers = self.extraction_pool.workers if self.extraction_pool else 1
+            stages.append(Stage("extract", self.extract, workers))
+            # one more worker than OCR jobs in flight, so documents without scanned pages
+            # never wait behind ones that are still being OCRed
+            ocr_workers = self.ocr_queue.max_in_flight + 1 if self.ocr_queue else 1
+            stages.append(Stage("ocr", self.ocr, ocr_workers))
+        stages += [
+            Stage("chunk", self.chunk),
+            # only hands chunks to the batcher, the index stage waits for the vectors
+            Stage("embed", self.embed),
+            Stage(
+                "index",
+                self.index,
+                INGEST_INDEX_WORKERS,
+                queue_size=INGEST_EMBED_PENDING_DOCS,
+            ),
+            # the write buffer isn't thread safe, so only one worker here
+            Stage(
+                "record", self.record, workers=1, queue_size=INGEST_INDEX_PENDING_DOCS
+            ),
+        ]
+        return Pipeline(self.source.name, stages, on_done=self.done)
+
+    def is_done(self, policy: PolicyDetails) -> bool:
+        """True if an earlier run of this attempt already finished the document"""
+        return bool(self.checkpoint and policy and self.checkpoint.is_done(policy.url))
+
+    def done(self, item: IngestItem):
+        """Called once we're finished with a document, whatever happened to it"""
+        # a failed document is tried again when the attempt is resumed
+        if self.checkpoint and item.unchanged:
+            self.checkpoint.mark_done(item.policy.url)
+        self.write_buffer.flush_if_due()
+
+    def check_download(self, item: IngestItem) -> IngestItem | None:
+        policy = item.policy
+        download_result = item.download_result
+
+        logger.info(f"Processing document {policy.url}")
+        log_memory_usage(logger)
+
+        # TODO: for now it's all PDF, but we'll need to handle other file types
+
+        if not download_result:
+            logger.error(f"Failed to download pdf at {policy.url}. ")
+            return None
+
+        # the host told us the document hasn't changed, so we never downloaded it
+        if download_result.not_modified:
+            logger.info(f"Document {policy.url} has not been modified, skipping")
+            item.unchanged = True
+            return None
+
+        # hashed while it was downloading
+        item.hash = download_result.hash
+        item.validators = download_result.validators
+
+        # if the document exists and hasn't changed, skip
+        if self.known_documents.get_hash(policy.url) == item.hash:
+            logger.info(f"Document {policy.url} has not changed, skipping")
+            update_validators(policy.url, item.validators, self.known_documents)
+            remove_download(download_result)
+            item.unchanged = True
+            return None
+
+        # the same file may already be indexed at another url
+        if self.reuse_indexed_duplicate(item):
+            remove_download(download_result)
+
+        return item
+
+    def check_text(self, item: IngestItem) -> IngestItem | None:
+        policy = item.policy
+        text = item.text
+
+        logger.info(f"Processing document {policy.url}")
+        log_memory_usage(logger)
+
+        item.hash = hashlib.sha256(text.encode()).hexdigest()
+
+        # if the document exists and hasn't changed, skip
+        if self.known_documents.get_hash(policy.url) == item.hash:
+            logger.info(f"Document {policy.url} has not changed, skipping")
+            item.unchanged = True
+            return None
+
+        if not text:
+            logger.warning(f"No text extracted from {policy.url}")
+            return None
+
+        # the same article may already be indexed at another url
+        if not self.reuse_indexed_duplicate(item):
+            item.vectorized_document = self.to_vectorized_document(item, text=text)
+
+        return item
+
+    def reuse_indexed_duplicate(self, item: IngestItem) -> bool:
+        """
+        If a document with the same content is already indexed at another url, index this url
+        by copying its chunks so we don't extract or embed the same content again.
+        Returns True if the document was indexed this way.
+        """
+        # an index that's being rebuilt has nothing searchable to copy from yet
+        if self.index_name != ELASTIC_INDEX:
+            return False
+
+        policy = item.policy
+        duplicate_url = self.known_documents.find_url_by_hash(
+            item.hash, exclude_url=policy.url
+        )
+
+        if not duplicate_url:
+            return False
+
+        logger.info(f"Document {policy.url} has the same content as {duplicate_url}")
+
+        vectorized_document = self.to_vectorized_document(item)
+
+        # only copies what's indexed under duplicate_url if it still has this hash
+        indexing = copy_document_vectors(
+            duplicate_url, vectorized_document, self.bulk_indexer, self.index_name
+        )
+
+        # nothing to copy, so index it the usual way
+        if not indexing:
+            return False
+
+        item.vectorized_document = vectorized_document
+        item.indexing = indexing
+        item.fulltext_indexing = copy_document_text(
+            duplicate_url, vectorized_document, self.bulk_indexer
+        )
+        item.reused = True
+        return True
+
+    def extract(self, item: IngestItem) -> IngestItem | None:
+        if item.reused:
+            return item
+
+        policy = item.policy
+
         try:
-            response = requests.get(url, **kwargs)
-            if response.status_code == 200:
-                return response
-            else:
+            # same file as one we've extracted before, no need to parse it (or pay for OCR) again
+            if self.extraction_cache:
+                item.pages = self.extraction_cache.get(item.hash)
+                item.cached_pages = item.pages is not None
+
+            if item.pages is None:
+                item.pages = read_pdf_pages(
+                    item.download_result.pdf, policy.url, self.extraction_pool
+                )
+                self.start_ocr(item)
+        except Exception as e:
+            logger.error(f"Error extracting text from {policy.url}: {e}")
+            return None
+        finally:
+            # we're done with the file either way
+            remove_download(item.download_result)
+            item.download_result.content = None
+
+        return item
+
+    def start_ocr(self, item: IngestItem):
+        """Send any scanned pages to OCR, the ocr stage picks up the result"""
+        item.scanned_pages = find_scanned_pages(item.pages)
+
+        if not item.scanned_pages:
+            return
+
+        logger.info(
+            f"Extracting text using OCR from {len(item.scanned_pages)} of {len(item.pages)} pages of {item.policy.url}"
+        )
+
+        document = scanned_pages_document(
+            item.download_result.pdf,
+            item.scanned_pages,
+            len(item.pages),
+            self.extraction_pool,
+        )
+        item.ocr_job = self.ocr_queue.submit(document, item.policy.url)
+
+    def ocr(self, item: IngestItem) -> IngestItem | None:
+        if item.reused:
+            return item
+
+        policy = item.policy
+
+        ocr_failed = False
+        if item.ocr_job:
+            try:
+                ocr_pages = item.ocr_job.result()
+            except Exception as e:
+                # already logged by the OCR queue, the pages pypdf read are still good
                 logger.warning(
-                    f"Request to {url} returned status code {response.status_code} on attempt {attempt + 1}"
+                    f"OCR failed for {policy.url}, indexing it without its scanned pages: {e}"
                 )
-        except requests.exceptions.RequestException as e:
-            logger.warning(
-                f"Request to {url} failed on attempt {attempt + 1} with exception: {e}"
+                ocr_failed = True
+            else:
+                item.pages = merge_ocr_pages(item.pages, item.scanned_pages, ocr_pages)
+            item.ocr_job = None
+
+        pages = [
+            (page_number, text) for page_number, text in item.pages if text.strip()
+        ]
+        item.pages = None
+
+        # missing its scanned pages, so not cached, the next run tries OCR again
+        if self.extraction_cache and not item.cached_pages and not ocr_failed:
+            self.extraction_cache.put(item.hash, pages)
+
+        if not pages:
+            logger.warning(f"No text extracted from {policy.url}")
+            return None
+
+        item.vectorized_document = self.to_vectorized_document(item, pages=pages)
+
+        if ocr_failed:
+            # recorded without its hash and validators so the next run doesn't take it as
+            # unchanged, it's downloaded again and its scanned pages sent to OCR again
+            metadata = item.vectorized_document.metadata
+            metadata.hash = ""
+            metadata.etag = ""
+            metadata.last_modified = ""
+
+        return item
+
+    def chunk(self, item: IngestItem) -> IngestItem | None:
+        if item.reused:
+            return item
+
+        # skip if the document has an ignored classification
+        if has_ignored_classification(item.vectorized_document):
+            logger.error(f"Failed to index document {item.policy.url}")
+            return None
+
+        chunks = split_document(item.vectorized_document)
+        item.chunk_changes = diff_chunks(
+            item.vectorized_document, chunks, self.index_name
+        )
+        return item
+
+    def embed(self, item: IngestItem) -> IngestItem | None:
+        if item.reused:
+            return item
+
+        new_chunks = item.chunk_changes.new
+        if not self.embedding_batcher:
+            item.vectors = Future()
+            item.vectors.set_result(
+                embed_chunks(item.vectorized_document, new_chunks) if new_chunks else []
             )
+            return item
 
-        # If we are here, that means the request failed. We wait before retrying.
-        wait_time = backoff_factor * (2**attempt)
-        logger.info(f"Retrying request to {url} in {wait_time} seconds...")
-        time.sleep(wait_time)
+        if new_chunks:
+            logger.info(f"Vectorizing document {item.policy.url}")
 
-    # If we exit the loop without returning, it means we've exhausted all attempts
-    logger.error(f"Failed to fetch {url} after {retries} attempts")
-    return None
+        # a future, sent along with chunks from other documents
+        item.vectors = self.embedding_batcher.submit(
+            [chunk.page_content for chunk in new_chunks]
+        )
+        return item
 
+    def index(self, item: IngestItem) -> IngestItem | None:
+        if item.reused:
+            return item
 
-def wait_before_next_request():
-    time.sleep(random.uniform(1, 3))  # Sleep for 1 to 3 seconds
+        vectors = item.vectors.result()
 
+        # written along with other documents' chunks, the record stage waits for it
+        item.indexing = index_chunk_changes(
+            item.vectorized_document,
+            item.chunk_changes,
+            vectors,
+            self.bulk_indexer,
+            self.index_name,
+        )
+        item.fulltext_indexing = index_document_text(
+            item.vectorized_document, self.bulk_indexer
+        )
 
-# download the document and return a path to the downloaded file
-def download_pdf(url: str, dir: str) -> str:
-    headers = {"User-Agent": user_agent}
-    response = request_with_retry(
-        url, headers=headers, allow_redirects=True, timeout=60
-    )
+        # these can be big and we don't need them anymore
+        item.chunk_changes = None
+        item.vectors = None
+        item.vectorized_document.text = None
+        item.vectorized_document.pages = None
+
+        return item
+
+    def record(self, item: IngestItem) -> IngestItem | None:
+        self.write_buffer.flush_if_due()
+
+        if item.indexing:
+            # only record the document once its chunks and text are all written
+            errors = item.indexing.result()
+            if item.fulltext_indexing:
+                errors = errors + item.fulltext_indexing.result()
+            item.result = None if errors else item.vectorized_document
+            item.indexing = None
+            item.fulltext_indexing = None
+
+        if update_document(
+            item.policy, item.vectorized_document, item.result, self.write_buffer
+        ):
+            with self._lock:
+                self.num_docs_indexed += 1
+
+        return item
+
+    def to_vectorized_document(
+        self,
+        item: IngestItem,
+        text: str = "",
+        pages: List[Tuple[int, str]] | None = None,
+    ) -> VectorDocument:
+        # add some metadata
+        vectorized_document = item.policy.to_vectorized_document(text, pages)
+        vectorized_document.metadata.hash = item.hash
+        vectorized_document.metadata.etag = item.validators.etag
+        vectorized_document.metadata.last_modified = item.validators.last_modified
+        vectorized_document.metadata.content_length = vectorized_document.content_length
+        vectorized_document.metadata.scope = self.source.name
+        return vectorized_document
 
-    if not response:
-        logger.error(f"Failed to download {url}")
-        return None
 
-    response.raise_for_status()
+def remove_download(download_result: DownloadResult):
+    if download_result.path and os.path.exists(download_result.path):
+        os.remove(download_result.path)
 
-    unique_filename = f"{uuid.uuid4()}.pdf"
-    pdf_path = os.path.join(dir, unique_filename)
 
-    with open(pdf_path, "wb") as file:
-        file.write(response.content)
+def log_extraction_stats(extraction_pool: ExtractionPool):
+    stats = extraction_pool.stats()
+    logger.info(
+        f"Extraction: {stats['workers']} workers, {stats['timeouts']} timed out, "
+        f"{stats['failures']} failed, {stats['recycled']} workers recycled"
+    )
+
+
+def load_known_documents(
+    source: Source, rebuild_index: str | None = None
+) -> DocumentStateIndex:
+    """
+    Everything we already know about this source, so we don't query per document.
+    Nothing is known when rebuilding, so every document is downloaded and indexed again.
+    """
+    if rebuild_index:
+        return DocumentStateIndex()
+    return DocumentStateIndex.load_for_source(source)
 
-    return pdf_path
 
+def log_resume(num_total: int, num_remaining: int):
+    if num_remaining < num_total:
+        logger.info(
+            f"Resuming: {num_total - num_remaining} documents already done, {num_remaining} to go"
+        )
 
-def calculate_file_hash(file_path: str) -> str:
-    hasher = hashlib.sha256()
-    with open(file_path, "rb") as afile:
-        buf = afile.read()
-        hasher.update(buf)
-    return hasher.hexdigest()
 
+def update_validators(
+    url: str, validators: Validators, known_documents: DocumentStateIndex
+):
+    """
+    The file hasn't changed but the host may have given it new validators,
+    store them so next time we can skip the download
+    """
+    if known_documents.get_validators(url) == validators:
+        return
 
-def get_document_by_url(url: str) -> IndexedDocument:
-    return IndexedDocument.objects(url=url).first()
+    IndexedDocument.objects(url=url).update_one(
+        set__metadata__etag=validators.etag,
+        set__metadata__last_modified=validators.last_modified,
+    )
+    known_documents.record_validators(url, validators)
 
 
-def ingest_documents(source: Source, policies: List[PolicyDetails]) -> IngestResult:
+def ingest_documents(
+    source: Source,
+    policies: List[PolicyDetails],
+    checkpoint: IngestCheckpoint | None = None,
+    rebuild_index: str | None = None,
+) -> IngestResult:
+    """
+    Ingest the source's documents into the vector index. With rebuild_index, every document is
+    downloaded and indexed into that index instead, whether it's changed or not (see rebuild.py)
+    """
     start_time = datetime.now(timezone.utc)
-    num_docs_indexed = 0
-    num_new_docs = 0
-
-    with tempfile.TemporaryDirectory() as temp_dir:
-        for policy in policies:
-            logger.info(f"Processing document {policy.url}")
-            log_memory_usage(logger)
-
-            # TODO: for now it's all PDF, but we'll need to handle other file types
-
-            # download the document
-            # calculate the file hash
-            # check if it exists in the database
-            # extract the text
-            # vectorize the text
-            # save the document to elastic search
-            # save the document to the database
-
-            if not policy:
-                logger.warning(f"Policy is None, skipping")
-                continue
-
-            local_pdf_path = download_pdf(policy.url, temp_dir)
-
-            if not local_pdf_path:
-                logger.error(f"Failed to download pdf at {policy.url}. ")
-                continue
-
-            pdf_hash = calculate_file_hash(local_pdf_path)
-
-            document = get_document_by_url(policy.url)
-
-            # if the document exists and hasn't changed, skip
-            if document and document.metadata.get("hash") == pdf_hash:
-                logger.info(f"Document {policy.url} has not changed, skipping")
-                # if we skip a document, let's wait a bit to avoid rate limiting
-                wait_before_next_request()
-                continue
-
-            extracted_text = extract_text_from_pdf(local_pdf_path, policy.url)
-
-            if not extracted_text:
-                logger.warning(f"No text extracted from {local_pdf_path}")
-                continue
-
-            # add some metadata
-            vectorized_document = policy.to_vectorized_document(extracted_text)
-            vectorized_document.metadata.hash = pdf_hash
-            vectorized_document.metadata.content_length = len(extracted_text)
-            vectorized_document.metadata.scope = source.name
-
-            result = vectorize_text(vectorized_document)
-
-            update_document(
-                source,
-                num_docs_indexed,
-                num_new_docs,
-                policy,
-                document,
-                vectorized_document,
-                result,
+
+    connection_stats.reset()
+    embedding_budget.reset_stats()
+    embedding_cache.reset_stats()
+
+    known_documents = load_known_documents(source, rebuild_index)
+
+    with (
+        tempfile.TemporaryDirectory() as temp_dir,
+        ExtractionPool() as extraction_pool,
+        create_ocr_queue() as ocr_queue,
+        EmbeddingBatcher(embedding) as embedding_batcher,
+        BulkIndexer(es_client) as bulk_indexer,
+        DocumentWriteBuffer(
+            source, known_documents, checkpoint=checkpoint
+        ) as write_buffer,
+    ):
+        ingester = DocumentIngester(
+            source,
+            known_documents,
+            write_buffer,
+            checkpoint,
+            extraction_pool,
+            ExtractionCache(EXTRACTOR_VERSION),
+            ocr_queue,
+            embedding_batcher,
+            bulk_indexer,
+            rebuild_index or ELASTIC_INDEX,
+        )
+
+        remaining = [policy for policy in policies if not ingester.is_done(policy)]
+        log_resume(len(policies), len(remaining))
+
+        # downloads run in the background, we get each document as soon as it's ready
+        download_pool = DownloadPool(temp_dir)
+
+        downloads = (
+            IngestItem(policy, download_result=download_result)
+            for policy, download_result in download_pool.download(
+                remaining, known_documents.get_validators
             )
+        )
+
+        # an index being rebuilt already has refresh off
+        pause_refresh = (
+            not rebuild_index and len(remaining) >= INGEST_PAUSE_REFRESH_MIN_DOCS
+        )
+        with (
+            refresh_paused(es_client, ELASTIC_INDEX, pause=pause_refresh),
+            refresh_paused(es_client, ELASTIC_INDEX_FULLTEXT, pause=pause_refresh),
+        ):
+            ingester.pipeline(ingester.check_download).run(downloads)
+
+        # make sure everything is saved before we count new documents
+        write_buffer.flush()
+        num_docs_indexed = ingester.num_docs_indexed
+        num_new_docs = write_buffer.num_inserted
 
         logger.info(f"Indexed {num_docs_indexed} documents from source {source.name}")
+        log_connection_stats()
+        log_rate_limiter_state()
+        log_extraction_stats(extraction_pool)
+        ingester.extraction_cache.log_stats()
+        ocr_queue.log_stats()
+        embedding_batcher.log_stats()
+        embedding_budget.log_stats()
+        embedding_cache.log_stats()
+        bulk_indexer.log_stats()
 
         end_time = datetime.now(timezone.utc)
 
@@ -205,86 +650,86 @@ def ingest_documents(source: Source, policies: List[PolicyDetails]) -> IngestRes
 
 
 def update_document(
-    source: Source,
-    num_docs_indexed: int,
-    num_new_docs: int,
     policy: PolicyDetails,
-    document: IndexedDocument,
     vectorized_document: VectorDocument,
     result: dict,
-):
+    write_buffer: DocumentWriteBuffer,
+) -> bool:
+    """
+    Queue the document to be saved (created if we've never seen it, updated otherwise)
+    if it was indexed. Returns True if it was.
+    """
     if result:
         logger.info(f"Successfully indexed document {policy.url}")
-        num_docs_indexed += 1
-        if not document:
-            # new doc we have never seen, create it
-            num_new_docs += 1
-            document = IndexedDocument(
-                url=policy.url,
-                metadata=vectorized_document.metadata.to_dict(),
-                title=policy.title,
-                filename=policy.filename,
-                last_updated=datetime.now(timezone.utc),
-                source_id=source._id,
-            )
-        else:
-            # existing doc so just update
-            document.metadata = vectorized_document.metadata.to_dict()
-            document.title = policy.title
-            document.filename = policy.filename
-            document.last_updated = datetime.now(timezone.utc)
-
-        document.save()
+        write_buffer.add(policy, vectorized_document)
+        return True
 
     else:
         logger.error(f"Failed to index document {policy.url}")
+        return False
 
 
 def ingest_kb_documents(
-    source: Source, policy_details_with_text: List[Tuple[PolicyDetails, str]]
+    source: Source,
+    policy_details_with_text: List[Tuple[PolicyDetails, str]],
+    checkpoint: IngestCheckpoint | None = None,
+    rebuild_index: str | None = None,
 ) -> IngestResult:
     # KB is a special case, we already have the content
     # eventually it'd be nice to either scrape the site or get API access instead
     start_time = datetime.now(timezone.utc)
-    num_docs_indexed = 0
-    num_new_docs = 0
 
-    for policy, text in policy_details_with_text:
-        logger.info(f"Processing document {policy.url}")
-        log_memory_usage(logger)
-
-        hash = hashlib.sha256(text.encode()).hexdigest()
-
-        document = get_document_by_url(policy.url)
+    embedding_budget.reset_stats()
+    embedding_cache.reset_stats()
 
-        # if the document exists and hasn't changed, skip
-        if document and document.metadata.get("hash") == hash:
-            logger.info(f"Document {policy.url} has not changed, skipping")
-            continue
+    known_documents = load_known_documents(source, rebuild_index)
 
-        if not text:
-            logger.warning(f"No text extracted from {policy.url}")
-            continue
-
-        # add some metadata
-        vectorized_document = policy.to_vectorized_document(text)
-        vectorized_document.metadata.hash = hash
-        vectorized_document.metadata.content_length = len(text)
-        vectorized_document.metadata.scope = source.name
-
-        result = vectorize_text(vectorized_document)
-
-        update_document(
+    with (
+        EmbeddingBatcher(embedding) as embedding_batcher,
+        BulkIndexer(es_client) as bulk_indexer,
+        DocumentWriteBuffer(
+            source, known_documents, checkpoint=checkpoint
+        ) as write_buffer,
+    ):
+        ingester = DocumentIngester(
             source,
-            num_docs_indexed,
-            num_new_docs,
-            policy,
-            document,
-            vectorized_document,
-            result,
+            known_documents,
+            write_buffer,
+            checkpoint,
+            embedding_batcher=embedding_batcher,
+            bulk_indexer=bulk_indexer,
+            index_name=rebuild_index or ELASTIC_INDEX,
+        )
+        remaining = [
+            (policy, text)
+            for policy, text in policy_details_with_text
+            if not ingester.is_done(policy)
+        ]
+        log_resume(len(policy_details_with_text), len(remaining))
+
+        articles = (IngestItem(policy, text=text) for policy, text in remaining)
+
+        # nothing to extract, we already have the text
+        # an index being rebuilt already has refresh off
+        pause_refresh = (
+            not rebuild_index and len(remaining) >= INGEST_PAUSE_REFRESH_MIN_DOCS
         )
+        with (
+            refresh_paused(es_client, ELASTIC_INDEX, pause=pause_refresh),
+            refresh_paused(es_client, ELASTIC_INDEX_FULLTEXT, pause=pause_refresh),
+        ):
+            ingester.pipeline(ingester.check_text, extract=False).run(articles)
+
+        # make sure everything is saved before we count new documents
+        write_buffer.flush()
+        num_docs_indexed = ingester.num_docs_indexed
+        num_new_docs = write_buffer.num_inserted
 
     logger.info(f"Indexed {num_docs_indexed} documents from source {source.name}")
+    embedding_batcher.log_stats()
+    embedding_budget.log_stats()
+    embedding_cache.log_stats()
+    bulk_indexer.log_stats()
 
     end_time = datetime.now(timezone.utc)
 
@@ -0,0 +1,691 @@
+## An in-memory stand-in for the parts of the elastic search client we use, for running offline
+# Strategy:
+# - Indexes are dicts of documents by id, behind one lock so bulk requests and scans from
+#   different threads see whole requests
+# - Covers what store.py, bulk_indexer.py, ingest.py and rebuild.py call: bulk writes (index,
+#   create, update with upsert, delete), get, mget, scan (search with scroll), count, and the
+#   index, alias, template and settings calls. Responses have the same shape as the real
+#   client's
+# - Searches understand match_all, term, terms, match and bool queries, and kNN by cosine
+#   similarity over every vector (exact, so recall is always perfect)
+# - script_score queries work for the cosineSimilarity scripts benchmark_vectors.py uses for
+#   its exact search, any other query or script is a BadRequestError like elastic gives
+# - Errors are the client's own (NotFoundError, BadRequestError), so callers handle them the
+#   same way
+# - Optionally sleeps on each request, like the round trip to a real cluster
+
+from copy import deepcopy
+from fnmatch import fnmatch
+import itertools
+import json
+import math
+import re
+import threading
+import time
+from typing import Dict, List
+
+from elastic_transport import ApiResponseMeta, HttpHeaders, NodeConfig
+from elastic_transport import SerializerCollection
+from elasticsearch import BadRequestError, NotFoundError
+
+
+class _Response(dict):
+    """A response body, also reachable as .body like the real client's responses"""
+
+    @property
+    def body(self):
+        return self
+
+
+def _api_error(error_class, status: int, error_type: str, reason: str):
+    meta = ApiResponseMeta(
+        status=status,
+        http_version="1.1",
+        headers=HttpHeaders(),
+        duration=0.0,
+        node=NodeConfig("http", "memory", 9200),
+    )
+    body = {"error": {"type": error_type, "reason": reason}, "status": status}
+    return error_class(message=error_type, meta=meta, body=body)
+
+
+def _index_not_found(index: str):
+    return _api_error(
+        NotFoundError, 404, "index_not_found_exception", f"no such index [{index}]"
+    )
+
+
+def _field_values(source: dict, field: str) -> list:
+    """Values of a dotted field, flattening lists like elastic does"""
+    values = [source]
+    for name in field.removesuffix(".keyword").split("."):
+        found = []
+        for value in values:
+            if isinstance(value, dict) and name in value:
+                item = value[name]
+                found += item if isinstance(item, list) else [item]
+        values = found
+    return values
+
+
+def _vector(source: dict, field: str) -> List[float] | None:
+    value = source
+    for name in field.split("."):
+        value = value.get(name) if isinstance(value, dict) else None
+    return value
+
+
+def _words(text) -> set:
+    return set(str(text).lower().split())
+
+
+def _matches(source: dict, query: dict | None) -> bool:
+    if not query or "match_all" in query:
+        return True
+
+    if "term" in query:
+        field, value = next(iter(query["term"].items()))
+        if isinstance(value, dict):
+            value = value["value"]
+        return value in _field_values(source, field)
+
+    if "terms" in query:
+        field, values = next(iter(query["terms"].items()))
+        return any(value in values for value in _field_values(source, field))
+
+    if "match" in query:
+        field, value = next(iter(query["match"].items()))
+        if isinstance(value, dict):
+            value = value["query"]
+        words = _words(value)
+        return any(words & _words(found) for found in _field_values(source, field))
+
+    if "bool" in query:
+        clauses = query["bool"]
+
+        def as_list(clause):
+            return clause if isinstance(clause, list) else [clause]
+
+        return (
+            all(
+                _matches(source, q)
+                for key in ("must", "filter")
+                for q in as_list(clauses.get(key, []))
+            )
+            and not any(
+                _matches(source, q) for q in as_list(clauses.get("must_not", []))
+            )
+            and (
+                not clauses.get("should")
+                or any(_matches(source, q) for q in as_list(clauses["should"]))
+            )
+        )
+
+    raise _api_error(
+        BadRequestError,
+        400,
+        "parsing_exception",
+        f"Query not supported in memory: {json.dumps(query)}",
+    )
+
+
+# cosineSimilarity(params.<vector>, '<field>') plus an optional constant
+COSINE_SCRIPT = re.compile(
+    r"\s*cosineSimilarity\(\s*params\.(\w+)\s*,\s*['\"]([\w.]+)['\"]\s*\)"
+    r"\s*(?:\+\s*([\d.]+))?\s*"
+)
+
+
+def _script_score(source: dict, script: dict) -> float | None:
+    """The score a script_score script gives the document, None if it has no vector"""
+    match = COSINE_SCRIPT.fullmatch(script.get("source", ""))
+    if not match:
+        raise _api_error(
+            BadRequestError,
+            400,
+            "script_exception",
+            f"Script not supported in memory: {script.get('source')}",
+        )
+
+    param, field, constant = match.groups()
+    vector = _vector(source, field)
+    if vector is None:
+        return None
+    query_vector = script.get("params", {})[param]
+    return _cosine(query_vector, vector) + float(constant or 0)
+
+
+def _cosine(a: List[float], b: List[float]) -> float:
+    dot = sum(x * y for x, y in zip(a, b))
+    length = math.sqrt(sum(x * x for x in a)) * math.sqrt(sum(y * y for y in b))
+    return dot / length if length else 0.0
+
+
+def _filter_source(source: dict, enabled=True, includes=None, excludes=None):
+    if enabled is False:
+        return None
+    source = deepcopy(source)
+    if includes:
+        source = {key: value for key, value in source.items() if key in includes}
+    for key in excludes or []:
+        source.pop(key, None)
+    return source
+
+
+def _index_settings(settings: dict | None) -> dict:
+    """Settings given either as {"index": {...}} or flat, as strings like elastic keeps them"""
+    settings = settings or {}
+    return {
+        key: value if value is None else str(value)
+        for key, value in settings.get("index", settings).items()
+    }
+
+
+def _merge(target: dict, doc: dict):
+    """A partial update, objects are merged and everything else replaced"""
+    for key, value in doc.items():
+        if isinstance(value, dict) and isinstance(target.get(key), dict):
+            _merge(target[key], value)
+        else:
+            target[key] = deepcopy(value)
+
+
+class _Index:
+    def __init__(self, mappings: dict | None = None, settings: dict | None = None):
+        self.docs: Dict[str, dict] = {}
+        self.mappings = deepcopy(mappings or {})
+        self.settings = {"number_of_shards": "1", "number_of_replicas": "1"}
+        self.settings.update(
+            {key: value for key, value in (settings or {}).items() if value is not None}
+        )
+
+
+class _Indices:
+    def __init__(self, client: "MemoryElasticsearch"):
+        self._client = client
+
+    def exists(self, index: str, **kwargs) -> bool:
+        with self._client._lock:
+            return bool(self._client._resolve(index, missing_ok=True))
+
+    def create(self, index: str, mappings=None, settings=None, **kwargs):
+        with self._client._lock:
+            self._client._create(index, mappings, settings)
+        return _Response(acknowledged=True, index=index)
+
+    def delete(self, index: str, ignore_unavailable: bool = False, **kwargs):
+        with self._client._lock:
+            for name in self._client._resolve(index, missing_ok=ignore_unavailable):
+                del self._client._indexes[name]
+                for indexes in self._client._aliases.values():
+                    indexes.discard(name)
+        return _Response(acknowledged=True)
+
+    def get(self, index: str, **kwargs):
+        with self._client._lock:
+            return _Response(
+                {
+                    name: {
+                        "aliases": self._client._aliases_of(name),
+                        "mappings": deepcopy(self._client._indexes[name].mappings),
+                        "settings": {
+                            "index": dict(self._client._indexes[name].settings)
+                        },
+                    }
+                    for name in self._client._resolve(index, missing_ok="*" in index)
+                }
+            )
+
+    def get_mapping(self, index: str, **kwargs):
+        with self._client._lock:
+            return _Response(
+                {
+                    name: {"mappings": deepcopy(self._client._indexes[name].mappings)}
+                    for name in self._client._resolve(index)
+                }
+            )
+
+    def get_settings(self, index: str, name: str | None = None, **kwargs):
+        with self._client._lock:
+            response = _Response()
+            for index_name in self._client._resolve(index):
+                settings = self._client._indexes[index_name].settings
+                if name:
+                    key = name.removeprefix("index.")
+                    settings = {key: settings[key]} if key in settings else {}
+                response[index_name] = {"settings": {"index": dict(settings)}}
+            return response
+
+    def put_settings(self, index: str, settings: dict, **kwargs):
+        with self._client._lock:
+            for name in self._client._resolve(index):
+                for key, value in _index_settings(settings).items():
+                    if value is None:
+                        self._client._indexes[name].settings.pop(key, None)
+                    else:
+                        self._client._indexes[name].settings[key] = value
+        return _Response(acknowledged=True)
+
+    def put_index_template(self, name: str, index_patterns, template=None, **kwargs):
+        with self._client._lock:
+            patterns = (
+                [index_patterns] if isinstance(index_patterns, str) else index_patterns
+            )
+            self._client._templates[name] = (list(patterns), deepcopy(template or {}))
+        return _Response(acknowledged=True)
+
+    def exists_alias(self, name: str, **kwargs) -> bool:
+        with self._client._lock:
+            return bool(self._client._aliases.get(name))
+
+    def get_alias(self, name: str, **kwargs):
+        with self._client._lock:
+            if not self._client._aliases.get(name):
+                raise _api_error(
+                    NotFoundError, 404, "aliases_not_found_exception", name
+                )
+            return _Response(
+                {
+                    index: {"aliases": {name: {}}}
+                    for index in sorted(self._client._aliases[name])
+                }
+            )
+
+    def update_aliases(self, actions: List[dict], **kwargs):
+        with self._client._lock:
+            aliases = {
+                name: set(indexes) for name, indexes in self._client._aliases.items()
+            }
+            removed = set()
+
+            # removals first, an alias can replace an index in the same update
+            for action in actions:
+                ((kind, args),) = action.items()
+                if kind == "remove_index":
+                    removed.update(self._client._resolve(args["index"]))
+                elif kind == "remove":
+                    aliases.get(args["alias"], set()).discard(args["index"])
+
+            for action in actions:
+                ((kind, args),) = action.items()
+                if kind == "add":
+                    if (
+                        args["alias"] in self._client._indexes
+                        and args["alias"] not in removed
+                    ):
+                        raise _api_error(
+                            BadRequestError,
+                            400,
+                            "invalid_alias_name_exception",
+                            f"an index exists with the same name as the alias [{args['alias']}]",
+                        )
+                    aliases.setdefault(args["alias"], set()).update(
+                        self._client._resolve(args["index"])
+                    )
+
+            for name in removed:
+                del self._client._indexes[name]
+                for indexes in aliases.values():
+                    indexes.discard(name)
+            self._client._aliases = aliases
+        return _Response(acknowledged=True)
+
+    def refresh(self, index: str | None = None, **kwargs):
+        return _Response(_shards={"total": 1, "successful": 1, "failed": 0})
+
+    def forcemerge(self, index: str | None = None, **kwargs):
+        return _Response(_shards={"total": 1, "successful": 1, "failed": 0})
+
+    def stats(self, index: str, **kwargs):
+        with self._client._lock:
+            return _Response(
+                indices={
+                    name: {
+                        "primaries": {
+                            "docs": {"count": len(self._client._indexes[name].docs)},
+                            "store": {
+                                "size_in_bytes": sum(
+                                    len(json.dumps(doc))
+                                    for doc in self._client._indexes[name].docs.values()
+                                )
+                            },
+                        }
+                    }
+                    for name in self._client._resolve(index)
+                }
+            )
+
+
+class _Cluster:
+    def health(self, **kwargs):
+        return _Response(status="green", timed_out=False)
+
+
+class MemoryElasticsearch:
+    """Keeps every index in memory, nothing is kept once the process ends"""
+
+    def __init__(self, latency: float = 0):
+        self.latency = latency
+        self.indices = _Indices(self)
+        self.cluster = _Cluster()
+        # the bulk helpers serialize actions with the client's serializer
+        self.transport = _Transport()
+
+        self._lock = threading.RLock()
+        self._indexes: Dict[str, _Index] = {}
+        self._aliases: Dict[str, set] = {}
+        self._templates: Dict[str, tuple] = {}
+        # scroll id -> (hits not returned yet, page size)
+        self._scrolls: Dict[str, tuple] = {}
+        # for scroll ids and documents written without one
+        self._ids = itertools.count(1)
+
+    def options(self, **kwargs):
+        return self
+
+    def bulk(self, operations, **kwargs):
+        self._wait()
+        started = time.monotonic()
+
+        items = []
+        with self._lock:
+            for header, body in self._split_operations(operations):
+                ((op_type, meta),) = header.items()
+                items.append({op_type: self._bulk_item(op_type, meta, body)})
+
+        return _Response(
+            took=round((time.monotonic() - started) * 1000),
+            errors=any(
+                not 200 <= next(iter(item.values()))["status"] < 300 for item in items
+            ),
+            items=items,
+        )
+
+    def get(
+        self, index: str, id: str, source_includes=None, source_excludes=None, **kwargs
+    ):
+        self._wait()
+        with self._lock:
+            for name in self._resolve(index):
+                doc = self._indexes[name].docs.get(id)
+                if doc is not None:
+                    return _Response(
+                        _index=name,
+                        _id=id,
+                        found=True,
+                        _source=_filter_source(
+                            doc, includes=source_includes, excludes=source_excludes
+                        ),
+                    )
+
+        raise _api_error(NotFoundError, 404, "not_found", f"document [{id}] missing")
+
+    def mget(self, index: str, ids: List[str], source_includes=None, **kwargs):
+        self._wait()
+        with self._lock:
+            names = self._resolve(index)
+            docs = []
+            for id in ids:
+                found = next(
+                    (
+                        (name, self._indexes[name].docs[id])
+                        for name in names
+                        if id in self._indexes[name].docs
+                    ),
+                    None,
+                )
+                if found:
+                    docs.append(
+                        {
+                            "_index": found[0],
+                            "_id": id,
+                            "found": True,
+                            "_source": _filter_source(
+                                found[1], includes=source_includes
+                            ),
+                        }
+                    )
+                else:
+                    docs.append({"_index": index, "_id": id, "found": False})
+
+        return _Response(docs=docs)
+
+    def count(self, index: str, query: dict | None = None, **kwargs):
+        self._wait()
+        with self._lock:
+            return _Response(
+                count=sum(
+                    1
+                    for name in self._resolve(index)
+                    for doc in self._indexes[name].docs.values()
+                    if _matches(doc, query)
+                )
+            )
+
+    def search(
+        self,
+        index: str,
+        query: dict | None = None,
+        knn: dict | None = None,
+        size: int = 10,
+        from_: int = 0,
+        scroll: str | None = None,
+        source=True,
+        _source=None,
+        source_includes=None,
+        source_excludes=None,
+        _source_includes=None,
+        _source_excludes=None,
+        **kwargs,
+    ):
+        self._wait()
+        started = time.monotonic()
+
+        with self._lock:
+            hits = [
+                (name, id, doc)
+                for name in self._resolve(index)
+                for id, doc in self._indexes[name].docs.items()
+            ]
+
+            if knn:
+                hits = [hit for hit in hits if _matches(hit[2], knn.get("filter"))]
+                scored = [
+                    ((1 + _cosine(knn["query_vector"], vector)) / 2, hit)
+                    for hit in hits
+                    if (vector := _vector(hit[2], knn["field"]))
+                ]
+                scored.sort(key=lambda item: item[0], reverse=True)
+                scored = scored[: knn.get("k", size)]
+                if query:
+                    scored = [item for item in scored if _matches(item[1][2], query)]
+            elif query and "script_score" in query:
+                script_score = query["script_score"]
+                scored = [
+                    (score, hit)
+                    for hit in hits
+                    if _matches(hit[2], script_score.get("query"))
+                    and (score := _script_score(hit[2], script_score["script"]))
+                    is not None
+                ]
+                scored.sort(key=lambda item: item[0], reverse=True)
+            else:
+                scored = [(1.0, hit) for hit in hits if _matches(hit[2], query)]
+
+            enabled = source if _source is None else _source
+            found = [
+                {
+                    "_index": name,
+                    "_id": id,
+                    "_score": score,
+                    "_source": _filter_source(
+                        doc,
+                        enabled,
+                        source_includes or _source_includes,
+                        source_excludes or _source_excludes,
+                    ),
+                }
+                for score, (name, id, doc) in scored
+            ]
+            for hit in found:
+                if hit["_source"] is None:
+                    del hit["_source"]
+
+        response = {
+            "took": round((time.monotonic() - started) * 1000),
+            "timed_out": False,
+            "_shards": {"total": 1, "successful": 1, "skipped": 0, "failed": 0},
+            "hits": {
+                "total": {"value": len(found), "relation": "eq"},
+                "max_score": found[0]["_score"] if found else None,
+                "hits": found[from_ : from_ + size],
+            },
+        }
+
+        if scroll:
+            scroll_id = str(next(self._ids))
+            with self._lock:
+                self._scrolls[scroll_id] = (found[from_ + size :], size)
+            response["_scroll_id"] = scroll_id
+
+        return _Response(response)
+
+    def scroll(self, scroll_id: str, **kwargs):
+        with self._lock:
+            remaining, size = self._scrolls.get(scroll_id, ([], 0))
+            page, remaining = remaining[:size], remaining[size:]
+            self._scrolls[scroll_id] = (remaining, size)
+
+        return _Response(
+            _scroll_id=scroll_id,
+            _shards={"total": 1, "successful": 1, "skipped": 0, "failed": 0},
+            hits={"hits": page},
+        )
+
+    def clear_scroll(self, scroll_id: str | None = None, **kwargs):
+        with self._lock:
+            self._scrolls.pop(scroll_id, None)
+        return _Response(succeeded=True)
+
+    def close(self):
+        pass
+
+    def _wait(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+    def _split_operations(self, operations):
+        """(header, body) for each operation, deletes have no body"""
+        lines = [
+            json.loads(line) if isinstance(line, (str, bytes)) else line
+            for line in operations
+        ]
+        i = 0
+        while i < len(lines):
+            header = lines[i]
+            if next(iter(header)) == "delete":
+                yield header, None
+                i += 1
+            else:
+                yield header, lines[i + 1]
+                i += 2
+
+    def _bulk_item(self, op_type: str, meta: dict, body: dict | None) -> dict:
+        name = meta["_index"]
+        id = meta.get("_id") or str(next(self._ids))
+        result = {"_index": name, "_id": id}
+
+        names = self._resolve(name, missing_ok=True)
+        if not names:
+            if op_type == "delete":
+                return {**result, "status": 404, "result": "not_found"}
+            names = [self._create(name)]
+        index = self._indexes[names[0]]
+
+        if op_type == "index":
+            index.docs[id] = deepcopy(body)
+            return {**result, "status": 201, "result": "created"}
+
+        if op_type == "create":
+            if id in index.docs:
+                return {
+                    **result,
+                    "status": 409,
+                    "error": {"type": "version_conflict_engine_exception"},
+                }
+            index.docs[id] = deepcopy(body)
+            return {**result, "status": 201, "result": "created"}
+
+        if op_type == "delete":
+            if index.docs.pop(id, None) is None:
+                return {**result, "status": 404, "result": "not_found"}
+            return {**result, "status": 200, "result": "deleted"}
+
+        if op_type == "update":
+            if id in index.docs:
+                _merge(index.docs[id], body.get("doc", {}))
+                return {**result, "status": 200, "result": "updated"}
+            if body.get("doc_as_upsert") or "upsert" in body:
+                index.docs[id] = deepcopy(body.get("upsert", body.get("doc", {})))
+                return {**result, "status": 201, "result": "created"}
+            return {
+                **result,
+                "status": 404,
+                "error": {
+                    "type": "document_missing_exception",
+                    "reason": f"[{id}]: document missing",
+                },
+            }
+
+        return {
+            **result,
+            "status": 400,
+            "error": {"type": "illegal_argument_exception", "reason": op_type},
+        }
+
+    def _create(self, name: str, mappings=None, settings=None) -> str:
+        if name in self._indexes or name in self._aliases:
+            raise _api_error(
+                BadRequestError,
+                400,
+                "resource_already_exists_exception",
+                f"index [{name}] already exists",
+            )
+
+        # the template's mapping and settings, with whatever the request sets on top of them
+        properties = {}
+        index_settings = {}
+        for patterns, template in self._templates.values():
+            if any(fnmatch(name, pattern) for pattern in patterns):
+                properties.update(template.get("mappings", {}).get("properties", {}))
+                index_settings.update(_index_settings(template.get("settings")))
+        properties.update((mappings or {}).get("properties", {}))
+        index_settings.update(_index_settings(settings))
+
+        self._indexes[name] = _Index(
+            {"properties": properties} if properties else {}, index_settings
+        )
+        return name
+
+    def _resolve(self, index: str, missing_ok: bool = False) -> List[str]:
+        """The concrete indexes behind a name, alias or pattern"""
+        names = []
+        for part in index.split(","):
+            if "*" in part:
+                names += [name for name in self._indexes if fnmatch(name, part)]
+            elif part in self._indexes:
+                names.append(part)
+            elif self._aliases.get(part):
+                names += sorted(self._aliases[part])
+            elif not missing_ok:
+                raise _index_not_found(part)
+        return sorted(set(names))
+
+    def _aliases_of(self, name: str) -> dict:
+        return {
+            alias: {} for alias, indexes in self._aliases.items() if name in indexes
+        }
+
+
+class _Transport:
+    serializers = SerializerCollection()
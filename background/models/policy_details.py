@@ -1,4 +1,5 @@
 import re
+from typing import Iterator, List, Tuple
 
 
 class PolicyDetails:
@@ -27,7 +28,9 @@ class PolicyDetails:
         self.classifications = classifications
         self.subject_areas = subject_areas
 
-    def to_vectorized_document(self, text: str):
+    def to_vectorized_document(
+        self, text: str = "", pages: List[Tuple[int, str]] | None = None
+    ):
         return VectorDocument(
             text,
             Metadata(
@@ -41,8 +44,25 @@ class PolicyDetails:
                 keywords=self.keywords,
                 classifications=self.classifications,
             ),
+            pages,
         )
 
+    def to_dict(self):
+        return {
+            "title": self.title,
+            "url": self.url,
+            "effective_date": self.effective_date,
+            "issuance_date": self.issuance_date,
+            "responsible_office": self.responsible_office,
+            "subject_areas": self.subject_areas,
+            "keywords": self.keywords,
+            "classifications": self.classifications,
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict):
+        return cls(**data)
+
     def __str__(self):
         return f"{self.title} - {self.url} - {self.effective_date} - {self.issuance_date} - {self.responsible_office} - {self.subject_areas} - {self.keywords} - {self.classifications}"
 
@@ -53,9 +73,22 @@ def sanitize_filename(filename):
 
 
 class VectorDocument:
-    def __init__(self, text, metadata):
+    def __init__(self, text, metadata, pages=None):
         self.text: str = text
         self.metadata: Metadata = metadata
+        # (page number, text) for documents extracted page by page, used instead of text
+        self.pages: List[Tuple[int, str]] | None = pages
+
+    def iter_pages(self) -> Iterator[Tuple[int, str]]:
+        """(page number, text) for each page, a document without pages is one page"""
+        if self.pages is not None:
+            yield from self.pages
+        elif self.text:
+            yield 1, self.text
+
+    @property
+    def content_length(self) -> int:
+        return sum(len(text) for _, text in self.iter_pages())
 
     def __str__(self):
         return f"{self.text} - {self.metadata}"
@@ -68,6 +101,8 @@ class Metadata:
         filename,
         url,
         hash="",
+        etag="",
+        last_modified="",
         content_length=0,
         scope="",
         start_index=0,
@@ -88,6 +123,8 @@ class Metadata:
         self.classifications = classifications
         self.subject_areas = subject_areas
         self.hash = hash
+        self.etag = etag
+        self.last_modified = last_modified
         self.content_length = content_length
         self.scope = scope
         self.start_index = start_index
@@ -104,10 +141,12 @@ class Metadata:
             "classifications": self.classifications,
             "subject_areas": self.subject_areas,
             "hash": self.hash,
+            "etag": self.etag,
+            "last_modified": self.last_modified,
             "content_length": self.content_length,
             "scope": self.scope,
             "start_index": self.start_index,
         }
 
     def __str__(self):
-        return f"{self.title} - {self.filename} - {self.effective_date} - {self.issuance_date} - {self.url} - {self.responsible_office} - {self.keywords} - {self.classifications} - {self.subject_areas} - {self.hash} - {self.content_length} - {self.scope} - {self.start_index}"
+        return f"{self.title} - {self.filename} - {self.effective_date} - {self.issuance_date} - {self.url} - {self.responsible_office} - {self.keywords} - {self.classifications} - {self.subject_areas} - {self.hash} - {self.etag} - {self.last_modified} - {self.content_length} - {self.scope} - {self.start_index}"
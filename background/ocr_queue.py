@@ -0,0 +1,198 @@
+## Runs OCR jobs in the background, a limited number at a time
+# Strategy:
+# - submit() starts the analyze job and hands back a Future right away, so whoever submitted
+#   it can get on with other documents while the service works
+# - Only N jobs are in flight at once, submit() waits for a free slot past that
+# - One thread checks every pending job and resolves its future once the service is done with it
+# - Jobs that take too long are failed, so a stuck job doesn't hold its slot forever
+# - Works with anything that speaks the same protocol as DocumentIntelligenceClient:
+#   begin_analyze_document(model, request) returns a poller with done() and result(),
+#   and the result has pages with lines of content
+
+from concurrent.futures import Future
+import os
+import threading
+import time
+from typing import List, Tuple
+
+from azure.ai.documentintelligence.models import AnalyzeDocumentRequest
+
+from logger import setup_logger
+
+logger = setup_logger()
+
+# max OCR jobs waiting on the service at once
+OCR_MAX_IN_FLIGHT = int(os.getenv("OCR_MAX_IN_FLIGHT", "4"))
+# how often to check on pending jobs
+OCR_POLL_SECONDS = float(os.getenv("OCR_POLL_SECONDS", "1"))
+# give up on a job after this long
+OCR_TIMEOUT_SECONDS = float(os.getenv("OCR_TIMEOUT_SECONDS", "600"))
+
+
+def analyze_result_pages(result) -> List[Tuple[int, str]]:
+    """(page number, text) for each page of an analyze result, one line of text per line"""
+    return [
+        (page.page_number, "".join(line.content + "\n" for line in page.lines or []))
+        for page in result.pages or []
+    ]
+
+
+class OcrJob:
+    def __init__(self, doc_url: str, poller, future: Future):
+        self.doc_url = doc_url
+        self.poller = poller
+        self.future = future
+        self.started_at = time.monotonic()
+
+
+class OcrQueue:
+    """
+    Submits documents for OCR and tracks them until they're done.
+    Each job's future resolves to a list of (page number, text).
+    """
+
+    def __init__(
+        self,
+        client,
+        model: str,
+        max_in_flight: int = OCR_MAX_IN_FLIGHT,
+        poll_seconds: float = OCR_POLL_SECONDS,
+        timeout: float = OCR_TIMEOUT_SECONDS,
+    ):
+        self.client = client
+        self.model = model
+        self.max_in_flight = max(1, max_in_flight)
+        self.poll_seconds = poll_seconds
+        self.timeout = timeout
+
+        self._slots = threading.BoundedSemaphore(self.max_in_flight)
+        self._lock = threading.Lock()
+        self._jobs: List[OcrJob] = []
+        self._closed = threading.Event()
+        self._wake = threading.Event()
+        self._thread = threading.Thread(
+            target=self._poll, name="ocr-poller", daemon=True
+        )
+        self._thread.start()
+
+        self.num_submitted = 0
+        self.num_done = 0
+        self.num_failed = 0
+        self.busy_seconds = 0.0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+        return False
+
+    def submit(self, document: bytes, doc_url: str) -> Future:
+        """Start OCR on the document, waiting first if too many jobs are already in flight"""
+        future = Future()
+
+        self._slots.acquire()
+
+        logger.info(f"Analyzing document {doc_url} for OCR text extraction")
+
+        try:
+            poller = self.client.begin_analyze_document(
+                self.model, AnalyzeDocumentRequest(bytes_source=document)
+            )
+        except Exception as e:
+            self._slots.release()
+            with self._lock:
+                self.num_failed += 1
+            future.set_exception(e)
+            return future
+
+        with self._lock:
+            self._jobs.append(OcrJob(doc_url, poller, future))
+            self.num_submitted += 1
+
+        self._wake.set()
+        return future
+
+    @property
+    def in_flight(self) -> int:
+        with self._lock:
+            return len(self._jobs)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "in_flight": len(self._jobs),
+                "submitted": self.num_submitted,
+                "done": self.num_done,
+                "failed": self.num_failed,
+                "average_seconds": (
+                    round(self.busy_seconds / self.num_done, 2) if self.num_done else 0
+                ),
+            }
+
+    def log_stats(self):
+        stats = self.stats()
+        logger.info(
+            f"OCR: {stats['submitted']} jobs submitted, {stats['done']} done, {stats['failed']} failed, "
+            f"{stats['average_seconds']}s average, {stats['in_flight']} still in flight"
+        )
+
+    def close(self):
+        """Stop checking on jobs, anything still pending is failed"""
+        self._closed.set()
+        self._wake.set()
+        self._thread.join()
+
+        with self._lock:
+            jobs = self._jobs
+            self._jobs = []
+
+        for job in jobs:
+            self._finish(
+                job, error=RuntimeError("OCR queue closed before job finished")
+            )
+
+    def _poll(self):
+        while not self._closed.is_set():
+            with self._lock:
+                jobs = list(self._jobs)
+
+            if not jobs:
+                self._wake.wait()
+                self._wake.clear()
+                continue
+
+            for job in jobs:
+                self._check(job)
+
+            self._closed.wait(self.poll_seconds)
+
+    def _check(self, job: OcrJob):
+        try:
+            if job.poller.done():
+                pages = analyze_result_pages(job.poller.result())
+                self._finish(job, pages=pages)
+            elif time.monotonic() - job.started_at > self.timeout:
+                self._finish(
+                    job, error=TimeoutError(f"OCR timed out after {self.timeout}s")
+                )
+        except Exception as e:
+            self._finish(job, error=e)
+
+    def _finish(self, job: OcrJob, pages=None, error: Exception | None = None):
+        with self._lock:
+            if job in self._jobs:
+                self._jobs.remove(job)
+            if error:
+                self.num_failed += 1
+            else:
+                self.num_done += 1
+                self.busy_seconds += time.monotonic() - job.started_at
+
+        self._slots.release()
+
+        if error:
+            logger.error(f"Error analyzing document {job.doc_url}: {error}")
+            job.future.set_exception(error)
+        else:
+            job.future.set_result(pages)
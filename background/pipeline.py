@@ -0,0 +1,233 @@
+## A small staged producer/consumer pipeline
+# Strategy:
+# - Each stage has its own worker threads and reads from a bounded queue fed by the stage before it
+# - A full queue blocks the stage feeding it, so a slow stage holds everything upstream back
+#   and memory stays capped no matter how many items are coming
+# - A stage function returns the item to pass along, or None to drop it (e.g. unchanged documents)
+# - An exception in a stage stops the whole pipeline and is raised from run(), same as it would
+#   be if everything ran in one loop
+# - Once an item is finished, whether it was dropped or made it through every stage, an optional
+#   on_done callback is called with it
+# - Each stage tracks how many items it handled, how long it spent on them and its queue depth
+
+import os
+import queue
+import threading
+import time
+from typing import Any, Callable, Iterable, List
+
+from logger import setup_logger
+
+logger = setup_logger()
+
+# default max number of items waiting in front of each stage
+PIPELINE_QUEUE_SIZE = int(os.getenv("PIPELINE_QUEUE_SIZE", "4"))
+# how often to log stage stats while the pipeline is running, 0 to disable
+PIPELINE_LOG_SECONDS = float(os.getenv("PIPELINE_LOG_SECONDS", "60"))
+
+# marks the end of the items for a worker
+_DONE = object()
+
+# how long a blocked worker waits before checking if the pipeline has failed
+_POLL_SECONDS = 0.5
+
+
+class Stage:
+    def __init__(
+        self,
+        name: str,
+        func: Callable[[Any], Any],
+        workers: int = 1,
+        queue_size: int = PIPELINE_QUEUE_SIZE,
+    ):
+        self.name = name
+        self.func = func
+        self.workers = max(1, workers)
+        self.queue: queue.Queue = queue.Queue(maxsize=max(1, queue_size))
+
+        self._lock = threading.Lock()
+        self._workers_remaining = self.workers
+        self.num_processed = 0
+        self.num_dropped = 0
+        self.busy_seconds = 0.0
+        self.started_at = None
+
+    def record(self, dropped: bool, seconds: float):
+        with self._lock:
+            self.num_processed += 1
+            if dropped:
+                self.num_dropped += 1
+            self.busy_seconds += seconds
+
+    def worker_finished(self) -> bool:
+        """Returns True for the last worker of this stage to finish"""
+        with self._lock:
+            self._workers_remaining -= 1
+            return self._workers_remaining == 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            elapsed = time.monotonic() - self.started_at if self.started_at else 0
+            return {
+                "workers": self.workers,
+                "queue_depth": self.queue.qsize(),
+                "queue_size": self.queue.maxsize,
+                "processed": self.num_processed,
+                "dropped": self.num_dropped,
+                "busy_seconds": round(self.busy_seconds, 2),
+                "per_second": round(self.num_processed / elapsed, 2) if elapsed else 0,
+            }
+
+
+class Pipeline:
+    def __init__(
+        self,
+        name: str,
+        stages: List[Stage],
+        on_done: Callable[[Any], None] | None = None,
+    ):
+        self.name = name
+        self.stages = stages
+        self.on_done = on_done
+        self._failed = threading.Event()
+        self._error: BaseException | None = None
+        self._error_lock = threading.Lock()
+        self.num_fed = 0
+        self.started_at = None
+
+    def run(self, items: Iterable):
+        """
+        Send every item through the stages, returning when all of them are done.
+        Items are pulled from the iterable as the first stage has room for them.
+        """
+        self.started_at = time.monotonic()
+
+        threads = []
+        for i, stage in enumerate(self.stages):
+            next_stage = self.stages[i + 1] if i + 1 < len(self.stages) else None
+            stage.started_at = time.monotonic()
+            for n in range(stage.workers):
+                thread = threading.Thread(
+                    target=self._worker,
+                    args=(stage, next_stage),
+                    name=f"{self.name}-{stage.name}-{n}",
+                    daemon=True,
+                )
+                thread.start()
+                threads.append(thread)
+
+        monitor_done = threading.Event()
+        monitor = threading.Thread(
+            target=self._monitor, args=(monitor_done,), daemon=True
+        )
+        monitor.start()
+
+        try:
+            self._feed(items)
+        except BaseException as e:
+            self._fail(e)
+
+        for thread in threads:
+            thread.join()
+
+        monitor_done.set()
+        monitor.join()
+
+        self.log_stats()
+
+        if self._error:
+            raise self._error
+
+    def stats(self) -> dict:
+        return {stage.name: stage.stats() for stage in self.stages}
+
+    def log_stats(self):
+        elapsed = time.monotonic() - self.started_at if self.started_at else 0
+        logger.info(
+            f"Pipeline {self.name}: {self.num_fed} items in, {round(self.num_fed / elapsed, 2) if elapsed else 0}/s"
+        )
+        for name, stats in self.stats().items():
+            logger.info(
+                f"Pipeline {self.name} stage {name}: {stats['processed']} processed ({stats['dropped']} dropped), "
+                f"{stats['per_second']}/s, queue {stats['queue_depth']}/{stats['queue_size']}, "
+                f"{stats['workers']} workers busy {stats['busy_seconds']}s"
+            )
+
+    def _feed(self, items: Iterable):
+        first = self.stages[0]
+        try:
+            for item in items:
+                if self._failed.is_set():
+                    break
+                self.num_fed += 1
+                self._put(first, item)
+        finally:
+            # stop the source early too if we broke out of it
+            close = getattr(items, "close", None)
+            if close:
+                close()
+            for _ in range(first.workers):
+                self._put(first, _DONE, force=True)
+
+    def _worker(self, stage: Stage, next_stage: Stage | None):
+        while True:
+            item = stage.queue.get()
+
+            if item is _DONE:
+                # the last worker out lets every worker of the next stage know we're done
+                if stage.worker_finished() and next_stage:
+                    for _ in range(next_stage.workers):
+                        self._put(next_stage, _DONE, force=True)
+                return
+
+            # something failed, drain what's left without doing any more work
+            if self._failed.is_set():
+                continue
+
+            start = time.monotonic()
+            try:
+                result = stage.func(item)
+            except BaseException as e:
+                logger.error(f"Pipeline {self.name} stage {stage.name} failed: {e}")
+                self._fail(e)
+                continue
+
+            stage.record(dropped=result is None, seconds=time.monotonic() - start)
+
+            if result is not None and next_stage:
+                self._put(next_stage, result)
+            elif self.on_done:
+                self._done(item if result is None else result)
+
+    def _done(self, item):
+        try:
+            self.on_done(item)
+        except BaseException as e:
+            logger.error(f"Pipeline {self.name} failed finishing an item: {e}")
+            self._fail(e)
+
+    def _put(self, stage: Stage, item, force: bool = False):
+        """
+        Put an item on the stage's queue, blocking while it's full. Unless forced,
+        give up if the pipeline fails while we're waiting.
+        """
+        while True:
+            if not force and self._failed.is_set():
+                return
+            try:
+                stage.queue.put(item, timeout=_POLL_SECONDS)
+                return
+            except queue.Full:
+                continue
+
+    def _fail(self, error: BaseException):
+        with self._error_lock:
+            if self._error is None:
+                self._error = error
+        self._failed.set()
+
+    def _monitor(self, done: threading.Event):
+        if PIPELINE_LOG_SECONDS <= 0:
+            return
+        while not done.wait(PIPELINE_LOG_SECONDS):
+            self.log_stats()
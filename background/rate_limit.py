@@ -0,0 +1,203 @@
+## Adaptive per-host rate limiting for downloads
+# Strategy:
+# - Each host gets a token bucket, every request takes a token and tokens refill at the host's rate
+# - While a host keeps answering quickly and without complaint, slowly raise its rate
+# - When a host pushes back (429 / 503) or gets much slower than usual, cut its rate in half
+# - When a host sends Retry-After, send nothing to it until that time has passed
+
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+import os
+import threading
+import time
+
+from logger import setup_logger
+
+logger = setup_logger()
+
+# requests per second we start each host at, and the range we let it move in
+RATE_LIMIT_INITIAL_RPS = float(os.getenv("RATE_LIMIT_INITIAL_RPS", "0.5"))
+RATE_LIMIT_MIN_RPS = float(os.getenv("RATE_LIMIT_MIN_RPS", "0.05"))
+RATE_LIMIT_MAX_RPS = float(os.getenv("RATE_LIMIT_MAX_RPS", "5"))
+# how many requests can go out back to back before the rate kicks in
+RATE_LIMIT_BURST = float(os.getenv("RATE_LIMIT_BURST", "1"))
+# added to the rate after each healthy response
+RATE_LIMIT_INCREASE_RPS = float(os.getenv("RATE_LIMIT_INCREASE_RPS", "0.05"))
+# the rate is multiplied by this when the host pushes back
+RATE_LIMIT_DECREASE_FACTOR = float(os.getenv("RATE_LIMIT_DECREASE_FACTOR", "0.5"))
+# a response this many times slower than the host's average counts as pushing back
+RATE_LIMIT_LATENCY_FACTOR = float(os.getenv("RATE_LIMIT_LATENCY_FACTOR", "3"))
+# ...as long as it also took at least this many seconds, so small jitter on fast hosts doesn't count
+RATE_LIMIT_SLOW_MIN_SECONDS = float(os.getenv("RATE_LIMIT_SLOW_MIN_SECONDS", "1"))
+# never wait longer than this for a Retry-After
+RATE_LIMIT_MAX_RETRY_AFTER = float(os.getenv("RATE_LIMIT_MAX_RETRY_AFTER", "300"))
+
+# status codes that mean the host wants us to slow down
+THROTTLE_STATUSES = (429, 503)
+
+# weight given to the latest response when updating a host's average latency
+_LATENCY_SMOOTHING = 0.2
+
+
+def parse_retry_after(value: str | None) -> float | None:
+    """Retry-After is either a number of seconds or an HTTP date, returns seconds from now"""
+    if not value:
+        return None
+
+    value = value.strip()
+
+    if value.isdigit():
+        seconds = float(value)
+    else:
+        try:
+            retry_at = parsedate_to_datetime(value)
+        except (TypeError, ValueError):
+            return None
+        if retry_at.tzinfo is None:
+            retry_at = retry_at.replace(tzinfo=timezone.utc)
+        seconds = (retry_at - datetime.now(timezone.utc)).total_seconds()
+
+    return min(max(seconds, 0), RATE_LIMIT_MAX_RETRY_AFTER)
+
+
+class HostRateLimiter:
+    def __init__(
+        self,
+        host: str,
+        rate: float = RATE_LIMIT_INITIAL_RPS,
+        burst: float = RATE_LIMIT_BURST,
+        min_rate: float = RATE_LIMIT_MIN_RPS,
+        max_rate: float = RATE_LIMIT_MAX_RPS,
+    ):
+        self.host = host
+        self.rate = rate
+        self.burst = max(1.0, burst)
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+
+        self._lock = threading.Lock()
+        self._tokens = self.burst
+        self._last_refill = time.monotonic()
+        # monotonic time before which nothing should be sent, from Retry-After
+        self._blocked_until = 0.0
+        self.average_latency: float | None = None
+
+        self.num_requests = 0
+        self.num_throttled = 0
+        self.num_slow = 0
+
+    def acquire(self):
+        """Wait for a token, then take it"""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+
+                wait = self._blocked_until - now
+                if wait <= 0:
+                    if self._tokens >= 1:
+                        self._tokens -= 1
+                        self.num_requests += 1
+                        return
+                    wait = (1 - self._tokens) / self.rate
+
+            time.sleep(wait)
+
+    def record(
+        self, status_code: int | None, latency: float, retry_after: str | None = None
+    ):
+        """
+        Adjust the rate based on how the host responded. status_code is None if the
+        request failed without a response.
+        """
+        with self._lock:
+            retry_after_seconds = parse_retry_after(retry_after)
+
+            if retry_after_seconds and status_code in THROTTLE_STATUSES:
+                self._blocked_until = max(
+                    self._blocked_until, time.monotonic() + retry_after_seconds
+                )
+                self._tokens = 0
+
+            if status_code in THROTTLE_STATUSES:
+                self.num_throttled += 1
+                self._decrease(f"status {status_code}", retry_after_seconds)
+                return
+
+            if status_code is None:
+                # connection trouble, treat it like the host is struggling
+                self._decrease("request failed", None)
+                return
+
+            slow = (
+                self.average_latency is not None
+                and latency > self.average_latency * RATE_LIMIT_LATENCY_FACTOR
+                and latency >= RATE_LIMIT_SLOW_MIN_SECONDS
+            )
+
+            if self.average_latency is None:
+                self.average_latency = latency
+            else:
+                self.average_latency += _LATENCY_SMOOTHING * (
+                    latency - self.average_latency
+                )
+
+            if slow:
+                self.num_slow += 1
+                self._decrease(f"latency {latency:.2f}s", None)
+            elif status_code < 500:
+                self.rate = min(self.max_rate, self.rate + RATE_LIMIT_INCREASE_RPS)
+
+    def state(self) -> dict:
+        with self._lock:
+            return {
+                "rate": round(self.rate, 3),
+                "average_latency": (
+                    round(self.average_latency, 3) if self.average_latency else None
+                ),
+                "blocked_for": round(max(0, self._blocked_until - time.monotonic()), 1),
+                "requests": self.num_requests,
+                "throttled": self.num_throttled,
+                "slow": self.num_slow,
+            }
+
+    def _refill(self, now: float):
+        self._tokens = min(
+            self.burst, self._tokens + (now - self._last_refill) * self.rate
+        )
+        self._last_refill = now
+
+    def _decrease(self, reason: str, retry_after_seconds: float | None):
+        self.rate = max(self.min_rate, self.rate * RATE_LIMIT_DECREASE_FACTOR)
+        retry_after = (
+            f", waiting {retry_after_seconds:.0f}s (Retry-After)"
+            if retry_after_seconds
+            else ""
+        )
+        logger.warning(
+            f"Rate limit for {self.host} lowered to {self.rate:.2f} requests/s due to {reason}{retry_after}"
+        )
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def get_rate_limiter(host: str) -> HostRateLimiter:
+    with _limiters_lock:
+        limiter = _limiters.get(host)
+        if limiter is None:
+            limiter = _limiters[host] = HostRateLimiter(host)
+        return limiter
+
+
+def log_rate_limiter_state():
+    with _limiters_lock:
+        limiters = list(_limiters.values())
+
+    for limiter in limiters:
+        state = limiter.state()
+        logger.info(
+            f"Rate limit {limiter.host}: {state['rate']} requests/s, average latency {state['average_latency']}s, "
+            f"{state['requests']} requests, {state['throttled']} throttled, {state['slow']} slow"
+        )
@@ -0,0 +1,222 @@
+## Rebuilds the vector index from scratch, for when every chunk needs to change at once
+## (a new embedding model or splitter), without readers ever seeing a half built index
+# Strategy:
+# - Build into a new versioned index (ELASTIC_INDEX-<timestamp>) while searches keep using the
+#   live one through the ELASTIC_INDEX alias
+# - No replicas and no refresh while building, so every chunk is only written once and
+#   nothing is made searchable until the end
+# - Ingest every active source into it, downloading and indexing every document whether it's
+#   changed or not (the extraction and embedding caches keep unchanged files cheap)
+# - Then force merge it down to one segment, put replicas and refresh back to what the live
+#   index had, and wait for it to be ready
+# - Finally point the alias at it in one atomic update, readers go from the old index to the
+#   new one with nothing in between. The first time, the plain ELASTIC_INDEX index is removed
+#   in that same update so the alias can take its name
+# - The previous index is kept so we can switch back, older builds are deleted
+# - If anything fails the new index is deleted and the live one is left alone. Ingest has
+#   saved new hashes and validators to IndexedDocument by then for chunks that are gone with
+#   the new index, so the documents are put back the way they were before the rebuild, and
+#   the next update sees every changed document as changed and indexes it into the live index
+# - The full text index (ELASTIC_INDEX_FULLTEXT) isn't rebuilt, each document's record is
+#   written over in place, which also fills in any it's missing. After a failed rebuild it can
+#   be ahead of the live index until the next update catches the live index up
+# - Stop the update loop while rebuilding, anything it indexes into the live index meanwhile
+#   won't be in the new one
+#
+# Run with: python background/rebuild.py
+
+from datetime import datetime, timezone
+import os
+import re
+from typing import Dict
+
+from bson import ObjectId
+from dotenv import load_dotenv
+from pymongo import DeleteOne, InsertOne, ReplaceOne
+
+from crawl import get_source_policy_list
+from db import IndexedDocument, Source, SourceName, SourceStatus
+from ingest import ingest_documents, ingest_kb_documents
+from logger import setup_logger
+from store import ELASTIC_INDEX, embedding, ensure_vector_index, es_client
+
+load_dotenv()
+
+logger = setup_logger()
+
+# older builds kept around after a rebuild (besides the live one), so we can switch back
+REBUILD_KEEP_PREVIOUS = int(os.getenv("REBUILD_KEEP_PREVIOUS", "1"))
+# how long to wait on force merge and the new index to be ready
+REBUILD_TIMEOUT_SECONDS = int(os.getenv("REBUILD_TIMEOUT_SECONDS", "3600"))
+
+# settings we change while building, and what elastic uses when they're not set
+BUILD_SETTINGS = {"number_of_replicas": "0", "refresh_interval": "-1"}
+DEFAULT_SETTINGS = {"number_of_replicas": "1", "refresh_interval": None}
+
+
+def build_index_name() -> str:
+    return f"{ELASTIC_INDEX}-{datetime.now(timezone.utc):%Y%m%d%H%M%S}"
+
+
+def is_build_index(name: str) -> bool:
+    return re.fullmatch(re.escape(ELASTIC_INDEX) + r"-\d{14}", name) is not None
+
+
+def live_settings() -> dict:
+    """Replicas and refresh interval of the live index, to give the new one once it's built"""
+    if not es_client.indices.exists(index=ELASTIC_INDEX):
+        return dict(DEFAULT_SETTINGS)
+
+    response = es_client.indices.get_settings(index=ELASTIC_INDEX)
+    settings = (
+        next(iter(response.body.values()), {}).get("settings", {}).get("index", {})
+    )
+
+    live = {
+        name: settings.get(name, default) for name, default in DEFAULT_SETTINGS.items()
+    }
+    # left off by an ingest run that died part way, it shouldn't be kept
+    if live["refresh_interval"] == "-1":
+        live["refresh_interval"] = None
+    return live
+
+
+def snapshot_documents() -> Dict[ObjectId, dict]:
+    """Every IndexedDocument as it is before the rebuild, to put back if it fails"""
+    return {
+        record["_id"]: record for record in IndexedDocument._get_collection().find()
+    }
+
+
+def restore_documents(snapshot: Dict[ObjectId, dict]):
+    """Put IndexedDocument back the way it was in the snapshot"""
+    collection = IndexedDocument._get_collection()
+    snapshot = dict(snapshot)
+
+    operations = []
+    for record in collection.find():
+        previous = snapshot.pop(record["_id"], None)
+        if previous is None:
+            # first indexed by the rebuild
+            operations.append(DeleteOne({"_id": record["_id"]}))
+        elif previous != record:
+            operations.append(ReplaceOne({"_id": record["_id"]}, previous))
+    operations += [InsertOne(record) for record in snapshot.values()]
+
+    if operations:
+        collection.bulk_write(operations, ordered=False)
+
+    logger.info(f"Restored {len(operations)} documents changed by the rebuild")
+
+
+def create_build_index(index: str):
+    # the mapping needs the vector size, ask the model once
+    dims = len(embedding.embed_query("dimensions"))
+    ensure_vector_index(dims, index)
+
+    es_client.indices.put_settings(index=index, settings={"index": BUILD_SETTINGS})
+
+    logger.info(f"Created index {index} for the rebuild, {dims} dimensions")
+
+
+def fill_build_index(index: str):
+    """Ingest every active source into the new index"""
+    for source in Source.objects(status=SourceStatus.ACTIVE):
+        logger.info(f"Rebuilding source {source.name} into {index}")
+
+        policy_details = get_source_policy_list(source.name)
+
+        # a source missing from the new index is worse than an old index, so stop here
+        if not policy_details:
+            raise ValueError(f"No documents found for source {source.name}")
+
+        if source.name == SourceName.UCDKB.value:
+            result = ingest_kb_documents(source, policy_details, rebuild_index=index)
+        else:
+            result = ingest_documents(source, policy_details, rebuild_index=index)
+
+        logger.info(
+            f"Rebuilt source {source.name}: {result.num_docs_indexed} of {len(policy_details)} documents indexed"
+        )
+
+
+def finish_build_index(index: str, settings: dict):
+    """Merge the new index down and give it the live index's settings back"""
+    client = es_client.options(request_timeout=REBUILD_TIMEOUT_SECONDS)
+
+    logger.info(f"Force merging {index}")
+    client.indices.forcemerge(index=index, max_num_segments=1)
+
+    client.indices.put_settings(index=index, settings={"index": settings})
+    client.indices.refresh(index=index)
+
+    # yellow is enough, a single node cluster never gets its replicas
+    client.cluster.health(
+        index=index, wait_for_status="yellow", timeout=f"{REBUILD_TIMEOUT_SECONDS}s"
+    )
+
+    count = client.count(index=index)["count"]
+    logger.info(f"Index {index} is ready with {count} chunks, settings {settings}")
+
+
+def swap_alias(index: str):
+    """Point the ELASTIC_INDEX alias at the new index, in one atomic update"""
+    actions = [{"add": {"index": index, "alias": ELASTIC_INDEX}}]
+
+    if es_client.indices.exists_alias(name=ELASTIC_INDEX):
+        for old_index in es_client.indices.get_alias(name=ELASTIC_INDEX).body:
+            actions.append({"remove": {"index": old_index, "alias": ELASTIC_INDEX}})
+    elif es_client.indices.exists(index=ELASTIC_INDEX):
+        # the live index was made before we used an alias, it has to go for the alias to
+        # take its name
+        logger.warning(f"Removing index {ELASTIC_INDEX} so the alias can replace it")
+        actions.append({"remove_index": {"index": ELASTIC_INDEX}})
+
+    es_client.indices.update_aliases(actions=actions)
+
+    logger.info(f"Alias {ELASTIC_INDEX} now points to {index}")
+
+
+def delete_old_builds(live_index: str):
+    """Delete builds older than the ones we keep to switch back to"""
+    builds = sorted(
+        (
+            name
+            for name in es_client.indices.get(index=f"{ELASTIC_INDEX}-*").body
+            if is_build_index(name) and name != live_index
+        ),
+        reverse=True,
+    )
+
+    for name in builds[REBUILD_KEEP_PREVIOUS:]:
+        logger.info(f"Deleting old index {name}")
+        es_client.indices.delete(index=name)
+
+
+def rebuild_index() -> str:
+    """Build a new index of every active source and switch searches over to it"""
+    index = build_index_name()
+    settings = live_settings()
+
+    logger.info(f"Rebuilding {ELASTIC_INDEX} into {index}")
+
+    documents = snapshot_documents()
+
+    try:
+        create_build_index(index)
+        fill_build_index(index)
+        finish_build_index(index, settings)
+    except Exception:
+        logger.exception(f"Rebuild failed, deleting {index}")
+        es_client.indices.delete(index=index, ignore_unavailable=True)
+        restore_documents(documents)
+        raise
+
+    swap_alias(index)
+    delete_old_builds(index)
+
+    return index
+
+
+if __name__ == "__main__":
+    rebuild_index()
@@ -1,20 +1,27 @@
 ## Converts policy details to indexed documents
 
+from concurrent.futures import Future
+import hashlib
 import os
-from elasticsearch import Elasticsearch
+import threading
+from typing import Dict, Iterator, List, Tuple
+
+from elasticsearch import NotFoundError, helpers
 
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain_core.documents import Document
-from langchain_elasticsearch import ElasticsearchStore
-from langchain_openai import OpenAIEmbeddings
 
+from backends import EMBEDDING_BACKEND, create_elasticsearch, create_embeddings
+from bulk_indexer import BulkIndexer
+from embedding_budget import BudgetedEmbeddings, EmbeddingBudget
+from embedding_cache import CachedEmbeddings, EmbeddingCache
 from models.policy_details import VectorDocument
 from logger import setup_logger
 
 logger = setup_logger()
 
 API_KEY = os.getenv("OPENAI_API_KEY")
-if not API_KEY:
+if not API_KEY and EMBEDDING_BACKEND == "openai":
     print("OpenAI API key is required")
     exit(1)
 
@@ -23,62 +30,639 @@ ELASTIC_URL = os.getenv("ELASTIC_URL", "http://127.0.0.1:9200")
 ELASTIC_WRITE_USERNAME = os.getenv("ELASTIC_WRITE_USERNAME", "")
 ELASTIC_WRITE_PASSWORD = os.getenv("ELASTIC_WRITE_PASSWORD", "")
 ELASTIC_INDEX = os.getenv("ELASTIC_INDEX", "policy_vectorstore_test")
+# one record per document with its whole text, for keyword and title lookups without kNN
 ELASTIC_INDEX_FULLTEXT = os.getenv("ELASTIC_INDEX_FULLTEXT", "policy_fulltext_test")
 
-# Create our elastic client
-es_client = Elasticsearch(
+# Create our elastic client, or an in-memory stand-in (see backends.py)
+es_client = create_elasticsearch(
     hosts=[ELASTIC_URL],
     basic_auth=(ELASTIC_WRITE_USERNAME, ELASTIC_WRITE_PASSWORD),
     max_retries=10,
     retry_on_timeout=True,
 )
 
-embedding = OpenAIEmbeddings(
-    model=os.getenv("OPENAI_EMBEDDING_MODEL", "text-embedding-3-small")
+EMBEDDING_MODEL = os.getenv("OPENAI_EMBEDDING_MODEL", "text-embedding-3-small")
+# size of the vectors the model returns, empty for its full size (1536 for text-embedding-3-small).
+# text-embedding-3 models keep most of their accuracy at 512 or 256, see benchmark_vectors.py.
+# The index holds one size, changing it needs a rebuild (rebuild.py)
+EMBEDDING_DIMENSIONS = int(os.getenv("OPENAI_EMBEDDING_DIMENSIONS", "0")) or None
+
+# how the vector field is indexed for kNN search. int8_hnsw keeps a copy of each vector as one
+# byte per dimension for the search graph instead of four, the full vectors stay on disk
+ELASTIC_VECTOR_INDEX_TYPE = os.getenv("ELASTIC_VECTOR_INDEX_TYPE", "int8_hnsw")
+# links per vector in the graph, more means better recall and more memory
+ELASTIC_VECTOR_M = int(os.getenv("ELASTIC_VECTOR_M", "16"))
+# candidates looked at when linking a new vector, more means a better graph and slower writes.
+# Above elastic's 100 since we only write a few thousand chunks a run
+ELASTIC_VECTOR_EF_CONSTRUCTION = int(os.getenv("ELASTIC_VECTOR_EF_CONSTRUCTION", "200"))
+# the index template giving our vector indexes (the live one and rebuilds) their mapping
+ELASTIC_VECTOR_TEMPLATE = f"{ELASTIC_INDEX}-template"
+
+# requests to the embedding API wait for room in the model's rate limits (see embedding_budget.py)
+embedding_budget = EmbeddingBudget(EMBEDDING_MODEL)
+# text we've embedded before comes from the cache instead (see embedding_cache.py)
+embedding_cache = EmbeddingCache()
+embedding = CachedEmbeddings(
+    BudgetedEmbeddings(
+        # rate limits are retried by the budget, it needs to see them
+        create_embeddings(EMBEDDING_MODEL, EMBEDDING_DIMENSIONS, max_retries=0),
+        embedding_budget,
+    ),
+    embedding_cache,
 )
 
 # revisions are classified as "Resource" but we don't want to include them in the search
 ignoredClassifications = ["Resource"]
 
 
-def vectorize_text(document: VectorDocument) -> dict:
-    # skip if the document has an ignored classification
+def has_ignored_classification(document: VectorDocument) -> bool:
     if document.metadata.classifications:
         if any(c in ignoredClassifications for c in document.metadata.classifications):
             logger.info(
                 f"Skipping document {document.metadata.url} due to ignored classification"
             )
-            return None
+            return True
+    return False
+
+
+# ingest runs each step as its own stage: split, embed, then index the chunks and text
+
+
+def split_document(document: VectorDocument) -> List[Document]:
+    return list(iter_document_chunks(document))
+
+
+def iter_document_chunks(document: VectorDocument) -> Iterator[Document]:
+    """
+    Split the document a page at a time, so we never need the whole text as one string.
+    Each chunk records the page it came from, and start_index is still its offset into
+    the whole document.
+    """
+    text_splitter = RecursiveCharacterTextSplitter(add_start_index=True)
+    metadata = document.metadata.to_dict()
+
+    offset = 0
+    for page_number, text in document.iter_pages():
+        # use langchain to split the text
+        langchain_document = Document(
+            page_content=text, metadata={**metadata, "page": page_number}
+        )
+
+        for chunk in text_splitter.split_documents([langchain_document]):
+            if chunk.metadata.get("start_index", -1) >= 0:
+                chunk.metadata["start_index"] += offset
+            chunk.metadata["chunk_hash"] = chunk_hash(chunk.page_content)
+            yield chunk
+
+        offset += len(text)
+
+
+def chunk_hash(text: str) -> str:
+    return hashlib.sha256(text.encode()).hexdigest()
 
-    # use langchain to split the text
-    langchain_document = Document(
-        page_content=document.text, metadata=document.metadata.to_dict()
+
+def chunk_id(url: str, start_index: int, hash: str) -> str:
+    """
+    The same chunk of the same document always gets the same id, so writing it again
+    overwrites it instead of adding a copy
+    """
+    return hashlib.sha256(f"{url}\n{start_index}\n{hash}".encode()).hexdigest()
+
+
+def document_chunk_id(chunk: Document) -> str:
+    return chunk_id(
+        chunk.metadata["url"],
+        chunk.metadata.get("start_index", -1),
+        chunk.metadata["chunk_hash"],
     )
 
+
+class ChunkChanges:
+    """
+    How a document's new chunks compare to what's already indexed for it.
+    Only new chunks need embedding, kept chunks are already indexed with the same text.
+    """
+
+    def __init__(
+        self,
+        new: List[Document],
+        kept: List[Tuple[dict, Document]],
+        stale_ids: List[str],
+        replace_all: bool = False,
+        moved: List[Tuple[str, Document, List[float]]] | None = None,
+    ):
+        self.new = new
+        # (indexed chunk without its vector, new chunk with the same text at the same position)
+        self.kept = kept
+        # (id of an indexed chunk, new chunk with the same text somewhere else, its vector),
+        # written again under the new chunk's id
+        self.moved = moved or []
+        # indexed chunks whose text isn't in the document anymore
+        self.stale_ids = stale_ids
+        # we couldn't tell what's indexed, so everything is replaced
+        self.replace_all = replace_all
+
+
+def get_indexed_chunks(url: str, index: str = ELASTIC_INDEX) -> Dict[str, List[dict]]:
+    """Chunks indexed for the url (without their vectors), by the hash of their text"""
+    query = {"query": {"term": {"metadata.url": url}}}
+
+    chunks_by_hash: Dict[str, List[dict]] = {}
+    for hit in helpers.scan(
+        es_client, index=index, query=query, _source_excludes=["vector"]
+    ):
+        source = hit["_source"]
+        # chunks indexed before we stored hashes
+        hash = source.get("metadata", {}).get("chunk_hash") or chunk_hash(
+            source.get("text", "")
+        )
+        chunks_by_hash.setdefault(hash, []).append(hit)
+
+    return chunks_by_hash
+
+
+def diff_chunks(
+    document: VectorDocument, chunks: List[Document], index: str = ELASTIC_INDEX
+) -> ChunkChanges:
+    """
+    Compare the document's chunks to what's indexed for its url, so only chunks with new
+    text are embedded and only chunks that are gone are deleted
+    """
+    try:
+        indexed = get_indexed_chunks(document.metadata.url, index)
+    except Exception as e:
+        logger.warning(
+            f"Couldn't get indexed chunks for {document.metadata.url}, replacing them all: {e}"
+        )
+        return ChunkChanges(chunks, [], [], replace_all=True)
+
+    # the same text can show up more than once in a document, match them up one to one.
+    # Chunks indexed at the same position (so under the same id) first, so one that moved
+    # never takes the indexed chunk another is still at
+    kept = []
+    unmatched = []
+    for chunk in chunks:
+        matches = indexed.get(chunk.metadata["chunk_hash"], [])
+        id = document_chunk_id(chunk)
+        match = next((hit for hit in matches if hit["_id"] == id), None)
+        if match:
+            matches.remove(match)
+            kept.append((match, chunk))
+        else:
+            unmatched.append(chunk)
+
+    new = []
+    moved = []
+    for chunk in unmatched:
+        matches = indexed.get(chunk.metadata["chunk_hash"])
+        if matches:
+            moved.append((matches.pop(), chunk))
+        else:
+            new.append(chunk)
+
+    stale_ids = [hit["_id"] for hits in indexed.values() for hit in hits]
+
+    # a moved chunk has a new id, it's written again with the vector it already has
+    vectors = get_chunk_vectors([hit["_id"] for hit, _ in moved], index)
+    moved_chunks = []
+    for hit, chunk in moved:
+        stale_ids.append(hit["_id"])
+        if hit["_id"] in vectors:
+            moved_chunks.append((hit["_id"], chunk, vectors[hit["_id"]]))
+        else:
+            new.append(chunk)
+
+    logger.info(
+        f"Document {document.metadata.url} has {len(new)} new chunks, {len(kept)} unchanged, "
+        f"{len(moved_chunks)} moved and {len(stale_ids) - len(moved_chunks)} removed"
+    )
+
+    return ChunkChanges(new, kept, stale_ids, moved=moved_chunks)
+
+
+def get_chunk_vectors(ids: List[str], index: str = ELASTIC_INDEX) -> Dict[str, list]:
+    """Vectors of the indexed chunks by id, any we couldn't get are left out"""
+    if not ids:
+        return {}
+
+    try:
+        response = es_client.mget(index=index, ids=ids, source_includes=["vector"])
+    except Exception as e:
+        logger.warning(f"Couldn't get vectors of indexed chunks, embedding again: {e}")
+        return {}
+
+    return {
+        doc["_id"]: doc["_source"]["vector"]
+        for doc in response["docs"]
+        if doc.get("found") and doc.get("_source", {}).get("vector")
+    }
+
+
+def get_indexed_chunk_ids(url: str, index: str = ELASTIC_INDEX) -> List[str] | None:
+    """Ids of every chunk indexed for the url, None if we couldn't find out"""
+    query = {"query": {"term": {"metadata.url": url}}}
+
+    try:
+        return [
+            hit["_id"]
+            for hit in helpers.scan(es_client, index=index, query=query, _source=False)
+        ]
+    except NotFoundError:
+        # no index yet, so nothing indexed
+        return []
+    except Exception as e:
+        logger.warning(f"Couldn't get indexed chunks for {url}: {e}")
+        return None
+
+
+def surplus_chunk_actions(
+    url: str, keep_ids: set, index: str = ELASTIC_INDEX
+) -> List[dict]:
+    """Bulk deletes for the chunks indexed for the url that aren't in keep_ids"""
+    indexed_ids = get_indexed_chunk_ids(url, index)
+
+    if indexed_ids is None:
+        logger.warning(f"Old chunks of {url} are left until it's next indexed")
+        return []
+
+    return [
+        {"_op_type": "delete", "_index": index, "_id": id}
+        for id in indexed_ids
+        if id not in keep_ids
+    ]
+
+
+def embed_chunks(document: VectorDocument, chunks: List[Document]) -> List[List[float]]:
     logger.info(f"Vectorizing document {document.metadata.url}")
 
-    text_splitter = RecursiveCharacterTextSplitter(add_start_index=True)
+    return embedding.embed_documents([chunk.page_content for chunk in chunks])
+
+
+def chunk_actions(
+    chunks: List[Document], vectors: List[List[float]], index: str = ELASTIC_INDEX
+) -> List[dict]:
+    """
+    Bulk actions to index the chunks, stored the same way ElasticsearchStore stores them.
+    Each goes under its chunk_id, so indexing the same chunk again replaces it.
+    """
+    if vectors:
+        ensure_vector_index(len(vectors[0]), index)
+
+    return [
+        {
+            "_op_type": "index",
+            "_index": index,
+            "_id": document_chunk_id(chunk),
+            "text": chunk.page_content,
+            "vector": vector,
+            "metadata": chunk.metadata,
+        }
+        for chunk, vector in zip(chunks, vectors)
+    ]
+
+
+def vector_index_mapping(dims: int) -> dict:
+    """
+    The fields ElasticsearchStore searches, with the vector field quantized. Metadata is
+    left to dynamic mapping, as it always has been
+    """
+    return {
+        "properties": {
+            "text": {"type": "text"},
+            "vector": {
+                "type": "dense_vector",
+                "dims": dims,
+                "index": True,
+                # what ElasticsearchStore uses by default
+                "similarity": "cosine",
+                "index_options": {
+                    "type": ELASTIC_VECTOR_INDEX_TYPE,
+                    "m": ELASTIC_VECTOR_M,
+                    "ef_construction": ELASTIC_VECTOR_EF_CONSTRUCTION,
+                },
+            },
+        }
+    }
+
+
+def put_vector_index_template(dims: int):
+    """Any index named ELASTIC_INDEX or a rebuild of it gets the vector mapping when created"""
+    es_client.indices.put_index_template(
+        name=ELASTIC_VECTOR_TEMPLATE,
+        index_patterns=[ELASTIC_INDEX, f"{ELASTIC_INDEX}-*"],
+        template={"mappings": vector_index_mapping(dims)},
+    )
+
+
+def indexed_vector_dims(index: str) -> List[int]:
+    """The vector size of each index behind the name (more than one for an alias)"""
+    mappings = es_client.indices.get_mapping(index=index).body
+    return [
+        mapping.get("mappings", {}).get("properties", {}).get("vector", {}).get("dims")
+        for mapping in mappings.values()
+    ]
 
-    splitDocs = text_splitter.split_documents([langchain_document])
 
-    # delete any existing documents first with the same url
+# indexes we know exist (with the right vector size), so we only check once a run
+_ready_indexes = set()
+# vector size the template was last put with
+_template_dims = None
+# index stages run in several threads, only one of them creates the index
+_index_lock = threading.Lock()
+
+
+def ensure_vector_index(dims: int, index: str = ELASTIC_INDEX):
+    """
+    Create the index with its vector mapping if it's not there, bulk writes won't.
+    An existing index has to hold vectors of the same size.
+    """
+    global _template_dims
+
+    if index in _ready_indexes:
+        return
+
+    with _index_lock:
+        if index in _ready_indexes:
+            return
+
+        if _template_dims != dims:
+            put_vector_index_template(dims)
+            _template_dims = dims
+
+        if es_client.indices.exists(index=index):
+            for indexed_dims in indexed_vector_dims(index):
+                if indexed_dims is not None and indexed_dims != dims:
+                    raise ValueError(
+                        f"Index {index} holds vectors of {indexed_dims} dimensions but the embedding "
+                        f"model gives {dims}, rebuild it (rebuild.py) to change the size"
+                    )
+        else:
+            # the template gives it the mapping
+            es_client.indices.create(index=index)
+            logger.info(f"Created index {index} for vectors of {dims} dimensions")
+
+        _ready_indexes.add(index)
+
+
+def index_chunks(
+    document: VectorDocument,
+    chunks: List[Document],
+    vectors: List[List[float]],
+    indexer: BulkIndexer,
+    index: str = ELASTIC_INDEX,
+) -> Future:
+    """
+    Replace everything indexed for the document with the chunks: write them over what's
+    there under the same ids, then delete whatever else is indexed for the url.
+    The future resolves to the errors writing them (see bulk_indexer.py).
+    """
+    actions = chunk_actions(chunks, vectors, index)
+    deletes = surplus_chunk_actions(
+        document.metadata.url, {action["_id"] for action in actions}, index
+    )
+
+    logger.info(
+        f"Indexing document {document.metadata.url}: {len(chunks)} chunks, {len(deletes)} deleted"
+    )
+
+    return indexer.submit(actions + deletes)
+
+
+def index_chunk_changes(
+    document: VectorDocument,
+    changes: ChunkChanges,
+    vectors: List[List[float]],
+    indexer: BulkIndexer,
+    index: str = ELASTIC_INDEX,
+) -> Future:
+    """
+    Bring what's indexed for the document up to date: add the new chunks with their vectors,
+    move the moved ones to their new ids, delete the stale ones and update the metadata of
+    kept chunks where it changed.
+    The future resolves to the errors writing them (see bulk_indexer.py).
+    """
+    if changes.replace_all:
+        return index_chunks(document, changes.new, vectors, indexer, index)
+
+    actions = [
+        {"_op_type": "delete", "_index": index, "_id": id} for id in changes.stale_ids
+    ]
+
+    for hit, chunk in changes.kept:
+        # includes the document's hash, every chunk of a url says which version it's from
+        if hit["_source"].get("metadata", {}) != chunk.metadata:
+            actions.append(
+                {
+                    "_op_type": "update",
+                    "_index": index,
+                    "_id": hit["_id"],
+                    "doc": {"metadata": chunk.metadata},
+                }
+            )
+
+    num_updated = len(actions) - len(changes.stale_ids)
+
+    # after the deletes, which include the ids they moved from
+    actions += chunk_actions(
+        [chunk for _, chunk, _ in changes.moved],
+        [vector for _, _, vector in changes.moved],
+        index,
+    )
+    actions += chunk_actions(changes.new, vectors, index)
+
+    logger.info(
+        f"Indexing document {document.metadata.url}: {len(changes.new)} chunks added, "
+        f"{len(changes.moved)} moved, {len(changes.stale_ids) - len(changes.moved)} deleted, "
+        f"{num_updated} updated"
+    )
+
+    return indexer.submit(actions)
+
+
+def copy_document_vectors(
+    source_url: str,
+    document: VectorDocument,
+    indexer: BulkIndexer,
+    index: str = ELASTIC_INDEX,
+) -> Future | None:
+    """
+    Index a document whose content is already indexed under source_url by copying those
+    chunks (text and vectors) with the new document's metadata, instead of embedding again.
+    Returns None if there was nothing to copy, or what's indexed under source_url isn't the
+    document's content (anymore), otherwise a future that resolves to the errors writing the
+    copies (see bulk_indexer.py).
+    """
+    if has_ignored_classification(document):
+        return None
+
+    query = {"query": {"term": {"metadata.url": source_url}}}
+
     try:
-        es_client.delete_by_query(
-            index=ELASTIC_INDEX,
-            body={"query": {"term": {"metadata.url": document.metadata.url}}},
+        chunks = list(helpers.scan(es_client, index=index, query=query))
+    except Exception as e:
+        logger.warning(
+            f"Couldn't get chunks for {source_url}, can't reuse them for {document.metadata.url}: {e}"
+        )
+        return None
+
+    if not chunks:
+        logger.warning(
+            f"No chunks found for {source_url}, can't reuse them for {document.metadata.url}"
+        )
+        return None
+
+    # source_url may have changed since we looked up its hash
+    if any(
+        chunk["_source"]["metadata"].get("hash") != document.metadata.hash
+        for chunk in chunks
+    ):
+        logger.warning(
+            f"Chunks for {source_url} have different content now, can't reuse them for {document.metadata.url}"
         )
-    except Exception:
-        pass  # ignore if index doesn't exist or any other error
-
-    # now push the new documents
-    ElasticsearchStore.from_documents(
-        splitDocs,
-        embedding,
-        index_name=ELASTIC_INDEX,
-        es_connection=es_client,
+        return None
+
+    logger.info(
+        f"Reusing {len(chunks)} chunks from {source_url} for document {document.metadata.url}"
+    )
+
+    # same content, so same length
+    document.metadata.content_length = chunks[0]["_source"]["metadata"].get(
+        "content_length", 0
+    )
+    metadata = document.metadata.to_dict()
+
+    actions = []
+    for chunk in chunks:
+        source = chunk["_source"]
+        start_index = source["metadata"].get("start_index", 0)
+        hash = source["metadata"].get("chunk_hash") or chunk_hash(
+            source.get("text", "")
+        )
+        actions.append(
+            {
+                "_index": index,
+                "_id": chunk_id(metadata["url"], start_index, hash),
+                "_source": {
+                    **source,
+                    "metadata": {
+                        **metadata,
+                        "start_index": start_index,
+                        "page": source["metadata"].get("page", 1),
+                        "chunk_hash": hash,
+                    },
+                },
+            }
+        )
+
+    # whatever was indexed for the url before and isn't overwritten
+    actions += surplus_chunk_actions(
+        document.metadata.url, {action["_id"] for action in actions}, index
     )
 
-    logger.info(f"Done indexing document {document.metadata.url}")
+    return indexer.submit(actions)
+
+
+def fulltext_index_mapping() -> dict:
+    """
+    Exact lookups on the url and hash, and the title both as words and as a whole.
+    The rest of the metadata is mapped dynamically, like the chunks' metadata
+    """
+    return {
+        "properties": {
+            "text": {"type": "text"},
+            "hash": {"type": "keyword"},
+            "metadata": {
+                "properties": {
+                    "url": {"type": "keyword"},
+                    "title": {
+                        "type": "text",
+                        "fields": {"keyword": {"type": "keyword", "ignore_above": 512}},
+                    },
+                }
+            },
+        }
+    }
+
+
+def ensure_fulltext_index(index: str = ELASTIC_INDEX_FULLTEXT):
+    """Create the full text index with its mapping if it's not there, bulk writes won't"""
+    if index in _ready_indexes:
+        return
+
+    with _index_lock:
+        if index in _ready_indexes:
+            return
+
+        if not es_client.indices.exists(index=index):
+            es_client.indices.create(index=index, mappings=fulltext_index_mapping())
+            logger.info(f"Created full text index {index}")
+
+        _ready_indexes.add(index)
+
 
-    # done, return our doc
-    return document
+def fulltext_id(url: str) -> str:
+    """One record per url, so writing a document again replaces its record"""
+    return hashlib.sha256(url.encode()).hexdigest()
+
+
+def document_text_action(
+    document: VectorDocument, text: str, index: str = ELASTIC_INDEX_FULLTEXT
+) -> dict:
+    """Bulk upsert of the document's record in the full text index"""
+    metadata = document.metadata.to_dict()
+    # only means something for chunks
+    metadata.pop("start_index", None)
+
+    return {
+        "_op_type": "update",
+        "_index": index,
+        "_id": fulltext_id(document.metadata.url),
+        "doc": {"text": text, "hash": document.metadata.hash, "metadata": metadata},
+        "doc_as_upsert": True,
+    }
+
+
+def index_document_text(
+    document: VectorDocument,
+    indexer: BulkIndexer,
+    index: str = ELASTIC_INDEX_FULLTEXT,
+) -> Future:
+    """
+    Write the document's whole text to the full text index, the future resolves to the
+    errors writing it (see bulk_indexer.py)
+    """
+    ensure_fulltext_index(index)
+
+    text = "\n".join(text for _, text in document.iter_pages())
+
+    return indexer.submit([document_text_action(document, text, index)])
+
+
+def copy_document_text(
+    source_url: str,
+    document: VectorDocument,
+    indexer: BulkIndexer,
+    index: str = ELASTIC_INDEX_FULLTEXT,
+) -> Future | None:
+    """
+    Write the full text record of a document whose content is already indexed under
+    source_url, using that record's text. Returns None if there's no record of the same
+    content to copy.
+    """
+    try:
+        record = es_client.get(
+            index=index, id=fulltext_id(source_url), source_includes=["text", "hash"]
+        )
+    except NotFoundError:
+        record = None
+
+    if not record or record["_source"].get("hash") != document.metadata.hash:
+        logger.warning(
+            f"No full text record of the same content for {source_url}, "
+            f"{document.metadata.url} won't have one until it's indexed again"
+        )
+        return None
+
+    return indexer.submit(
+        [document_text_action(document, record["_source"].get("text", ""), index)]
+    )
@@ -4,6 +4,8 @@ from datetime import datetime, timedelta, timezone
 import traceback
 from dotenv import load_dotenv
 
+from backends import DATABASE_BACKEND
+from checkpoint import IngestCheckpoint
 from ingest import ingest_documents, ingest_kb_documents
 from crawl import get_source_policy_list
 from db import (
@@ -30,20 +32,31 @@ MAX_SOURCE_FAILURES = 3
 def index_documents(source: Source) -> None:
     start_time = datetime.now(timezone.utc)
 
-    # create new index attempt
-    attempt = IndexAttempt(
-        source_id=source._id,
-        status=IndexStatus.INPROGRESS,
-        num_docs_indexed=0,
-        num_new_docs=0,
-        num_docs_removed=0,
-        start_time=start_time,
-        duration=0,
-        end_time=None,
-        error_details=None,
-    )
+    # if we were stopped part way through this source, pick up where we left off
+    checkpoint = IngestCheckpoint.find_resumable(source)
+
+    if checkpoint:
+        attempt = checkpoint.attempt
+        logger.info(
+            f"Resuming index attempt {attempt.pk} for source {source.name}, {len(checkpoint.completed_urls)} documents already done"
+        )
+    else:
+        # create new index attempt
+        attempt = IndexAttempt(
+            source_id=source._id,
+            status=IndexStatus.INPROGRESS,
+            num_docs_indexed=0,
+            num_new_docs=0,
+            num_docs_removed=0,
+            start_time=start_time,
+            duration=0,
+            end_time=None,
+            error_details=None,
+        )
 
-    attempt.save()
+        attempt.save()
+
+        checkpoint = IngestCheckpoint(attempt)
 
     ## TODO: each source should return a list of PolicyDetails objects from their respective functions
     ## then common code to loop through each, save to db, download files, convert to text, vectorize and save to db
@@ -52,7 +65,11 @@ def index_documents(source: Source) -> None:
     ## OPTIONAL: eventually, we could add a check to see if the policy has been removed from the source, and if so, remove it from the db
 
     try:
-        policy_details = get_source_policy_list(source.name)
+        if checkpoint.has_policies:
+            # we already crawled before we were stopped
+            policy_details = checkpoint.get_policies()
+        else:
+            policy_details = get_source_policy_list(source.name)
 
         if policy_details is None:
             logger.error(f"Source {source.name} not recognized")
@@ -80,21 +97,28 @@ def index_documents(source: Source) -> None:
         # loop through each policy, download files, convert to text, vectorize and save to db
         if source.name == SourceName.UCDKB.value:
             # KB is a special case, we have the data in a JSON file
-            ingest_result = ingest_kb_documents(source, policy_details)
+            # reading it again is cheap, so we don't checkpoint the articles themselves
+            ingest_result = ingest_kb_documents(source, policy_details, checkpoint)
         else:
-            ingest_result = ingest_documents(source, policy_details)
+            if not checkpoint.has_policies:
+                checkpoint.save_policies(policy_details)
+            ingest_result = ingest_documents(source, policy_details, checkpoint)
 
-        logger.info(f"Indexing source {source.name} successful.")
+        logger.info(
+            f"Indexing source {source.name} successful, indexed {ingest_result.num_docs_indexed} documents in {ingest_result.duration}s."
+        )
 
         # End timing the indexing attempt
         end_time = datetime.now(timezone.utc)
 
+        # the counts are kept on the attempt as documents are saved, including by any earlier
+        # run of this attempt, so get the latest before saving it
+        attempt.reload()
+
         # Record a successful index attempt
         attempt.status = IndexStatus.SUCCESS
         attempt.end_time = end_time
         attempt.duration = (end_time - start_time).total_seconds()
-        attempt.num_docs_indexed = ingest_result.num_docs_indexed
-        attempt.num_new_docs = ingest_result.num_new_docs
         attempt.num_docs_removed = 0  # TODO: update with actual counts
 
         source.last_updated = datetime.now(timezone.utc)
@@ -217,10 +241,28 @@ def ensure_default_source():
         source.save()
 
 
+def ensure_offline_source():
+    # the KB is read from a file instead of crawled, so it can be ingested offline
+    source = Source.objects(name=SourceName.UCDKB.value).first()
+
+    if not source:
+        source = Source(
+            name=SourceName.UCDKB.value,
+            url="https://kb.ucdavis.edu/",
+            refresh_frequency=RefreshFrequency.DAILY,
+            last_updated=datetime.now(timezone.utc) - timedelta(days=30),
+            status=SourceStatus.ACTIVE,
+        )
+        source.save()
+
+
 def update__main() -> None:
     logger.info("Starting Indexing Loop")
     cleanup_old_attempts()
     ensure_default_source()  # TMP: don't delete anything but make sure the APM source is in there
+    if DATABASE_BACKEND == "mongomock":
+        # an in-memory database starts empty every time
+        ensure_offline_source()
     update_loop()
 
 